@@ -0,0 +1,84 @@
+"""
+Benchmark of the ChainCRF algorithms: 'sequential' (one step per token) against 'scan' (balanced tree of
+log-semiring / max-plus matrix products). Reports loss forward+backward and decoding time, the difference
+of the losses and of their gradients, and whether the decoded labels are identical.
+"""
+
+import os
+import sys
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+root_path = os.path.dirname(os.path.dirname(current_path))
+sys.path.append(root_path)
+
+import time
+import argparse
+import torch
+from neuronlp2.nn import ChainCRF
+
+
+def make_inputs(batch_size, length, input_size, num_labels, generator):
+    input = torch.randn(batch_size, length, input_size, generator=generator)
+    lengths = torch.randint(max(length // 2, 1), length + 1, (batch_size,), generator=generator)
+    lengths[0] = length
+    mask = (torch.arange(length).unsqueeze(0) < lengths.unsqueeze(1)).float()
+    target = torch.randint(0, num_labels, (batch_size, length), generator=generator) * mask.long()
+    return input, target, mask
+
+
+def run_loss(crf, input, target, mask, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.time()
+        loss = crf.loss(input, target, mask=mask)
+        grads = torch.autograd.grad(loss.sum(), list(crf.parameters()))
+        best = min(best, time.time() - start_time)
+    return best, loss.detach(), grads
+
+
+def run_decode(crf, input, mask, leading_symbolic, repeat):
+    best = float('inf')
+    with torch.no_grad():
+        for _ in range(repeat):
+            start_time = time.time()
+            preds = crf.decode(input, mask=mask, leading_symbolic=leading_symbolic)
+            best = min(best, time.time() - start_time)
+    return best, preds * mask.long()
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description='Benchmark of the ChainCRF algorithms')
+    args_parser.add_argument('--lengths', type=int, nargs='+', default=[10, 25, 50, 100, 200, 400])
+    args_parser.add_argument('--batch_size', type=int, default=32)
+    args_parser.add_argument('--input_size', type=int, default=128)
+    args_parser.add_argument('--num_labels', type=int, default=9)
+    args_parser.add_argument('--leading_symbolic', type=int, default=1)
+    args_parser.add_argument('--repeat', type=int, default=5)
+    args_parser.add_argument('--seed', type=int, default=1234)
+    args_parser.add_argument('--cuda', action='store_true')
+    args = args_parser.parse_args()
+
+    device = torch.device('cuda') if args.cuda else torch.device('cpu')
+    torch.manual_seed(args.seed)
+    sequential = ChainCRF(args.input_size, args.num_labels, bigram=True).to(device)
+    scan = ChainCRF(args.input_size, args.num_labels, bigram=True, algorithm='scan').to(device)
+    scan.load_state_dict(sequential.state_dict())
+
+    generator = torch.Generator().manual_seed(args.seed)
+    print('%6s %12s %12s %8s %12s %12s %8s %8s %10s' % ('length', 'loss seq', 'loss scan', 'speedup', 'max |dloss|', 'max |dgrad|',
+                                                        'dec seq', 'dec scan', 'same path'))
+    for length in args.lengths:
+        input, target, mask = [x.to(device) for x in make_inputs(args.batch_size, length, args.input_size, args.num_labels, generator)]
+        time_seq, loss_seq, grads_seq = run_loss(sequential, input, target, mask, args.repeat)
+        time_scan, loss_scan, grads_scan = run_loss(scan, input, target, mask, args.repeat)
+        dec_seq, preds_seq = run_decode(sequential, input, mask, args.leading_symbolic, args.repeat)
+        dec_scan, preds_scan = run_decode(scan, input, mask, args.leading_symbolic, args.repeat)
+        print('%6d %10.2fms %10.2fms %7.1fx %12.2e %12.2e %6.1fms %6.1fms %10s' % (
+            length, time_seq * 1000, time_scan * 1000, time_seq / time_scan,
+            (loss_seq - loss_scan).abs().max().item(),
+            max((g1 - g2).abs().max().item() for g1, g2 in zip(grads_seq, grads_scan)),
+            dec_seq * 1000, dec_scan * 1000, torch.equal(preds_seq, preds_scan)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Peak memory of the labeled decoding of DeepBiAffine: the legacy path, which expands type_h/type_c to
+[batch, length, length, type_space] and scores every label of every arc at once, against DeepBiAffine.decode,
+which scores the labels of a chunk of heads at a time. Every run is done in a fresh process.
+"""
+
+import os
+import sys
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+root_path = os.path.dirname(os.path.dirname(current_path))
+sys.path.append(root_path)
+
+import time
+import argparse
+import resource
+import multiprocessing
+import numpy as np
+import torch
+import torch.nn.functional as F
+from neuronlp2.models import DeepBiAffine
+from neuronlp2.tasks import parser
+
+
+def legacy_decode(network, input_word, input_char, input_pos, mask, leading_symbolic):
+    out_arc, out_type = network(input_word, input_char, input_pos, mask=mask)
+    type_h, type_c = out_type
+    batch, max_len, type_space = type_h.size()
+    type_h = type_h.unsqueeze(2).expand(batch, max_len, max_len, type_space).contiguous()
+    type_c = type_c.unsqueeze(1).expand(batch, max_len, max_len, type_space).contiguous()
+    out_type = network.bilinear(type_h, type_c)
+    out_arc.masked_fill_(mask.eq(0).unsqueeze(2), float('-inf'))
+    loss_arc = F.log_softmax(out_arc, dim=1)
+    loss_type = F.log_softmax(out_type, dim=3).permute(0, 3, 1, 2)
+    energy = loss_arc.unsqueeze(1) + loss_type
+    length = mask.sum(dim=1).long().cpu().numpy()
+    return parser.decode_MST(energy.cpu().numpy(), length, leading_symbolic=leading_symbolic, labeled=True)
+
+
+def run(mode, args, queue):
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(1)
+    network = DeepBiAffine(100, 1000, 50, 100, 50, 50, 'FastLSTM', args.hidden_size, 1, args.num_labels,
+                           args.arc_space, args.type_space, p_in=0., p_out=0., p_rnn=(0., 0.))
+    network.eval()
+    words = torch.randint(3, 1000, (args.batch_size, args.length))
+    chars = torch.randint(3, 100, (args.batch_size, args.length, 10))
+    postags = torch.randint(3, 50, (args.batch_size, args.length))
+    masks = torch.ones(args.batch_size, args.length)
+
+    with torch.no_grad():
+        # run the encoder once so that its buffers do not count in the decoding memory.
+        network(words, chars, postags, mask=masks)
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start_time = time.time()
+        if mode == 'legacy':
+            heads, types = legacy_decode(network, words, chars, postags, masks, 3)
+        else:
+            heads, types = network.decode(words, chars, postags, mask=masks, leading_symbolic=3)
+        elapsed = time.time() - start_time
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((base, peak, elapsed, heads, types))
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description='Peak memory of the labeled decoding of DeepBiAffine')
+    args_parser.add_argument('--batch_size', type=int, default=32)
+    args_parser.add_argument('--length', type=int, default=140)
+    args_parser.add_argument('--hidden_size', type=int, default=256)
+    args_parser.add_argument('--arc_space', type=int, default=256)
+    args_parser.add_argument('--type_space', type=int, default=128)
+    args_parser.add_argument('--num_labels', type=int, default=40)
+    args_parser.add_argument('--seed', type=int, default=1234)
+    args = args_parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for mode in ['legacy', 'chunked']:
+        queue = context.Queue()
+        process = context.Process(target=run, args=(mode, args, queue))
+        process.start()
+        results[mode] = queue.get()
+        process.join()
+        base, peak, elapsed, _, _ = results[mode]
+        # ru_maxrss is in KB on linux
+        print('%8s: peak RSS %8.1f MB (+%7.1f MB for decoding), time: %.2fs' % (mode, peak / 1024., (peak - base) / 1024., elapsed))
+
+    _, _, _, heads_legacy, types_legacy = results['legacy']
+    _, _, _, heads_chunked, types_chunked = results['chunked']
+    print('same heads: %s, same types: %s' % ((heads_legacy == heads_chunked).all(), (types_legacy == types_chunked).all()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Benchmark of the MST decoders: the recursive reference implementation (parser.decode_MST_recursive)
+against the array-based Chu-Liu-Edmonds (parser.decode_MST), sequential and on a process pool.
+"""
+
+import os
+import sys
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+root_path = os.path.dirname(os.path.dirname(current_path))
+sys.path.append(root_path)
+
+import time
+import argparse
+import numpy as np
+from neuronlp2.tasks import parser
+
+
+def timeit(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.time()
+        result = func()
+        best = min(best, time.time() - start_time)
+    return best, result
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description='Benchmark of the MST decoders')
+    args_parser.add_argument('--lengths', type=int, nargs='+', default=[10, 20, 40, 60, 80, 100, 120, 140], help='sentence lengths')
+    args_parser.add_argument('--batch_size', type=int, default=32, help='number of sentences in each batch')
+    args_parser.add_argument('--num_labels', type=int, default=40, help='number of labels')
+    args_parser.add_argument('--num_workers', type=int, default=4, help='number of processes of the parallel decoder')
+    args_parser.add_argument('--repeat', type=int, default=3, help='number of runs (the best one is reported)')
+    args_parser.add_argument('--seed', type=int, default=1234, help='random seed')
+    args = args_parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    print('%6s %12s %12s %12s %9s %9s %6s' % ('length', 'recursive', 'array', 'parallel', 'speedup', 'par-spd', 'match'))
+    for length in args.lengths:
+        energies = rng.randn(args.batch_size, args.num_labels, length, length).astype(np.float32)
+        lengths = rng.randint(max(length // 2, 2), length + 1, size=args.batch_size)
+        lengths[0] = length
+        leading_symbolic = 3
+
+        time_ref, (heads_ref, types_ref) = timeit(lambda: parser.decode_MST_recursive(energies, lengths, leading_symbolic=leading_symbolic), args.repeat)
+        time_new, (heads_new, types_new) = timeit(lambda: parser.decode_MST(energies, lengths, leading_symbolic=leading_symbolic), args.repeat)
+        # warm up the process pool
+        parser.decode_MST(energies, lengths, leading_symbolic=leading_symbolic, num_workers=args.num_workers)
+        time_par, (heads_par, types_par) = timeit(lambda: parser.decode_MST(energies, lengths, leading_symbolic=leading_symbolic,
+                                                                           num_workers=args.num_workers), args.repeat)
+        match = (heads_ref == heads_new).all() and (types_ref == types_new).all() and \
+                (heads_ref == heads_par).all() and (types_ref == types_par).all()
+        print('%6d %11.2fms %11.2fms %11.2fms %8.1fx %8.1fx %6s' % (length, time_ref * 1000, time_new * 1000, time_par * 1000,
+                                                                  time_ref / time_new, time_ref / time_par, match))
+
+
+if __name__ == '__main__':
+    main()
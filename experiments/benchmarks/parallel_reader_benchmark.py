@@ -0,0 +1,60 @@
+"""
+Benchmark of the parallel CoNLL-X reader: time of conllx_data.read_data with 1 (serial) to N worker processes,
+and whether the data is identical to that of the serial reader.
+"""
+
+import os
+import sys
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+root_path = os.path.dirname(os.path.dirname(current_path))
+sys.path.append(root_path)
+
+import time
+import argparse
+import torch
+from neuronlp2.io import conllx_data
+
+
+def read(path, alphabets, num_workers, ragged, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.time()
+        data = conllx_data.read_data(path, *alphabets, symbolic_root=True, ragged=ragged, num_workers=num_workers)
+        best = min(best, time.time() - start_time)
+    return best, data
+
+
+def identical(data, other):
+    tensors, size, words = data
+    other_tensors, other_size, other_words = other
+    if size != other_size or words != other_words or tensors.keys() != other_tensors.keys():
+        return False
+    # ragged fields are compared padded.
+    return all(torch.equal(tensors[key][:, :], other_tensors[key][:, :]) if key != 'LENGTH' else torch.equal(tensors[key], other_tensors[key])
+               for key in tensors)
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description='Benchmark of the parallel CoNLL-X reader')
+    args_parser.add_argument('--data', required=True, help='CoNLL-X file')
+    args_parser.add_argument('--alphabets', required=True, help='alphabet directory (created from --data if missing)')
+    args_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args_parser.add_argument('--ragged', action='store_true')
+    args_parser.add_argument('--repeat', type=int, default=3)
+    args = args_parser.parse_args()
+
+    alphabets = conllx_data.create_alphabets(args.alphabets, args.data)
+    time_serial, serial = read(args.data, alphabets, 1, args.ragged, args.repeat)
+    print('%8s %10s %10s %8s %10s' % ('workers', 'time', 'sents/s', 'speedup', 'identical'))
+    for num_workers in args.workers:
+        if num_workers == 1:
+            elapsed, data = time_serial, serial
+        else:
+            elapsed, data = read(args.data, alphabets, num_workers, args.ragged, args.repeat)
+        print('%8d %9.2fs %10.1f %7.2fx %10s' % (num_workers, elapsed, data[1] / elapsed, time_serial / elapsed,
+                                                 identical(data, serial)))
+
+
+if __name__ == '__main__':
+    main()
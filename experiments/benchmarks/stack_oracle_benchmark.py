@@ -0,0 +1,128 @@
+"""
+Benchmark of the decoder inputs of the stack-pointer parser: the legacy oracle, which finds the children of every head
+by scanning the sentence (inside_out), sorts them by depth with a recursion (deep_first, shallow_first) and pops them
+from the front of the lists, against stack_oracle, linear in the number of tokens, for every prior order. The outputs
+of both are checked to be identical.
+"""
+
+import os
+import sys
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+root_path = os.path.dirname(os.path.dirname(current_path))
+sys.path.append(root_path)
+
+import time
+import argparse
+from neuronlp2.io.reader import CoNLLXReader
+from neuronlp2.io import conllx_stacked_data
+from neuronlp2.io.conllx_stacked_data import stack_oracle, PRIOR_ORDERS
+from neuronlp2.io.common import PAD_ID_TAG
+
+
+def legacy_child_ids(heads, prior_order):
+    child_ids = [[] for _ in range(len(heads))]
+    if prior_order == 'inside_out':
+        for head in range(len(heads)):
+            for child in reversed(range(1, head)):
+                if heads[child] == head:
+                    child_ids[head].append(child)
+            for child in range(head + 1, len(heads)):
+                if heads[child] == head:
+                    child_ids[head].append(child)
+        return child_ids
+
+    for child in range(1, len(heads)):
+        child_ids[heads[child]].append(child)
+    if prior_order == 'left2right':
+        return child_ids
+
+    def calc_depth(head):
+        max_depth = 0
+        for child in child_ids[head]:
+            depth = calc_depth(child)
+            child_with_depth[head].append((child, depth))
+            max_depth = max(max_depth, depth + 1)
+        child_with_depth[head] = sorted(child_with_depth[head], key=lambda x: x[1], reverse=prior_order == 'deep_first')
+        return max_depth
+
+    child_with_depth = [[] for _ in range(len(heads))]
+    calc_depth(0)
+    return [[child for child, depth in child_with_depth[head]] for head in range(len(heads))]
+
+
+def legacy_stack_inputs(heads, types, prior_order):
+    child_ids = legacy_child_ids(heads, prior_order)
+    stacked_heads = []
+    children = []
+    siblings = []
+    stacked_types = []
+    skip_connect = []
+    prev = [0 for _ in range(len(heads))]
+    sibs = [0 for _ in range(len(heads))]
+    stack = [0]
+    position = 1
+    while len(stack) > 0:
+        head = stack[-1]
+        stacked_heads.append(head)
+        siblings.append(sibs[head])
+        child_id = child_ids[head]
+        skip_connect.append(prev[head])
+        prev[head] = position
+        if len(child_id) == 0:
+            children.append(head)
+            sibs[head] = 0
+            stacked_types.append(PAD_ID_TAG)
+            stack.pop()
+        else:
+            child = child_id.pop(0)
+            children.append(child)
+            sibs[head] = child
+            stack.append(child)
+            stacked_types.append(types[child])
+        position += 1
+    return stacked_heads, children, siblings, stacked_types, skip_connect
+
+
+def read_trees(path, alphabets):
+    reader = CoNLLXReader(path, *alphabets)
+    heads = []
+    types = []
+    for inst in reader.iterate(symbolic_root=True, symbolic_end=False):
+        heads.append(inst.heads)
+        types.append(inst.type_ids)
+    return heads, types
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start_time = time.time()
+        output = fn()
+        elapsed = time.time() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description='Benchmark of the decoder inputs of the stack-pointer parser')
+    args_parser.add_argument('--data', required=True, help='CoNLL-X file')
+    args_parser.add_argument('--alphabets', required=True, help='alphabet directory (created from --data if missing)')
+    args_parser.add_argument('--num_workers', type=int, default=1)
+    args_parser.add_argument('--repeat', type=int, default=3)
+    args = args_parser.parse_args()
+
+    alphabets = conllx_stacked_data.create_alphabets(args.alphabets, args.data)
+    heads, types = read_trees(args.data, alphabets)
+    print('%d sentences, %d tokens' % (len(heads), sum(len(sent_heads) for sent_heads in heads)))
+    print('%14s %9s %9s' % ('', 'legacy', 'linear'))
+    for prior_order in PRIOR_ORDERS:
+        legacy_time, expected = timed(lambda: [legacy_stack_inputs(sent_heads, sent_types, prior_order)
+                                               for sent_heads, sent_types in zip(heads, types)], args.repeat)
+        linear_time, output = timed(lambda: stack_oracle(heads, types, prior_order, num_workers=args.num_workers), args.repeat)
+        assert [tuple(oracle) for oracle in output] == [tuple(oracle) for oracle in expected], prior_order
+        print('%14s %8.3fs %8.3fs' % (prior_order, legacy_time, linear_time))
+
+
+if __name__ == '__main__':
+    main()
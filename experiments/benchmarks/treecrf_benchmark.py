@@ -0,0 +1,87 @@
+"""
+Benchmark of the TreeCRF partition function: the legacy float64 Laplacian (exp without shift, dense diag_embed
+and masking, logdet) against TreeCRF.log_partition (per-child log-space shift, float32). Reports forward+backward
+throughput, the differences of log Z and of its gradient, and the behaviour on large energies.
+"""
+
+import os
+import sys
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+root_path = os.path.dirname(os.path.dirname(current_path))
+sys.path.append(root_path)
+
+import time
+import argparse
+import torch
+from neuronlp2.nn import TreeCRF
+
+
+def legacy_log_partition(energy, mask):
+    batch, length, _ = energy.size()
+    energy = energy.double()
+    A = torch.exp(energy)
+    mask = mask.double()
+    A = A * mask.unsqueeze(2) * mask.unsqueeze(1)
+    diag_mask = 1.0 - torch.eye(length).unsqueeze(0).type_as(energy)
+    A = A * diag_mask
+    D = A.sum(dim=1)
+    D += 1e-6
+    D = D * mask
+    D = torch.diag_embed(D)
+    L = D - A
+    L = L + torch.diag_embed(1. - mask)
+    L = L[:, 1:, 1:]
+    return torch.logdet(L).float()
+
+
+def make_inputs(batch_size, length, scale, generator):
+    energy = torch.randn(batch_size, length, length, generator=generator) * scale
+    lengths = torch.randint(max(length // 2, 2), length + 1, (batch_size,), generator=generator)
+    lengths[0] = length
+    mask = (torch.arange(length).unsqueeze(0) < lengths.unsqueeze(1)).float()
+    return energy * mask.unsqueeze(2) * mask.unsqueeze(1), mask
+
+
+def run(func, energy, mask, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        energy = energy.detach().requires_grad_()
+        start_time = time.time()
+        z = func(energy, mask)
+        grad, = torch.autograd.grad(z.sum(), energy)
+        best = min(best, time.time() - start_time)
+    return best, z.detach(), grad
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description='Benchmark of the TreeCRF partition function')
+    args_parser.add_argument('--lengths', type=int, nargs='+', default=[10, 20, 40, 60, 80, 100, 140])
+    args_parser.add_argument('--batch_size', type=int, default=32)
+    args_parser.add_argument('--repeat', type=int, default=5)
+    args_parser.add_argument('--seed', type=int, default=1234)
+    args = args_parser.parse_args()
+
+    crf = TreeCRF(1)
+    generator = torch.Generator().manual_seed(args.seed)
+    print('%6s %10s %10s %8s %12s %12s' % ('length', 'legacy', 'new', 'speedup', 'max |dZ|/Z', 'max |dgrad|'))
+    for length in args.lengths:
+        energy, mask = make_inputs(args.batch_size, length, 1.0, generator)
+        time_legacy, z_legacy, grad_legacy = run(legacy_log_partition, energy, mask, args.repeat)
+        time_new, z_new, grad_new = run(crf.log_partition, energy, mask, args.repeat)
+        print('%6d %9.2fms %9.2fms %7.1fx %12.2e %12.2e' % (length, time_legacy * 1000, time_new * 1000, time_legacy / time_new,
+                                                          ((z_legacy - z_new).abs() / z_legacy.abs()).max().item(),
+                                                          (grad_legacy - grad_new).abs().max().item()))
+
+    print('\nstability (length 100, energies scaled up):')
+    for scale in [10., 100., 1000.]:
+        energy, mask = make_inputs(args.batch_size, 100, scale, generator)
+        _, z_legacy, grad_legacy = run(legacy_log_partition, energy, mask, 1)
+        _, z_new, grad_new = run(crf.log_partition, energy, mask, 1)
+        print('scale %6.0f: legacy finite log Z %2d/%d, finite grad %s | new finite log Z %2d/%d, finite grad %s' % (
+            scale, torch.isfinite(z_legacy).sum().item(), args.batch_size, torch.isfinite(grad_legacy).all().item(),
+            torch.isfinite(z_new).sum().item(), args.batch_size, torch.isfinite(grad_new).all().item()))
+
+
+if __name__ == '__main__':
+    main()
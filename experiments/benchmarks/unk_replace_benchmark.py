@@ -0,0 +1,93 @@
+"""
+Benchmark of the unk replacement of the training batches: an epoch of iterate_data with the legacy replacement, which
+selects the SINGLE rows of the batch and draws a Bernoulli noise for every position of the batch, against the
+replacement of the singletons of the batch only, from the singleton index of the dataset. Reports the time of an
+epoch and the memory allocated by its batches (measured with the torch profiler).
+"""
+
+import os
+import sys
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+root_path = os.path.dirname(os.path.dirname(current_path))
+sys.path.append(root_path)
+
+import time
+import argparse
+import torch
+from torch.profiler import profile, ProfilerActivity
+from neuronlp2.io import conllx_data, iterate_data
+from neuronlp2.io.vocab import vocabulary_words
+from neuronlp2.io import utils as io_utils
+
+
+class LegacyCollator(object):
+    def __init__(self, data, exclude_keys=('SINGLE', ), unk_replace=0.):
+        self.data = data
+        self.exclude_keys = exclude_keys
+        self.unk_replace = unk_replace
+
+    def __call__(self, index, batch_length):
+        data = self.data
+        batch = {'LENGTH': data['LENGTH'][index]}
+        for key, field in data.items():
+            if key == 'LENGTH' or key in self.exclude_keys:
+                continue
+            length = 2 * batch_length - 1 if key in io_utils._STACK_KEYS else batch_length
+            batch[key] = field[index, :length]
+
+        if self.unk_replace:
+            words = batch['WORD']
+            single = data['SINGLE'][index, :batch_length]
+            noise = single.new_empty(single.size()).bernoulli_(self.unk_replace).long()
+            batch['WORD'] = words * (1 - single * noise)
+        return batch
+
+
+def epoch(data, batch_size, unk_replace):
+    start_time = time.time()
+    num_batches = 0
+    for _ in iterate_data(data, batch_size, bucketed=True, unk_replace=unk_replace, shuffle=True):
+        num_batches += 1
+    return time.time() - start_time, num_batches
+
+
+def allocated(data, batch_size, unk_replace):
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        epoch(data, batch_size, unk_replace)
+    return sum(max(event.self_cpu_memory_usage, 0) for event in prof.events())
+
+
+def run(name, data, args):
+    best = min(epoch(data, args.batch_size, args.unk_replace)[0] for _ in range(args.repeat))
+    memory = allocated(data, args.batch_size, args.unk_replace)
+    print('%8s %9.3fs %10.1fMB' % (name, best, memory / 1e6))
+
+
+def main():
+    args_parser = argparse.ArgumentParser(description='Benchmark of the unk replacement of the training batches')
+    args_parser.add_argument('--data', required=True, help='CoNLL-X file')
+    args_parser.add_argument('--alphabets', required=True, help='alphabet directory (created from --data if missing)')
+    args_parser.add_argument('--batch_size', type=int, default=32)
+    args_parser.add_argument('--unk_replace', type=float, default=0.5)
+    args_parser.add_argument('--ragged', action='store_true')
+    args_parser.add_argument('--singletons', action='store_true', help='keep the rare words in the alphabet as singletons, as if they were in the pretrained embedding')
+    args_parser.add_argument('--repeat', type=int, default=3)
+    args = args_parser.parse_args()
+
+    embedd_dict = dict.fromkeys(vocabulary_words([args.data])) if args.singletons else None
+    alphabets = conllx_data.create_alphabets(args.alphabets, args.data, embedd_dict=embedd_dict)
+    data = conllx_data.read_bucketed_data(args.data, *alphabets, symbolic_root=True, ragged=args.ragged)
+    print('%8s %10s %12s' % ('', 'epoch', 'allocated'))
+
+    dataset_collator = io_utils._dataset_collator
+    io_utils._dataset_collator = LegacyCollator
+    try:
+        run('legacy', data, args)
+    finally:
+        io_utils._dataset_collator = dataset_collator
+    run('indexed', data, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+"""
+Local inference server for the graph-based parsers (DeepBiAffine, NeuroMST and ConvBiAffine).
+
+Concurrent requests are coalesced into length-bucketed batches: the first pending sentence opens a batching
+window of --max_latency ms, after which all the sentences received so far are sorted by length and decoded in
+batches of at most --batch_size sentences (or --max_tokens padded tokens).
+
+POST /parse with a JSON body
+    {"sentences": [["The", "cat", "sat"], {"words": ["It", "rains"], "pos": ["PRP", "VBZ"]}, "raw text"],
+     "format": "json" | "conllx"}
+returns the predicted heads and types as JSON or as CoNLL-X text. GET /health and GET /stats report the state of
+the server and the latency percentiles of the last requests.
+"""
+
+import os
+import sys
+
+current_path = os.path.dirname(os.path.realpath(__file__))
+root_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(root_path)
+
+import time
+import json
+import queue
+import argparse
+import threading
+import socketserver
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+from neuronlp2.io import get_logger, conllx_data
+from neuronlp2.io.common import DIGIT_RE, MAX_CHAR_LENGTH, PAD_ID_WORD, PAD_ID_CHAR, PAD_ID_TAG
+from neuronlp2.io.common import ROOT, ROOT_CHAR, ROOT_POS
+from neuronlp2.models import BiRecurrentConvBiAffine
+from parsing import load_model
+
+
+class _Sentence(object):
+    def __init__(self, words, postags, word_ids, char_id_seqs, pos_ids):
+        self.words = words
+        self.postags = postags
+        self.word_ids = word_ids
+        self.char_id_seqs = char_id_seqs
+        self.pos_ids = pos_ids
+        self.heads = None
+        self.types = None
+        self.error = None
+        self.done = threading.Event()
+
+    def length(self):
+        return len(self.words) + 1
+
+
+class DynamicBatcher(object):
+    """
+    Collect the sentences of concurrent requests and decode them in length-bucketed batches.
+    """
+    def __init__(self, network, alphabets, device, batch_size=32, max_tokens=None, max_latency=0.01, normalize_digits=True, pos=True):
+        self.network = network
+        self.word_alphabet, self.char_alphabet, self.pos_alphabet, self.type_alphabet = alphabets
+        self.device = device
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.max_latency = max_latency
+        self.normalize_digits = normalize_digits
+        # the model reads the pos tags.
+        self.pos = pos
+        self.queue = queue.Queue()
+        self.num_batches = 0
+        self.num_sentences = 0
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+
+    def start(self):
+        self.__thread.start()
+
+    def encode(self, words, postags):
+        """
+        Map a sentence to ids, in the request thread: a sentence is only queued once it is valid, so that a bad
+        request never fails the batch it would share with other requests.
+
+        Args:
+            words: list
+                the words of the sentence.
+            postags: list or None
+                the pos tags of the words. Missing tags ('_' or None) are read as CoNLLXReader does ('$,'), they
+                are rejected if the pos alphabet has no '$,' and the model reads the pos tags.
+
+        Returns: _Sentence
+            the sentence to parse.
+
+        """
+        if not all(isinstance(word, str) for word in words):
+            raise ValueError('words must be strings')
+        if postags is None:
+            postags = ['_'] * len(words)
+        elif not all(isinstance(pos, str) for pos in postags):
+            raise ValueError('pos tags must be strings')
+        # symbolic root
+        word_ids = [self.word_alphabet.get_index(ROOT)]
+        char_id_seqs = [[self.char_alphabet.get_index(ROOT_CHAR)]]
+        pos_ids = [self.pos_alphabet.get_index(ROOT_POS)]
+        for word, pos in zip(words, postags):
+            char_id_seqs.append([self.char_alphabet.get_index(char) for char in word[:MAX_CHAR_LENGTH]])
+            word = DIGIT_RE.sub("0", word) if self.normalize_digits else word
+            word_ids.append(self.word_alphabet.get_index(word))
+            pos = '$,' if pos == '_' else pos
+            try:
+                pos_ids.append(self.pos_alphabet.get_index(pos))
+            except KeyError:
+                if pos != '$,':
+                    raise ValueError('unknown pos tag: %s' % pos)
+                if self.pos:
+                    raise ValueError('the model requires the pos tags of the words')
+                pos_ids.append(PAD_ID_TAG)
+        return _Sentence(words, postags, word_ids, char_id_seqs, pos_ids)
+
+    def parse(self, pending):
+        """
+        Args:
+            pending: list
+                list of sentences returned by encode.
+
+        Returns: list
+            list of (heads, types) of each sentence (without the symbolic root).
+
+        """
+        for sent in pending:
+            self.queue.put(sent)
+        for sent in pending:
+            sent.done.wait()
+            if sent.error is not None:
+                raise sent.error
+        return [(sent.heads, sent.types) for sent in pending]
+
+    def __run(self):
+        while True:
+            # the first sentence opens the batching window.
+            pending = [self.queue.get()]
+            deadline = time.time() + self.max_latency
+            while True:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            pending.sort(key=lambda sent: sent.length())
+            for batch in self.__buckets(pending):
+                try:
+                    self.__decode(batch)
+                except Exception as e:
+                    for sent in batch:
+                        sent.error = e
+                for sent in batch:
+                    sent.done.set()
+
+    def __buckets(self, sentences):
+        # sentences are sorted by length, so the last sentence of a batch is the longest one.
+        batch = []
+        for sent in sentences:
+            if batch and (len(batch) == self.batch_size or
+                          (self.max_tokens is not None and (len(batch) + 1) * sent.length() > self.max_tokens)):
+                yield batch
+                batch = []
+            batch.append(sent)
+        if batch:
+            yield batch
+
+    def __tensorize(self, batch):
+        batch_size = len(batch)
+        max_length = max(sent.length() for sent in batch)
+        char_length = max(len(cids) for sent in batch for cids in sent.char_id_seqs)
+        wid_inputs = np.full([batch_size, max_length], PAD_ID_WORD, dtype=np.int64)
+        cid_inputs = np.full([batch_size, max_length, char_length], PAD_ID_CHAR, dtype=np.int64)
+        pid_inputs = np.full([batch_size, max_length], PAD_ID_TAG, dtype=np.int64)
+        masks = np.zeros([batch_size, max_length], dtype=np.float32)
+
+        for i, sent in enumerate(batch):
+            inst_size = sent.length()
+            wid_inputs[i, :inst_size] = sent.word_ids
+            for j, cids in enumerate(sent.char_id_seqs):
+                cid_inputs[i, j, :len(cids)] = cids
+            pid_inputs[i, :inst_size] = sent.pos_ids
+            masks[i, :inst_size] = 1.0
+
+        words = torch.from_numpy(wid_inputs).to(self.device)
+        chars = torch.from_numpy(cid_inputs).to(self.device)
+        postags = torch.from_numpy(pid_inputs).to(self.device)
+        masks = torch.from_numpy(masks).to(self.device)
+        return words, chars, postags, masks
+
+    def __decode(self, batch):
+        words, chars, postags, masks = self.__tensorize(batch)
+        with torch.no_grad():
+            if isinstance(self.network, BiRecurrentConvBiAffine):
+                heads, types = self.network.decode_mst(words, chars, postags, mask=masks, leading_symbolic=conllx_data.NUM_SYMBOLIC_TAGS)
+            else:
+                heads, types = self.network.decode(words, chars, postags, mask=masks, leading_symbolic=conllx_data.NUM_SYMBOLIC_TAGS)
+        for i, sent in enumerate(batch):
+            inst_size = sent.length()
+            sent.heads = [int(head) for head in heads[i, 1:inst_size]]
+            sent.types = [self.type_alphabet.get_instance(int(type)) for type in types[i, 1:inst_size]]
+        self.num_batches += 1
+        self.num_sentences += len(batch)
+
+
+def _read_sentences(request, batcher):
+    sentences = []
+    for sent in request['sentences']:
+        if isinstance(sent, str):
+            words, postags = sent.split(), None
+        elif isinstance(sent, dict):
+            words, postags = sent['words'], sent.get('pos')
+        else:
+            words, postags = sent, None
+        if len(words) == 0:
+            raise ValueError('empty sentence')
+        if postags is not None and len(postags) != len(words):
+            raise ValueError('number of pos tags does not match the number of words')
+        sentences.append(batcher.encode(list(words), postags))
+    return sentences
+
+
+def _format_conllx(sentences, results):
+    lines = []
+    for sent, (heads, types) in zip(sentences, results):
+        for j, (word, pos) in enumerate(zip(sent.words, sent.postags)):
+            lines.append('%d\t%s\t_\t_\t%s\t_\t%d\t%s\n' % (j + 1, word, pos, heads[j], types[j]))
+        lines.append('\n')
+    return ''.join(lines)
+
+
+class ParseHandler(BaseHTTPRequestHandler):
+    # set by serve()
+    batcher = None
+    latencies = deque(maxlen=10000)
+
+    def address_string(self):
+        # requests over a unix socket have no client address.
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def __send(self, code, body, content_type='application/json'):
+        body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.__send(200, json.dumps({'status': 'ok'}))
+        elif self.path == '/stats':
+            latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+            stats = {'requests': len(self.latencies), 'batches': self.batcher.num_batches, 'sentences': self.batcher.num_sentences,
+                     'latency_ms': {'p50': float(np.percentile(latencies, 50)), 'p90': float(np.percentile(latencies, 90)),
+                                    'p99': float(np.percentile(latencies, 99))}}
+            self.__send(200, json.dumps(stats))
+        else:
+            self.__send(404, json.dumps({'error': 'not found: %s' % self.path}))
+
+    def do_POST(self):
+        if self.path != '/parse':
+            self.__send(404, json.dumps({'error': 'not found: %s' % self.path}))
+            return
+        start_time = time.time()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            sentences = _read_sentences(request, self.batcher)
+            fmt = request.get('format', 'json')
+            if fmt not in ['json', 'conllx']:
+                raise ValueError('Unknown output format: %s' % fmt)
+        except (ValueError, KeyError, TypeError) as e:
+            self.__send(400, json.dumps({'error': str(e)}))
+            return
+
+        try:
+            results = self.batcher.parse(sentences)
+        except Exception as e:
+            self.__send(500, json.dumps({'error': str(e)}))
+            return
+
+        if fmt == 'conllx':
+            self.__send(200, _format_conllx(sentences, results), content_type='text/plain')
+        else:
+            response = [{'words': sent.words, 'heads': heads, 'types': types} for sent, (heads, types) in zip(sentences, results)]
+            self.__send(200, json.dumps({'sentences': response}))
+        self.latencies.append(time.time() - start_time)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def serve(args):
+    logger = get_logger("Parse Server")
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device('cuda', 0) if torch.cuda.is_available() and not args.cpu else torch.device('cpu')
+
+    network, alphabets, alg, _ = load_model(args.model_path, device, logger)
+    if alg != 'graph':
+        raise RuntimeError('Only the graph-based parsers can be served')
+    hyps = json.load(open(os.path.join(args.model_path, 'config.json'), 'r'))
+
+    batcher = DynamicBatcher(network, alphabets, device, batch_size=args.batch_size, max_tokens=args.max_tokens,
+                             max_latency=args.max_latency / 1000.0, pos=hyps['pos'])
+    batcher.start()
+    ParseHandler.batcher = batcher
+
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, ParseHandler)
+        logger.info("Serving on unix socket %s" % args.socket)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), ParseHandler)
+        logger.info("Serving on http://%s:%d" % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    args_parser = argparse.ArgumentParser(description='Inference server for graph-based parsing')
+    args_parser.add_argument('--model_path', help='path of the trained model.', required=True)
+    args_parser.add_argument('--host', default='127.0.0.1', help='host to listen on')
+    args_parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    args_parser.add_argument('--socket', default=None, help='listen on this unix socket instead of a TCP port')
+    args_parser.add_argument('--batch_size', type=int, default=32, help='maximum number of sentences in each batch')
+    args_parser.add_argument('--max_tokens', type=int, default=None, help='maximum number of (padded) tokens in each batch')
+    args_parser.add_argument('--max_latency', type=float, default=10.0, help='batching window in milliseconds')
+    args_parser.add_argument('--num_threads', type=int, default=None, help='number of torch threads')
+    args_parser.add_argument('--cpu', action='store_true', help='run on CPU even if a GPU is available')
+
+    args = args_parser.parse_args()
+    serve(args)
@@ -18,14 +18,19 @@ import argparse
 import math
 import numpy as np
 import torch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from torch.optim import SGD
 from torch.nn.utils import clip_grad_norm_
 from neuronlp2.nn.utils import total_grad_norm
-from neuronlp2.io import get_logger, conllx_data, conllx_stacked_data, iterate_data
+from neuronlp2.io import get_logger, conllx_data, conllx_stacked_data, iterate_data, iterate_sorted_batch, prefetch
+from neuronlp2.io.streaming import shard_paths, count_sentences
+from neuronlp2.io.data_cache import file_hash
+from neuronlp2.io.vocab import vocabulary_words
 from neuronlp2.models import DeepBiAffine, NeuroMST, StackPtrNet, BiRecurrentConvBiAffine
 from neuronlp2.optim import ExponentialScheduler 
 from neuronlp2 import utils
-from neuronlp2.io import CoNLLXWriter
+from neuronlp2.io import CoNLLXWriter, SyntaxFeatureWriter
 from neuronlp2.tasks import parser
 from neuronlp2.nn.utils import freeze_embedding
 from torch.optim.adamw import AdamW
@@ -40,7 +45,7 @@ def get_optimizer(parameters, optim, learning_rate, lr_decay, betas, eps, amsgra
     return optimizer, scheduler
 
 
-def eval(alg, data, network, pred_writer, gold_writer, punct_set, word_alphabet, pos_alphabet, device, beam=1, batch_size=256):
+def eval(alg, data, network, pred_writer, gold_writer, punct_set, word_alphabet, pos_alphabet, device, beam=1, batch_size=256, decoder=None):
     network.eval()
     accum_ucorr = 0.0
     accum_lcorr = 0.0
@@ -65,7 +70,7 @@ def eval(alg, data, network, pred_writer, gold_writer, punct_set, word_alphabet,
         lengths = data['LENGTH'].numpy()
         if alg == 'graph':
             masks = data['MASK'].to(device)
-            heads_pred, types_pred = network.decode(words, chars, postags, mask=masks, leading_symbolic=conllx_data.NUM_SYMBOLIC_TAGS)
+            heads_pred, types_pred = network.decode(words, chars, postags, mask=masks, leading_symbolic=conllx_data.NUM_SYMBOLIC_TAGS, decoder=decoder)
         else:
             masks = data['MASK_ENC'].to(device)
             heads_pred, types_pred = network.decode(words, chars, postags, mask=masks, beam=beam, leading_symbolic=conllx_data.NUM_SYMBOLIC_TAGS)
@@ -110,6 +115,38 @@ def eval(alg, data, network, pred_writer, gold_writer, punct_set, word_alphabet,
            (accum_ucorr_nopunc, accum_lcorr_nopunc, accum_ucomlpete_nopunc, accum_lcomplete_nopunc, accum_total_nopunc), \
            (accum_root_corr, accum_total_root, accum_total_inst)
 
+def extract_features(data, network, feature_writer, device, batch_size=256, max_tokens=None, sort_by_length=True):
+    """
+    Stream the data through the encoder in mini-batches and export the syntax features of every sentence.
+    data is either the output of read_data, or a stream of batches carrying their 'ORIGINAL_WORDS' (see iterate_stream).
+    """
+    network.eval()
+    if isinstance(data, tuple):
+        _, _, original_words = data
+        batches = iterate_sorted_batch(data, batch_size, max_tokens=max_tokens, sort_by_length=sort_by_length)
+    else:
+        original_words = None
+        batches = data
+    num_sents = 0
+    num_tokens = 0
+    with torch.no_grad():
+        for batch in batches:
+            index = batch['INDEX'].tolist()
+            # skip the batches already extracted by a previous run.
+            if all(feature_writer.written(i) for i in index):
+                continue
+            words = batch['WORD'].to(device)
+            chars = batch['CHAR'].to(device)
+            postags = batch['POS'].to(device)
+            masks = batch['MASK'].to(device)
+            batch_words = batch['ORIGINAL_WORDS'] if original_words is None else [original_words[i] for i in index]
+            network._get_rnn_output(words, chars, postags, mask=masks, feature_writer=feature_writer,
+                                    original_words=batch_words, sent_ids=index)
+            num_sents += len(index)
+            num_tokens += (batch['LENGTH'] - 1).sum().item()
+    return num_sents, num_tokens
+
+
 def train(args):
     logger = get_logger("Parsing")
 
@@ -121,6 +158,9 @@ def train(args):
 
     num_epochs = args.num_epochs
     batch_size = args.batch_size
+    max_tokens = args.max_tokens
+    batch_cost = args.batch_cost
+    num_prefetch = args.prefetch
     optim = args.optim
     learning_rate = args.learning_rate
     lr_decay = args.lr_decay
@@ -138,6 +178,8 @@ def train(args):
     model_path = args.model_path
     model_name = os.path.join(model_path, 'model.pt')
     punctuation = args.punctuation
+    cache_dir = args.cache_dir
+    read_workers = args.read_workers
 
     word_embedding = args.word_embedding
     word_path = args.word_path
@@ -146,23 +188,33 @@ def train(args):
     
     load_model = args.load_model
     ckp_path = args.checkpoint_fpath
+
+    # in streaming mode the training data is read from disk every epoch instead of being loaded,
+    # and can be split in several shards (a directory or a comma-separated list of files).
+    stream = args.stream
+    if stream:
+        train_path = shard_paths(train_path)
     
 
     print(args)
 
-    word_dict, word_dim = utils.load_embedding_dict(word_embedding, word_path)
+    alphabet_path = os.path.join(model_path, 'alphabets')
+    # the embedding is only loaded for the words of the data (and of the existing alphabets).
+    embedd_words = vocabulary_words((train_path if stream else [train_path]) + [dev_path, test_path],
+                                    alphabet_directory=alphabet_path, num_workers=read_workers)
+    word_dict, word_dim = utils.load_embedding_dict(word_embedding, word_path, cache_dir=cache_dir, words=embedd_words)
     char_dict = None
     if char_embedding != 'random':
-        char_dict, char_dim = utils.load_embedding_dict(char_embedding, char_path)
+        char_dict, char_dim = utils.load_embedding_dict(char_embedding, char_path, cache_dir=cache_dir)
     else:
         char_dict = None
         char_dim = None
 
     logger.info("Creating Alphabets")
-    alphabet_path = os.path.join(model_path, 'alphabets')
     word_alphabet, char_alphabet, pos_alphabet, type_alphabet = conllx_data.create_alphabets(alphabet_path, train_path,
                                                                                              data_paths=[dev_path, test_path],
-                                                                                             embedd_dict=word_dict, max_vocabulary_size=200000)
+                                                                                             embedd_dict=word_dict, max_vocabulary_size=200000,
+                                                                                             num_workers=read_workers)
 
     num_words = word_alphabet.size()
     num_chars = char_alphabet.size()
@@ -187,16 +239,13 @@ def train(args):
         scale = np.sqrt(3.0 / word_dim)
         table = np.empty([word_alphabet.size(), word_dim], dtype=np.float32)
         table[conllx_data.UNK_ID, :] = np.zeros([1, word_dim]).astype(np.float32) if freeze else np.random.uniform(-scale, scale, [1, word_dim]).astype(np.float32)
-        oov = 0
-        for word, index in word_alphabet.items():
-            if word in word_dict:
-                embedding = word_dict[word]
-            elif word.lower() in word_dict:
-                embedding = word_dict[word.lower()]
-            else:
-                embedding = np.zeros([1, word_dim]).astype(np.float32) if freeze else np.random.uniform(-scale, scale, [1, word_dim]).astype(np.float32)
-                oov += 1
-            table[index, :] = embedding
+        words, indices = zip(*word_alphabet.items())
+        indices = np.array(indices)
+        embeddings, found = utils.lookup_embeddings(word_dict, list(words))
+        oov = int(len(words) - found.sum())
+        table[indices[found], :] = embeddings
+        # the random embeddings are drawn in the order of the words, one row per OOV word.
+        table[indices[~found], :] = np.zeros([oov, word_dim]).astype(np.float32) if freeze else np.random.uniform(-scale, scale, [oov, word_dim]).astype(np.float32)
         print('word OOV: %d' % oov)
         return torch.from_numpy(table)
 
@@ -298,22 +347,35 @@ def train(args):
     logger.info('# of Parameters: %d' % (sum([param.numel() for param in network.parameters()])))
 
     logger.info("Reading Data")
+    # with a token budget, the length buckets are derived from the training data instead of the _buckets table.
+    bucketed = max_tokens is None
     if alg == 'graph':
-        data_train = conllx_data.read_bucketed_data(train_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, symbolic_root=True)
-        data_dev = conllx_data.read_data(dev_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, symbolic_root=True)
-        data_test = conllx_data.read_data(test_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, symbolic_root=True)    
+        data_train = None
+        if not stream:
+            read_train = conllx_data.read_bucketed_data if bucketed else conllx_data.read_data
+            data_train = read_train(train_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, symbolic_root=True,
+                                    ragged=True, cache_dir=cache_dir, num_workers=read_workers)
+        data_dev = conllx_data.read_data(dev_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, symbolic_root=True, ragged=True, cache_dir=cache_dir, num_workers=read_workers)
+        data_test = conllx_data.read_data(test_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, symbolic_root=True, ragged=True, cache_dir=cache_dir, num_workers=read_workers)
         id2word = {v: k for k, v in word_alphabet.instance2index.items()}
         network.id2word = id2word
-        data_train_flat = [item for sublist in data_train[-1] for item in sublist]
+        data_train_flat = [] if stream else [item for sublist in data_train[-1] for item in sublist]
         data_dev_flat = [item for sublist in data_dev[-1] for item in sublist]
         data_test_flat = [item for sublist in data_test[-1] for item in sublist]
         network.original_words = data_train_flat + data_dev_flat + data_test_flat
         
     else:
-        data_train = conllx_stacked_data.read_bucketed_data(train_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, prior_order=prior_order)
-        data_dev = conllx_stacked_data.read_data(dev_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, prior_order=prior_order)
-        data_test = conllx_stacked_data.read_data(test_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, prior_order=prior_order)
-    num_data = sum(data_train[1])
+        data_train = None
+        if not stream:
+            read_train = conllx_stacked_data.read_bucketed_data if bucketed else conllx_stacked_data.read_data
+            data_train = read_train(train_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, prior_order=prior_order,
+                                    ragged=True, cache_dir=cache_dir, num_workers=read_workers)
+        data_dev = conllx_stacked_data.read_data(dev_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, prior_order=prior_order, ragged=True, cache_dir=cache_dir, num_workers=read_workers)
+        data_test = conllx_stacked_data.read_data(test_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, prior_order=prior_order, ragged=True, cache_dir=cache_dir, num_workers=read_workers)
+    if stream:
+        num_data = count_sentences(train_path)
+    else:
+        num_data = sum(data_train[1]) if bucketed else data_train[1]
     logger.info("training: #training data: %d, batch: %d, unk replace: %.2f" % (num_data, batch_size, unk_replace))
 
     pred_writer = CoNLLXWriter(word_alphabet, char_alphabet, pos_alphabet, type_alphabet)
@@ -387,7 +449,15 @@ def train(args):
         if args.cuda:
             torch.cuda.empty_cache()
         gc.collect()
-        for step, data in enumerate(iterate_data(data_train, batch_size, bucketed=True, unk_replace=unk_replace, shuffle=True)):
+        if stream:
+            data_module = conllx_data if alg == 'graph' else conllx_stacked_data
+            options = {'symbolic_root': True} if alg == 'graph' else {'prior_order': prior_order}
+            train_batches = data_module.iterate_stream(train_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, batch_size,
+                                                       shuffle_buffer=args.shuffle_buffer, unk_replace=unk_replace, **options)
+        else:
+            train_batches = iterate_data(data_train, batch_size, bucketed=bucketed, unk_replace=unk_replace, shuffle=True,
+                                         max_tokens=max_tokens, cost=batch_cost)
+        for step, data in enumerate(prefetch(train_batches, device, num_prefetch)):
             optimizer.zero_grad()
             words = data['WORD'].to(device)
             chars = data['CHAR'].to(device)
@@ -471,7 +541,7 @@ def train(args):
             gold_writer.start(gold_filename)
 
             print('Evaluating dev:')
-            dev_stats, dev_stats_nopunct, dev_stats_root = eval(alg, data_dev, network, pred_writer, gold_writer, punct_set, word_alphabet, pos_alphabet, device, beam=beam)
+            dev_stats, dev_stats_nopunct, dev_stats_root = eval(alg, data_dev, network, pred_writer, gold_writer, punct_set, word_alphabet, pos_alphabet, device, beam=beam, decoder=args.decoder)
 
             pred_writer.close()
             gold_writer.close()
@@ -517,7 +587,7 @@ def train(args):
                 gold_writer.start(gold_filename)
 
                 print('Evaluating test:')
-                test_stats, test_stats_nopunct, test_stats_root = eval(alg, data_test, network, pred_writer, gold_writer, punct_set, word_alphabet, pos_alphabet, device, beam=beam)
+                test_stats, test_stats_nopunct, test_stats_root = eval(alg, data_test, network, pred_writer, gold_writer, punct_set, word_alphabet, pos_alphabet, device, beam=beam, decoder=args.decoder)
 
                 test_ucorrect, test_lcorrect, test_ucomlpete, test_lcomplete, test_total = test_stats
                 test_ucorrect_nopunc, test_lcorrect_nopunc, test_ucomlpete_nopunc, test_lcomplete_nopunc, test_total_nopunc = test_stats_nopunct
@@ -573,16 +643,12 @@ def load_ckp(checkpoint_fpath, model, optimizer):
     return model, optimizer, checkpoint['epoch']
 
 
-def parse(args):
-    logger = get_logger("Parsing")
-    args.cuda = torch.cuda.is_available()
-    device = torch.device('cuda', 0) if args.cuda else torch.device('cpu')
-    test_path = args.test
-
-    model_path = args.model_path
+def load_model(model_path, device, logger):
+    """
+    Load the alphabets and the trained network stored in model_path.
+    Returns: network, (word_alphabet, char_alphabet, pos_alphabet, type_alphabet), alg, prior_order
+    """
     model_name = os.path.join(model_path, 'model.pt')
-    punctuation = args.punctuation
-    print(args)
 
     logger.info("Creating Alphabets")
     alphabet_path = os.path.join(model_path, 'alphabets')
@@ -599,19 +665,9 @@ def parse(args):
     logger.info("POS Alphabet Size: %d" % num_pos)
     logger.info("Type Alphabet Size: %d" % num_types)
 
-    result_path = os.path.join(model_path, 'tmp')
-    if not os.path.exists(result_path):
-        os.makedirs(result_path)
-
-    punct_set = None
-    if punctuation is not None:
-        punct_set = set(punctuation)
-        logger.info("punctuations(%d): %s" % (len(punct_set), ' '.join(punct_set)))
-
     logger.info("loading network...")
     hyps = json.load(open(os.path.join(model_path, 'config.json'), 'r'))
     model_type = hyps['model']
-    print(model_type)
     assert model_type in ['DeepBiAffine', 'NeuroMST', 'StackPtr', 'ConvBiAffine']
     word_dim = hyps['word_dim']
     char_dim = hyps['char_dim']
@@ -627,8 +683,6 @@ def parse(args):
     activation = hyps['activation']
     prior_order = None
 
-
-
     alg = 'transition' if model_type == 'StackPtr' else 'graph'
     if model_type == 'DeepBiAffine':
         num_layers = hyps['num_layers']
@@ -668,14 +722,96 @@ def parse(args):
 
     network = network.to(device)
     network.load_state_dict(torch.load(model_name, map_location=device))
+    network.eval()
     model = "{}-{}".format(model_type, mode)
     logger.info("Network: %s, num_layer=%s, hidden=%d, act=%s" % (model, num_layers, hidden_size, activation))
+    return network, (word_alphabet, char_alphabet, pos_alphabet, type_alphabet), alg, prior_order
 
-    logger.info("Reading Data")
-    if alg == 'graph':
-        data_test = conllx_data.read_data(test_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, symbolic_root=True)
+
+class BackgroundFeatureWriter(object):
+    """
+    Hand the writes of a SyntaxFeatureWriter to an executor, so that formatting and disk I/O overlap with the
+    forward pass of the next batch. The executor must be single-threaded to keep the writes of a file in order.
+    """
+    def __init__(self, writer, executor, max_pending=8):
+        self.writer = writer
+        self.executor = executor
+        self.max_pending = max_pending
+        self.pending = []
+
+    def written(self, sent_id):
+        return self.writer.written(sent_id)
+
+    def write(self, *args, **kwargs):
+        # bound the number of batches waiting to be written.
+        while len(self.pending) >= self.max_pending:
+            self.pending.pop(0).result()
+        self.pending.append(self.executor.submit(self.writer.write, *args, **kwargs))
+
+    def close(self):
+        self.pending.append(self.executor.submit(self.writer.close))
+        for future in self.pending:
+            future.result()
+        self.pending = []
+
+    def abort(self):
+        # the queued writes are over (their errors are moot) before the partial output is removed.
+        for future in self.pending:
+            future.exception()
+        self.pending = []
+        self.executor.submit(self.writer.abort).result()
+
+
+def get_feature_dir(test_file):
+    # features of data/file.conll go to data/file/ (data/a.dev.conll to data/a.dev/).
+    directory, filename = os.path.split(os.path.abspath(test_file))
+    return os.path.join(directory, os.path.splitext(filename)[0])
+
+
+def parse(args):
+    logger = get_logger("Parsing")
+    args.cuda = torch.cuda.is_available()
+    device = torch.device('cuda', 0) if args.cuda else torch.device('cpu')
+    test_path = args.test
+    model_path = args.model_path
+    punctuation = args.punctuation
+    cache_dir = args.cache_dir
+    read_workers = args.read_workers
+    print(args)
+
+    # the alphabets and the network are loaded once and shared by all the files.
+    network, alphabets, alg, prior_order = load_model(model_path, device, logger)
+    word_alphabet, char_alphabet, pos_alphabet, type_alphabet = alphabets
+    # a binary feature store only resumes the features of the same input file and model.
+    model_hash = file_hash(os.path.join(model_path, 'model.pt')) if args.feature_format == 'binary' else None
+
+    result_path = os.path.join(model_path, 'tmp')
+    if not os.path.exists(result_path):
+        os.makedirs(result_path)
+
+    punct_set = None
+    if punctuation is not None:
+        punct_set = set(punctuation)
+        logger.info("punctuations(%d): %s" % (len(punct_set), ' '.join(punct_set)))
+
+    if os.path.isdir(test_path):
+        test_files = sorted(os.path.join(test_path, f) for f in os.listdir(test_path) if f.endswith('.conll'))
     else:
-        data_test = conllx_stacked_data.read_data(test_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, prior_order=prior_order)
+        test_files = [test_path]
+    logger.info("Parsing %d file(s)" % len(test_files))
+
+    def read_file(test_file):
+        if args.stream:
+            # batches in file order, read lazily while the features are extracted.
+            data_module = conllx_data if alg == 'graph' else conllx_stacked_data
+            options = {'symbolic_root': True} if alg == 'graph' else {'prior_order': prior_order}
+            return data_module.iterate_stream([test_file], word_alphabet, char_alphabet, pos_alphabet, type_alphabet, args.batch_size,
+                                              bucketed=False, keep_words=True, **options)
+        if alg == 'graph':
+            return conllx_data.read_data(test_file, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, symbolic_root=True, ragged=True, cache_dir=cache_dir, num_workers=read_workers)
+        else:
+            return conllx_stacked_data.read_data(test_file, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, prior_order=prior_order,
+                                                 ragged=True, cache_dir=cache_dir, num_workers=read_workers)
 
     beam = args.beam
     pred_writer = CoNLLXWriter(word_alphabet, char_alphabet, pos_alphabet, type_alphabet)
@@ -684,43 +820,71 @@ def parse(args):
     pred_writer.start(pred_filename)
     gold_filename = os.path.join(result_path, 'gold.txt')
     gold_writer.start(gold_filename)
-    network.eval()
-    
-    directory, filename = test_path.split('/')
-    filename = filename.split('.')[0]
-    output_dir = f'{directory}/{filename}/'
-    if not os.path.exists(output_dir):
-        os.mkdir(output_dir)
-        
-        
-    original_words = []
-    for i in range(len(data_test[-1])):
-        original_words += data_test[-1][i]
-        
-    for i in range(len(data_test) - 2):
-        network._get_rnn_output(output_dir=output_dir,
-                                    input_word=data_test[0]['WORD'],
-                                    input_char=data_test[0]['CHAR'],
-                                    input_pos=data_test[0]['POS'],
-                                    original_words=data_test[-1])
-            # network.forward()
-    # with torch.no_grad():
-    #     print('Parsing...')
-    #     start_time = time.time()
-    #     eval(alg, data_test, network, pred_writer, gold_writer, punct_set, word_alphabet, pos_alphabet, device, beam, batch_size=args.batch_size)
-    #     print('Time: %.2fs' % (time.time() - start_time))
-    
+
+    # files are read ahead by a pool of workers, features are written by a background thread.
+    num_workers = max(args.num_workers, 1)
+    reader = ThreadPoolExecutor(max_workers=num_workers)
+    writer = ThreadPoolExecutor(max_workers=1)
+    pending = deque()
+    next_file = 0
+    total_sents = 0
+    total_tokens = 0
+    num_failed = 0
+    start_time = time.time()
+    for test_file in test_files:
+        while next_file < len(test_files) and len(pending) < num_workers + 1:
+            pending.append(reader.submit(read_file, test_files[next_file]))
+            next_file += 1
+        file_time = time.time()
+        feature_writer = None
+        try:
+            data_test = pending.popleft().result()
+            syntax_writer = SyntaxFeatureWriter(fmt=args.feature_format, dtype=args.feature_dtype)
+            feature_writer = BackgroundFeatureWriter(syntax_writer, writer)
+            source = {'input': file_hash(test_file), 'model': model_hash} if model_hash is not None else None
+            syntax_writer.start(get_feature_dir(test_file), source=source)
+            # the text layout follows the order of the input file, the binary store is indexed by sentence id.
+            num_sents, num_tokens = extract_features(data_test, network, feature_writer, device, batch_size=args.batch_size,
+                                                     max_tokens=args.max_tokens, sort_by_length=args.feature_format == 'binary')
+            feature_writer.close()
+            feature_writer = None
+        except (OSError, ValueError, IndexError, KeyError) as e:
+            # I/O errors and malformed files (bad encoding, missing columns, pos tags or labels unknown to the
+            # alphabets) only skip the file, other errors stop.
+            num_failed += 1
+            logger.error("Failed to parse %s: %s" % (test_file, e))
+            continue
+        finally:
+            if feature_writer is not None:
+                feature_writer.abort()
+        # network.forward()
+        # with torch.no_grad():
+        #     print('Parsing...')
+        #     start_time = time.time()
+        #     eval(alg, data_test, network, pred_writer, gold_writer, punct_set, word_alphabet, pos_alphabet, device, beam, batch_size=args.batch_size, decoder=args.decoder)
+        #     print('Time: %.2fs' % (time.time() - start_time))
+        file_time = max(time.time() - file_time, 1e-6)
+        total_sents += num_sents
+        total_tokens += num_tokens
+        logger.info("%s: %d sentences, %d tokens, time: %.2fs (%.1f sents/s, %.1f tokens/s)" % (
+            test_file, num_sents, num_tokens, file_time, num_sents / file_time, num_tokens / file_time))
+    reader.shutdown()
+    writer.shutdown()
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    logger.info("Total: %d files (%d failed), %d sentences, %d tokens, time: %.2fs (%.1f sents/s, %.1f tokens/s)" % (
+        len(test_files), num_failed, total_sents, total_tokens, elapsed, total_sents / elapsed, total_tokens / elapsed))
+
     pred_writer.close()
     gold_writer.close()
 
 
-
 if __name__ == '__main__':
     args_parser = argparse.ArgumentParser(description='Tuning with graph-based parsing')
     args_parser.add_argument('--mode', choices=['train', 'parse'], required=True, help='processing mode')
     args_parser.add_argument('--config', type=str, help='config file')
     args_parser.add_argument('--num_epochs', type=int, default=200, help='Number of training epochs')
-    args_parser.add_argument('--batch_size', type=int, default=16, help='Number of sentences in each batch')
+    args_parser.add_argument('--batch_size', type=int, default=16, help='Number of sentences in each batch (maximum number with --max_tokens)')
     args_parser.add_argument('--loss_type', choices=['sentence', 'token'], default='sentence', help='loss type (default: sentence)')
     args_parser.add_argument('--optim', choices=['sgd', 'adam'], help='type of optimizer')
     args_parser.add_argument('--learning_rate', type=float, default=0.1, help='Learning rate')
@@ -737,14 +901,25 @@ if __name__ == '__main__':
     args_parser.add_argument('--freeze', action='store_true', help='frozen the word embedding (disable fine-tuning).')
     args_parser.add_argument('--punctuation', nargs='+', type=str, help='List of punctuations')
     args_parser.add_argument('--beam', type=int, default=1, help='Beam size for decoding')
+    args_parser.add_argument('--decoder', choices=['mst', 'eisner'], default=None, help='tree decoder of the graph-based parsers (default: mst, greedy for ConvBiAffine)')
     args_parser.add_argument('--word_embedding', choices=['glove', 'senna', 'sskip', 'polyglot'], help='Embedding for words')
     args_parser.add_argument('--word_path', help='path for word embedding dict')
     args_parser.add_argument('--char_embedding', choices=['random', 'polyglot'], help='Embedding for characters')
     args_parser.add_argument('--char_path', help='path for character embedding dict')
     args_parser.add_argument('--train', help='path for training file.')
     args_parser.add_argument('--dev', help='path for dev file.')
-    args_parser.add_argument('--test', help='path for test file.', required=True)
+    args_parser.add_argument('--test', help='path for test file (or a directory of .conll files in parse mode).', required=True)
     args_parser.add_argument('--model_path', help='path for saving model file.', required=True)
+    args_parser.add_argument('--num_workers', type=int, default=4, help='Number of workers reading the test files ahead (parse mode)')
+    args_parser.add_argument('--max_tokens', type=int, default=None, help='maximum number of (padded) tokens in each batch (train mode: form the batches by this budget instead of a number of sentences)')
+    args_parser.add_argument('--batch_cost', choices=['tokens', 'square'], default='tokens', help='cost of a training batch counted against --max_tokens: padded tokens, or squared padded lengths (the size of the biaffine arc scores)')
+    args_parser.add_argument('--feature_format', choices=['text', 'binary'], default='text', help='output format of the extracted syntax features (parse mode)')
+    args_parser.add_argument('--feature_dtype', choices=['float32', 'float16'], default='float32', help='dtype of the binary feature store (parse mode)')
+    args_parser.add_argument('--cache_dir', default=None, help='directory of the binary cache of the preprocessed data (default: no cache)')
+    args_parser.add_argument('--read_workers', type=int, default=1, help='number of processes tokenizing each data file (default 1: serial)')
+    args_parser.add_argument('--prefetch', type=int, default=0, help='number of training batches assembled ahead by a background thread (default 0: none)')
+    args_parser.add_argument('--stream', action='store_true', help='read the data from disk on the fly instead of loading it (--train can be a directory or a comma-separated list of shards)')
+    args_parser.add_argument('--shuffle_buffer', type=int, default=10000, help='number of sentences in the shuffle buffer of the streamed training data')
     args_parser.add_argument('--load_model', default=False)
     args_parser.add_argument('--checkpoint_fpath')
 
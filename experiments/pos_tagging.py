@@ -19,10 +19,11 @@ import torch
 from torch.optim.adamw import AdamW
 from torch.optim import SGD
 from torch.nn.utils import clip_grad_norm_
-from neuronlp2.io import get_logger, conllx_data, iterate_data, POSWriter
+from neuronlp2.io import get_logger, conllx_data, iterate_data, prefetch, POSWriter
 from neuronlp2.models import BiRecurrentConv, BiVarRecurrentConv, BiRecurrentConvCRF, BiVarRecurrentConvCRF
 from neuronlp2.optim import ExponentialScheduler
 from neuronlp2 import utils
+from neuronlp2.io.vocab import vocabulary_words
 
 
 def get_optimizer(parameters, optim, learning_rate, lr_decay, amsgrad, weight_decay, warmup_steps):
@@ -58,7 +59,9 @@ def main():
     parser = argparse.ArgumentParser(description='NER with bi-directional RNN-CNN')
     parser.add_argument('--config', type=str, help='config file', required=True)
     parser.add_argument('--num_epochs', type=int, default=100, help='Number of training epochs')
-    parser.add_argument('--batch_size', type=int, default=16, help='Number of sentences in each batch')
+    parser.add_argument('--batch_size', type=int, default=16, help='Number of sentences in each batch (maximum number with --max_tokens)')
+    parser.add_argument('--max_tokens', type=int, default=None, help='form the training batches by a budget of (padded) tokens instead of a number of sentences')
+    parser.add_argument('--batch_cost', choices=['tokens', 'square'], default='tokens', help='cost of a batch counted against --max_tokens: padded tokens, or squared padded lengths')
     parser.add_argument('--loss_type', choices=['sentence', 'token'], default='sentence', help='loss type (default: sentence)')
     parser.add_argument('--optim', choices=['sgd', 'adam'], help='type of optimizer', required=True)
     parser.add_argument('--learning_rate', type=float, default=0.1, help='Learning rate')
@@ -74,6 +77,9 @@ def main():
     parser.add_argument('--dev', help='path for dev file.', required=True)
     parser.add_argument('--test', help='path for test file.', required=True)
     parser.add_argument('--model_path', help='path for saving model file.', required=True)
+    parser.add_argument('--cache_dir', default=None, help='directory of the binary cache of the preprocessed data (default: no cache)')
+    parser.add_argument('--read_workers', type=int, default=1, help='number of processes tokenizing each data file (default 1: serial)')
+    parser.add_argument('--prefetch', type=int, default=0, help='number of training batches assembled ahead by a background thread (default 0: none)')
 
     args = parser.parse_args()
 
@@ -87,6 +93,9 @@ def main():
 
     num_epochs = args.num_epochs
     batch_size = args.batch_size
+    max_tokens = args.max_tokens
+    batch_cost = args.batch_cost
+    num_prefetch = args.prefetch
     optim = args.optim
     learning_rate = args.learning_rate
     lr_decay = args.lr_decay
@@ -100,18 +109,24 @@ def main():
 
     model_path = args.model_path
     model_name = os.path.join(model_path, 'model.pt')
+    cache_dir = args.cache_dir
+    read_workers = args.read_workers
     embedding = args.embedding
     embedding_path = args.embedding_dict
 
     print(args)
 
-    embedd_dict, embedd_dim = utils.load_embedding_dict(embedding, embedding_path)
+    alphabet_path = os.path.join(model_path, 'alphabets')
+    # the embedding is only loaded for the words of the data (and of the existing alphabets).
+    embedd_words = vocabulary_words([train_path, dev_path, test_path], alphabet_directory=alphabet_path,
+                                    num_workers=read_workers)
+    embedd_dict, embedd_dim = utils.load_embedding_dict(embedding, embedding_path, cache_dir=cache_dir, words=embedd_words)
 
     logger.info("Creating Alphabets")
-    alphabet_path = os.path.join(model_path, 'alphabets')
     word_alphabet, char_alphabet, pos_alphabet, type_alphabet = conllx_data.create_alphabets(alphabet_path, train_path,
                                                                                              data_paths=[dev_path, test_path],
-                                                                                             embedd_dict=embedd_dict, max_vocabulary_size=50000)
+                                                                                             embedd_dict=embedd_dict, max_vocabulary_size=50000,
+                                                                                             num_workers=read_workers)
 
     logger.info("Word Alphabet Size: %d" % word_alphabet.size())
     logger.info("Character Alphabet Size: %d" % char_alphabet.size())
@@ -119,12 +134,15 @@ def main():
 
     logger.info("Reading Data")
 
-    data_train = conllx_data.read_bucketed_data(train_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet)
-    num_data = sum(data_train[1])
+    # with a token budget, the length buckets are derived from the training data instead of the _buckets table.
+    bucketed = max_tokens is None
+    read_train = conllx_data.read_bucketed_data if bucketed else conllx_data.read_data
+    data_train = read_train(train_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, ragged=True, cache_dir=cache_dir, num_workers=read_workers)
+    num_data = sum(data_train[1]) if bucketed else data_train[1]
     num_labels = pos_alphabet.size()
 
-    data_dev = conllx_data.read_data(dev_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet)
-    data_test = conllx_data.read_data(test_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet)
+    data_dev = conllx_data.read_data(dev_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, ragged=True, cache_dir=cache_dir, num_workers=read_workers)
+    data_test = conllx_data.read_data(test_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, ragged=True, cache_dir=cache_dir, num_workers=read_workers)
 
     writer = POSWriter(word_alphabet, char_alphabet, pos_alphabet)
 
@@ -132,16 +150,13 @@ def main():
         scale = np.sqrt(3.0 / embedd_dim)
         table = np.empty([word_alphabet.size(), embedd_dim], dtype=np.float32)
         table[conllx_data.UNK_ID, :] = np.random.uniform(-scale, scale, [1, embedd_dim]).astype(np.float32)
-        oov = 0
-        for word, index in word_alphabet.items():
-            if word in embedd_dict:
-                embedding = embedd_dict[word]
-            elif word.lower() in embedd_dict:
-                embedding = embedd_dict[word.lower()]
-            else:
-                embedding = np.random.uniform(-scale, scale, [1, embedd_dim]).astype(np.float32)
-                oov += 1
-            table[index, :] = embedding
+        words, indices = zip(*word_alphabet.items())
+        indices = np.array(indices)
+        embeddings, found = utils.lookup_embeddings(embedd_dict, list(words))
+        oov = int(len(words) - found.sum())
+        table[indices[found], :] = embeddings
+        # the random embeddings are drawn in the order of the words, one row per OOV word.
+        table[indices[~found], :] = np.random.uniform(-scale, scale, [oov, embedd_dim]).astype(np.float32)
         print('oov: %d' % oov)
         return torch.from_numpy(table)
 
@@ -154,6 +169,7 @@ def main():
     dropout = hyps['dropout']
     crf = hyps['crf']
     bigram = hyps['bigram']
+    crf_algorithm = hyps.get('crf_algorithm', 'sequential')
     assert embedd_dim == hyps['embedd_dim']
     char_dim = hyps['char_dim']
     mode = hyps['rnn_mode']
@@ -168,14 +184,16 @@ def main():
     if dropout == 'std':
         if crf:
             network = BiRecurrentConvCRF(embedd_dim, word_alphabet.size(), char_dim, char_alphabet.size(), mode, hidden_size, out_features, num_layers,
-                                         num_labels, embedd_word=word_table, p_in=p_in, p_out=p_out, p_rnn=p_rnn, bigram=bigram, activation=activation)
+                                         num_labels, embedd_word=word_table, p_in=p_in, p_out=p_out, p_rnn=p_rnn, bigram=bigram, activation=activation,
+                                         crf_algorithm=crf_algorithm)
         else:
             network = BiRecurrentConv(embedd_dim, word_alphabet.size(), char_dim, char_alphabet.size(), mode, hidden_size, out_features, num_layers,
                                       num_labels, embedd_word=word_table, p_in=p_in, p_out=p_out, p_rnn=p_rnn, activation=activation)
     elif dropout == 'variational':
         if crf:
             network = BiVarRecurrentConvCRF(embedd_dim, word_alphabet.size(), char_dim, char_alphabet.size(), mode, hidden_size, out_features, num_layers,
-                                            num_labels, embedd_word=word_table, p_in=p_in, p_out=p_out, p_rnn=p_rnn, bigram=bigram, activation=activation)
+                                            num_labels, embedd_word=word_table, p_in=p_in, p_out=p_out, p_rnn=p_rnn, bigram=bigram, activation=activation,
+                                            crf_algorithm=crf_algorithm)
         else:
             network = BiVarRecurrentConv(embedd_dim, word_alphabet.size(), char_dim, char_alphabet.size(), mode, hidden_size, out_features, num_layers,
                                          num_labels, embedd_word=word_table, p_in=p_in, p_out=p_out, p_rnn=p_rnn, activation=activation)
@@ -213,7 +231,9 @@ def main():
         if args.cuda:
             torch.cuda.empty_cache()
         gc.collect()
-        for step, data in enumerate(iterate_data(data_train, batch_size, bucketed=True, unk_replace=unk_replace, shuffle=True)):
+        train_batches = iterate_data(data_train, batch_size, bucketed=bucketed, unk_replace=unk_replace, shuffle=True,
+                                     max_tokens=max_tokens, cost=batch_cost)
+        for step, data in enumerate(prefetch(train_batches, device, num_prefetch)):
             optimizer.zero_grad()
             words = data['WORD'].to(device)
             chars = data['CHAR'].to(device)
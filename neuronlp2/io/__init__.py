@@ -3,6 +3,9 @@ __author__ = 'max'
 from neuronlp2.io.alphabet import Alphabet
 from neuronlp2.io.instance import *
 from neuronlp2.io.logger import get_logger
-from neuronlp2.io.writer import CoNLL03Writer, CoNLLXWriter, POSWriter
-from neuronlp2.io.utils import get_batch, get_bucketed_batch, iterate_data
+from neuronlp2.io.writer import CoNLL03Writer, CoNLLXWriter, POSWriter, SyntaxFeatureWriter
+from neuronlp2.io.feature_store import FeatureStore, FeatureStoreWriter
+from neuronlp2.io.embedding import EmbeddingDict
+from neuronlp2.io.utils import get_batch, get_bucketed_batch, iterate_data, iterate_sorted_batch, iterate_token_batch, length_buckets
+from neuronlp2.io.prefetch import prefetch
 from neuronlp2.io import conllx_data, conll03_data, conllx_stacked_data
@@ -5,14 +5,137 @@ Alphabet maps objects to integer ids. It provides two way mapping from the index
 """
 import json
 import os
+import mmap
+import zlib
+import numpy as np
 from neuronlp2.io.logger import get_logger
+from neuronlp2.io.data_cache import _write
+
+BINARY_MAGIC = b'NLP2ALPH'
+BINARY_VERSION = 1
+
+
+def _save_binary(path, instances, singletons):
+    """
+    Write the instances in the binary format: a json header, then the utf-8 text of the instances separated by
+    newlines, the start of every instance in the text (int64), a hash index (the instances sorted by crc32 slot,
+    and the start of every slot) and the sorted singletons (int32).
+    Returns False (and writes nothing) if the instances are not all strings without newline.
+    """
+    if not all(isinstance(instance, str) for instance in instances):
+        return False
+    keys = [instance.encode('utf-8') for instance in instances]
+    text = b'\n'.join(keys)
+    if text.count(b'\n') != max(len(keys) - 1, 0):
+        return False
+
+    lengths = np.fromiter(map(len, keys), dtype=np.int64, count=len(keys))
+    starts = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(lengths + 1, out=starts[1:])
+    num_slots = 1 << max(len(keys) - 1, 0).bit_length()
+    slots = np.fromiter((zlib.crc32(key) for key in keys), dtype=np.int64, count=len(keys)) & (num_slots - 1)
+    order = np.argsort(slots, kind='stable')
+    slot_starts = np.searchsorted(slots[order], np.arange(num_slots + 1))
+    header = {'version': BINARY_VERSION, 'size': len(keys), 'text': len(text), 'slots': num_slots,
+              'singletons': None if singletons is None else len(singletons)}
+    sections = [text, starts, order.astype(np.int32), slot_starts.astype(np.int32)]
+    if singletons is not None:
+        sections.append(np.array(sorted(singletons), dtype=np.int32))
+
+    header = json.dumps(header).encode('utf-8')
+
+    def save(file):
+        file.write(BINARY_MAGIC + np.int64(len(header)).tobytes() + header)
+        for section in sections:
+            file.write(b'\0' * (-file.tell() % 8))
+            file.write(section if isinstance(section, bytes) else section.tobytes())
+
+    # written to a temporary file first: the file may be memory-mapped by a loaded alphabet.
+    _write(os.path.dirname(path), path, save)
+    return True
+
+
+class _MappedInstances(object):
+    """
+    The instances of a binary alphabet file, memory-mapped. Instances are looked up with the hash index of the
+    file, so that neither the instance list nor the instance --> index map has to be built.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.__map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.__map[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+            raise ValueError('%s is not a binary alphabet file.' % path)
+        position = len(BINARY_MAGIC) + 8
+        header_length = int(np.frombuffer(self.__map, dtype=np.int64, count=1, offset=len(BINARY_MAGIC))[0])
+        header = json.loads(self.__map[position:position + header_length].decode('utf-8'))
+        if header['version'] != BINARY_VERSION:
+            raise ValueError('unsupported alphabet format version %d in %s' % (header['version'], path))
+        position += header_length
+        self.size = header['size']
+        self.num_slots = header['slots']
+        self.num_singletons = header['singletons']
+
+        buffer = memoryview(self.__map)
+
+        def section(length, fmt):
+            nonlocal position
+            position += -position % 8
+            itemsize = {'B': 1, 'i': 4, 'q': 8}[fmt]
+            view = buffer[position:position + length * itemsize]
+            position += length * itemsize
+            return view.cast(fmt)
+
+        self.text = section(header['text'], 'B')
+        self.starts = section(self.size + 1, 'q')
+        self.order = section(self.size, 'i')
+        self.slot_starts = section(self.num_slots + 1, 'i')
+        self.singleton_ids = section(self.num_singletons, 'i') if self.num_singletons is not None else None
+
+    def __getstate__(self):
+        # the memory map itself cannot be pickled, it is re-opened from the file.
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    def find(self, instance):
+        """
+        Position of the instance in the instance list, None if it is missing.
+        """
+        if not isinstance(instance, str) or self.size == 0:
+            return None
+        key = instance.encode('utf-8')
+        slot = zlib.crc32(key) & (self.num_slots - 1)
+        starts = self.starts
+        for k in range(self.slot_starts[slot], self.slot_starts[slot + 1]):
+            i = self.order[k]
+            if self.text[starts[i]:starts[i + 1] - 1] == key:
+                return i
+        return None
+
+    def get(self, i):
+        if i < 0 or i >= self.size:
+            raise IndexError(i)
+        return str(self.text[self.starts[i]:self.starts[i + 1] - 1], 'utf-8')
+
+    def instances(self):
+        return str(self.text, 'utf-8').split('\n') if self.size > 0 else []
+
+    def singletons(self):
+        return None if self.singleton_ids is None else set(self.singleton_ids.tolist())
+
 
 class Alphabet(object):
     def __init__(self, name, defualt_value=False, keep_growing=True, singleton=False):
         self.__name = name
 
-        self.instance2index = {}
-        self.instances = []
+        self.__instance2index = {}
+        self.__instances = []
+        # the memory-mapped binary file the alphabet was loaded from, the instance list and the instance --> index
+        # map are only built from it when they are needed.
+        self.__mapped = None
+        self.__mapped_lookups = 0
         self.default_value = defualt_value
         self.offset = 1 if self.default_value else 0
         self.keep_growing = keep_growing
@@ -23,10 +146,29 @@ class Alphabet(object):
 
         self.next_index = self.offset
 
+        # a frozen alphabet never changes and keeps an array of its instances for the bulk decoding.
+        self.frozen = False
+        self.__instance_array = None
+        self.__singleton_mask = None
+
         self.logger = get_logger('Alphabet')
 
+    @property
+    def instances(self):
+        if self.__instances is None:
+            self.__instances = self.__mapped.instances()
+        return self.__instances
+
+    @property
+    def instance2index(self):
+        if self.__instance2index is None:
+            self.__instance2index = {instance: index for index, instance in enumerate(self.instances, self.offset)}
+        return self.__instance2index
+
     def add(self, instance):
         if instance not in self.instance2index:
+            if self.frozen:
+                raise RuntimeError('Alphabet %s is frozen.' % self.__name)
             self.instances.append(instance)
             self.instance2index[instance] = self.next_index
             self.next_index += 1
@@ -36,12 +178,14 @@ class Alphabet(object):
             raise RuntimeError('Alphabet %s does not have singleton.' % self.__name)
         else:
             self.singletons.add(id)
+            self.__singleton_mask = None
 
     def add_singletons(self, ids):
         if self.singletons is None:
             raise RuntimeError('Alphabet %s does not have singleton.' % self.__name)
         else:
             self.singletons.update(ids)
+            self.__singleton_mask = None
 
     def is_singleton(self, id):
         if self.singletons is None:
@@ -50,18 +194,26 @@ class Alphabet(object):
             return id in self.singletons
 
     def get_index(self, instance):
-        try:
-            return self.instance2index[instance]
-        except KeyError:
-            if self.keep_growing:
-                index = self.next_index
-                self.add(instance)
+        if self.__instance2index is None and self.__mapped_lookups < self.size():
+            # looked up in the file until there were as many lookups as instances, building the map is cheaper then.
+            self.__mapped_lookups += 1
+            index = self.__mapped.find(instance)
+            if index is not None:
+                return index + self.offset
+        else:
+            index = self.instance2index.get(instance)
+            if index is not None:
                 return index
+
+        if self.keep_growing:
+            index = self.next_index
+            self.add(instance)
+            return index
+        else:
+            if self.default_value:
+                return self.default_index
             else:
-                if self.default_value:
-                    return self.default_index
-                else:
-                    raise KeyError("instance not found: %s" % instance)
+                raise KeyError("instance not found: %s" % instance)
 
     def get_instance(self, index):
         if self.default_value and index == self.default_index:
@@ -69,12 +221,72 @@ class Alphabet(object):
             return '<_UNK>'
         else:
             try:
+                if self.__instances is None:
+                    return self.__mapped.get(index - self.offset)
                 return self.instances[index - self.offset]
             except IndexError:
                 raise IndexError('unknown index: %d' % index)
 
+    def get_indices(self, instances):
+        """
+        Indices of a sequence of instances, as a list (the readers map whole sentences with one call).
+        """
+        if self.keep_growing:
+            return [self.get_index(instance) for instance in instances]
+
+        get = self.instance2index.get
+        if self.default_value:
+            default_index = self.default_index
+            return [get(instance, default_index) for instance in instances]
+        indices = [get(instance) for instance in instances]
+        if None in indices:
+            raise KeyError("instance not found: %s" % instances[indices.index(None)])
+        return indices
+
+    def encode_many(self, instances):
+        """
+        Indices of a sequence of instances, as an int64 array.
+        """
+        return np.array(self.get_indices(instances), dtype=np.int64).reshape(-1)
+
+    def decode_many(self, indices):
+        """
+        Instances of an array (or tensor) of indices, as an object array of the same shape.
+        """
+        indices = np.asarray(indices)
+        if not self.frozen:
+            instances = [self.get_instance(index) for index in indices.reshape(-1).tolist()]
+            return np.array(instances + [None], dtype=object)[:-1].reshape(indices.shape)
+        if self.__instance_array is None:
+            instances = (['<_UNK>'] if self.default_value else []) + self.instances
+            # built element-wise, so that tuple or list instances are kept as objects.
+            self.__instance_array = np.empty(len(instances), dtype=object)
+            self.__instance_array[:] = instances
+        try:
+            return self.__instance_array[indices]
+        except IndexError:
+            raise IndexError('unknown index: %d' % indices.max())
+
+    @property
+    def singleton_mask(self):
+        """
+        Boolean array telling for every index whether it is a singleton.
+        """
+        if self.singletons is None:
+            raise RuntimeError('Alphabet %s does not have singleton.' % self.__name)
+        if self.__singleton_mask is None or len(self.__singleton_mask) != self.size():
+            mask = np.zeros(self.size(), dtype=bool)
+            mask[np.fromiter(self.singletons, dtype=np.int64, count=len(self.singletons))] = True
+            self.__singleton_mask = mask
+        return self.__singleton_mask
+
+    def is_singleton_many(self, ids):
+        return self.singleton_mask[np.asarray(ids, dtype=np.int64)]
+
     def size(self):
-        return len(self.instances) + self.offset
+        if self.__instances is None:
+            return self.__mapped.size + self.offset
+        return len(self.__instances) + self.offset
 
     def singleton_size(self):
         return len(self.singletons)
@@ -92,27 +304,44 @@ class Alphabet(object):
 
     def open(self):
         self.keep_growing = True
+        self.frozen = False
+        self.__instance_array = None
 
-    def get_content(self):
-        if self.singletons is None:
-            return {'instance2index': self.instance2index, 'instances': self.instances}
-        else:
-            return {'instance2index': self.instance2index, 'instances': self.instances,
-                    'singletions': list(self.singletons)}
+    def freeze(self):
+        """
+        Close the alphabet for good, decode_many then uses an array of the instances (built on first use).
+        """
+        self.close()
+        self.frozen = True
+        self.__instance_array = None
+
+    def get_content(self, compact=False):
+        # the compact content leaves out instance2index, which is rebuilt from the instances when loading.
+        content = {'instances': self.instances} if compact else {'instance2index': self.instance2index, 'instances': self.instances}
+        if self.singletons is not None:
+            content['singletions'] = sorted(self.singletons) if compact else list(self.singletons)
+        return content
 
     def __from_json(self, data):
-        self.instances = data["instances"]
-        self.instance2index = data["instance2index"]
+        self.__mapped = None
+        self.__instances = data["instances"]
+        # rebuilt from the instances when missing (compact files).
+        self.__instance2index = data.get("instance2index")
         if 'singletions' in data:
             self.singletons = set(data['singletions'])
         else:
             self.singletons = None
+        self.__singleton_mask = None
 
-    def save(self, output_directory, name=None):
+    def save(self, output_directory, name=None, compact=True, binary=True):
         """
         Save both alhpabet records to the given directory.
         :param output_directory: Directory to save model and weights.
         :param name: The alphabet saving name, optional.
+        :param compact: Save the instances only, without indentation (faster to load), instead of the indented
+                        instances and instance2index.
+        :param binary: Save in the memory-mapped binary format (<name>.bin) rather than json. Alphabets whose
+                       instances are not all strings without newline are saved as json anyway.
         :return:
         """
         saving_name = name if name else self.__name
@@ -120,8 +349,20 @@ class Alphabet(object):
             if not os.path.exists(output_directory):
                 os.makedirs(output_directory)
 
-            json.dump(self.get_content(),
-                      open(os.path.join(output_directory, saving_name + ".json"), 'w'), indent=4)
+            json_path = os.path.join(output_directory, saving_name + ".json")
+            binary_path = os.path.join(output_directory, saving_name + ".bin")
+            if binary and _save_binary(binary_path, self.instances, self.singletons):
+                stale_path = json_path
+            else:
+                with open(json_path, 'w') as file:
+                    if compact:
+                        json.dump(self.get_content(compact=True), file, separators=(',', ':'))
+                    else:
+                        json.dump(self.get_content(), file, indent=4)
+                stale_path = binary_path
+            # load() prefers the binary file, the other format must not shadow the saved one.
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
         except Exception as e:
             self.logger.warn("Alphabet is not saved: %s" % repr(e))
 
@@ -133,6 +374,18 @@ class Alphabet(object):
         :return:
         """
         loading_name = name if name else self.__name
-        self.__from_json(json.load(open(os.path.join(input_directory, loading_name + ".json"))))
-        self.next_index = len(self.instances) + self.offset
+        binary_path = os.path.join(input_directory, loading_name + ".bin")
+        if os.path.exists(binary_path):
+            self.__mapped = _MappedInstances(binary_path)
+            self.__mapped_lookups = 0
+            self.__instances = None
+            self.__instance2index = None
+            self.singletons = self.__mapped.singletons()
+            self.__singleton_mask = None
+        else:
+            with open(os.path.join(input_directory, loading_name + ".json")) as file:
+                self.__from_json(json.load(file))
+        self.next_index = self.size()
         self.keep_growing = False
+        if self.frozen:
+            self.freeze()
@@ -1,13 +1,18 @@
 __author__ = 'max'
 
 import os.path
-import numpy as np
-from collections import defaultdict, OrderedDict
-import torch
+import time
+from functools import reduce
 
 from neuronlp2.io.reader import CoNLLXReader
 from neuronlp2.io.alphabet import Alphabet
 from neuronlp2.io.logger import get_logger
+from neuronlp2.io.data_cache import load_or_build
+from neuronlp2.io.ragged import pack_data
+from neuronlp2.io.streaming import stream_batches
+from neuronlp2.io.parallel import read_parallel
+from neuronlp2.io.utils import _collate
+from neuronlp2.io.vocab import count_vocabulary, merge_counts, embedding_vocabulary
 from neuronlp2.io.common import DIGIT_RE, MAX_CHAR_LENGTH, UNK_ID
 from neuronlp2.io.common import PAD_CHAR, PAD, PAD_POS, PAD_TYPE, PAD_ID_CHAR, PAD_ID_TAG, PAD_ID_WORD
 from neuronlp2.io.common import ROOT, END, ROOT_CHAR, ROOT_POS, ROOT_TYPE, END_CHAR, END_POS, END_TYPE
@@ -19,33 +24,13 @@ NUM_SYMBOLIC_TAGS = 3
 _buckets = [10, 15, 20, 25, 30, 35, 40, 50, 60, 70, 140]
 
 
-def create_alphabets(alphabet_directory, train_path, data_paths=None, max_vocabulary_size=100000, embedd_dict=None,
-                     min_occurrence=1, normalize_digits=True):
-
-    def expand_vocab():
-        vocab_set = set(vocab_list)
-        for data_path in data_paths:
-            # logger.info("Processing data: %s" % data_path)
-            with open(data_path, 'r') as file:
-                for line in file:
-                    line = line.strip()
-                    if len(line) == 0:
-                        continue
-
-                    tokens = line.split('\t')
-                    for char in tokens[1]:
-                        char_alphabet.add(char)
+def _instance_row(inst):
+    sent = inst.sentence
+    return [sent.word_ids, sent.char_id_seqs, inst.pos_ids, inst.heads, inst.type_ids]
 
-                    word = DIGIT_RE.sub("0", tokens[1]) if normalize_digits else tokens[1]
-                    pos = tokens[4]
-                    type = tokens[7]
 
-                    pos_alphabet.add(pos)
-                    type_alphabet.add(type)
-
-                    if word not in vocab_set and (word in embedd_dict or word.lower() in embedd_dict):
-                        vocab_set.add(word)
-                        vocab_list.append(word)
+def create_alphabets(alphabet_directory, train_path, data_paths=None, max_vocabulary_size=100000, embedd_dict=None,
+                     min_occurrence=1, normalize_digits=True, num_workers=1):
 
     logger = get_logger("Create Alphabets")
     word_alphabet = Alphabet('word', defualt_value=True, singleton=True)
@@ -67,35 +52,38 @@ def create_alphabets(alphabet_directory, train_path, data_paths=None, max_vocabu
         pos_alphabet.add(END_POS)
         type_alphabet.add(END_TYPE)
 
-        vocab = defaultdict(int)
-        with open(train_path, 'r') as file:
-            for line in file:
-                line = line.strip()
-                if len(line) == 0:
-                    continue
-
-                tokens = line.split('\t')
-                for char in tokens[1]:
-                    char_alphabet.add(char)
-
-                word = DIGIT_RE.sub("0", tokens[1]) if normalize_digits else tokens[1]
-                vocab[word] += 1
-
-                pos = tokens[4]
-                pos_alphabet.add(pos)
-
-                type = tokens[7]
-                type_alphabet.add(type)
+        # the training data can be given as a list of shards.
+        train_paths = [train_path] if isinstance(train_path, str) else list(train_path)
+        # the other data only adds the words of the pretrained embedding.
+        expand = data_paths is not None and embedd_dict is not None
+        start_time = time.time()
+        counts = count_vocabulary(train_paths + (list(data_paths) if expand else []), (4, 7),
+                                  normalize_digits=normalize_digits, num_workers=num_workers)
+        vocab, chars, (postags, types) = reduce(merge_counts, counts[:len(train_paths)], ({}, {}, [{}, {}]))
+        expand_words, expand_chars, (expand_postags, expand_types) = reduce(merge_counts, counts[len(train_paths):],
+                                                                            ({}, {}, [{}, {}]))
+        count_time = time.time() - start_time
 
         # collect singletons
         singletons = set([word for word, count in vocab.items() if count <= min_occurrence])
 
         # if a singleton is in pretrained embedding dict, set the count to min_occur + c
+        start_time = time.time()
+        embedd_words = set()
         if embedd_dict is not None:
-            assert isinstance(embedd_dict, OrderedDict)
+            embedd_words = embedding_vocabulary(set(vocab).union(expand_words), embedd_dict)
             for word in vocab.keys():
-                if word in embedd_dict or word.lower() in embedd_dict:
+                if word in embedd_words:
                     vocab[word] += min_occurrence
+        embedding_time = time.time() - start_time
+
+        start_time = time.time()
+        for char in chars:
+            char_alphabet.add(char)
+        for pos in postags:
+            pos_alphabet.add(pos)
+        for type in types:
+            type_alphabet.add(type)
 
         vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
         logger.info("Total Vocabulary Size: %d" % len(vocab_list))
@@ -106,28 +94,40 @@ def create_alphabets(alphabet_directory, train_path, data_paths=None, max_vocabu
         if len(vocab_list) > max_vocabulary_size:
             vocab_list = vocab_list[:max_vocabulary_size]
 
-        if data_paths is not None and embedd_dict is not None:
-            expand_vocab()
+        if expand:
+            # the characters and tags of the other data come after those of the training data.
+            for char in expand_chars:
+                char_alphabet.add(char)
+            for pos in expand_postags:
+                pos_alphabet.add(pos)
+            for type in expand_types:
+                type_alphabet.add(type)
+            vocab_set = set(vocab_list)
+            vocab_list.extend(word for word in expand_words if word not in vocab_set and word in embedd_words)
 
         for word in vocab_list:
             word_alphabet.add(word)
             if word in singletons:
                 word_alphabet.add_singleton(word_alphabet.get_index(word))
+        build_time = time.time() - start_time
 
+        start_time = time.time()
         word_alphabet.save(alphabet_directory)
         char_alphabet.save(alphabet_directory)
         pos_alphabet.save(alphabet_directory)
         type_alphabet.save(alphabet_directory)
+        logger.info("Time: counting %.2fs, embedding filtering %.2fs, building %.2fs, saving %.2fs"
+                    % (count_time, embedding_time, build_time, time.time() - start_time))
     else:
         word_alphabet.load(alphabet_directory)
         char_alphabet.load(alphabet_directory)
         pos_alphabet.load(alphabet_directory)
         type_alphabet.load(alphabet_directory)
 
-    word_alphabet.close()
-    char_alphabet.close()
-    pos_alphabet.close()
-    type_alphabet.close()
+    word_alphabet.freeze()
+    char_alphabet.freeze()
+    pos_alphabet.freeze()
+    type_alphabet.freeze()
     logger.info("Word Alphabet Size (Singleton): %d (%d)" % (word_alphabet.size(), word_alphabet.singleton_size()))
     logger.info("Character Alphabet Size: %d" % char_alphabet.size())
     logger.info("POS Alphabet Size: %d" % pos_alphabet.size())
@@ -136,7 +136,18 @@ def create_alphabets(alphabet_directory, train_path, data_paths=None, max_vocabu
 
 
 def read_data(source_path: str, word_alphabet: Alphabet, char_alphabet: Alphabet, pos_alphabet: Alphabet, type_alphabet: Alphabet,
-              max_size=None, normalize_digits=True, symbolic_root=False, symbolic_end=False):
+              max_size=None, normalize_digits=True, symbolic_root=False, symbolic_end=False, ragged=False, cache_dir=None, num_workers=1):
+    if cache_dir is not None:
+        options = {'max_size': max_size, 'normalize_digits': normalize_digits, 'symbolic_root': symbolic_root, 'symbolic_end': symbolic_end,
+                   'ragged': ragged}
+        return load_or_build(cache_dir, 'conllx', source_path, [word_alphabet, char_alphabet, pos_alphabet, type_alphabet], options,
+                             lambda: read_data(source_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, num_workers=num_workers, **options))
+
+    if num_workers > 1:
+        return read_parallel(CoNLLXReader, source_path, [word_alphabet, char_alphabet, pos_alphabet, type_alphabet], _instance_row,
+                             ['WORD', 'CHAR', 'POS', 'HEAD', 'TYPE'], [PAD_ID_WORD, PAD_ID_CHAR, PAD_ID_TAG, PAD_ID_TAG, PAD_ID_TAG], num_workers, max_size=max_size,
+                             ragged=ragged, normalize_digits=normalize_digits, symbolic_root=symbolic_root, symbolic_end=symbolic_end)
+
     original_words = []
     data = []
     max_length = 0
@@ -164,58 +175,28 @@ def read_data(source_path: str, word_alphabet: Alphabet, char_alphabet: Alphabet
 
     data_size = len(data)
     char_length = min(MAX_CHAR_LENGTH, max_char_length)
-    wid_inputs = np.empty([data_size, max_length], dtype=np.int64)
-    cid_inputs = np.empty([data_size, max_length, char_length], dtype=np.int64)
-    pid_inputs = np.empty([data_size, max_length], dtype=np.int64)
-    hid_inputs = np.empty([data_size, max_length], dtype=np.int64)
-    tid_inputs = np.empty([data_size, max_length], dtype=np.int64)
-
-    masks = np.zeros([data_size, max_length], dtype=np.float32)
-    single = np.zeros([data_size, max_length], dtype=np.int64)
-    lengths = np.empty(data_size, dtype=np.int64)
-
-    for i, inst in enumerate(data):
-        wids, cid_seqs, pids, hids, tids = inst
-        inst_size = len(wids)
-        lengths[i] = inst_size
-        # word ids
-        wid_inputs[i, :inst_size] = wids
-        wid_inputs[i, inst_size:] = PAD_ID_WORD
-        for c, cids in enumerate(cid_seqs):
-            cid_inputs[i, c, :len(cids)] = cids
-            cid_inputs[i, c, len(cids):] = PAD_ID_CHAR
-        cid_inputs[i, inst_size:, :] = PAD_ID_CHAR
-        # pos ids
-        pid_inputs[i, :inst_size] = pids
-        pid_inputs[i, inst_size:] = PAD_ID_TAG
-        # type ids
-        tid_inputs[i, :inst_size] = tids
-        tid_inputs[i, inst_size:] = PAD_ID_TAG
-        # heads
-        hid_inputs[i, :inst_size] = hids
-        hid_inputs[i, inst_size:] = PAD_ID_TAG
-        # masks
-        masks[i, :inst_size] = 1.0
-        for j, wid in enumerate(wids):
-            if word_alphabet.is_singleton(wid):
-                single[i, j] = 1
-
-    words = torch.from_numpy(wid_inputs)
-    chars = torch.from_numpy(cid_inputs)
-    pos = torch.from_numpy(pid_inputs)
-    heads = torch.from_numpy(hid_inputs)
-    types = torch.from_numpy(tid_inputs)
-    masks = torch.from_numpy(masks)
-    single = torch.from_numpy(single)
-    lengths = torch.from_numpy(lengths)
-
-    data_tensor = {'WORD': words, 'CHAR': chars, 'POS': pos, 'HEAD': heads, 'TYPE': types,
-                   'MASK': masks, 'SINGLE': single, 'LENGTH': lengths}
+    data_tensor = pack_data(data, ['WORD', 'CHAR', 'POS', 'HEAD', 'TYPE'], [PAD_ID_WORD, PAD_ID_CHAR, PAD_ID_TAG, PAD_ID_TAG, PAD_ID_TAG],
+                            char_length, word_alphabet.is_singleton_many)
+    if not ragged:
+        # the flat id arrays are scattered into the padded [data_size, max_length(, char_length)] tensors at once.
+        data_tensor = _collate(data_tensor, slice(None), max_length, exclude_keys=())
     return data_tensor, data_size, original_words
 
 
 def read_bucketed_data(source_path: str, word_alphabet: Alphabet, char_alphabet: Alphabet, pos_alphabet: Alphabet, type_alphabet: Alphabet,
-                       max_size=None, normalize_digits=True, symbolic_root=False, symbolic_end=False):
+                       max_size=None, normalize_digits=True, symbolic_root=False, symbolic_end=False, ragged=False, cache_dir=None, num_workers=1):
+    if cache_dir is not None:
+        options = {'max_size': max_size, 'normalize_digits': normalize_digits, 'symbolic_root': symbolic_root, 'symbolic_end': symbolic_end,
+                   'ragged': ragged}
+        return load_or_build(cache_dir, 'conllx.bucketed', source_path, [word_alphabet, char_alphabet, pos_alphabet, type_alphabet],
+                             dict(options, buckets=_buckets),
+                             lambda: read_bucketed_data(source_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, num_workers=num_workers, **options))
+
+    if num_workers > 1:
+        return read_parallel(CoNLLXReader, source_path, [word_alphabet, char_alphabet, pos_alphabet, type_alphabet], _instance_row,
+                             ['WORD', 'CHAR', 'POS', 'HEAD', 'TYPE'], [PAD_ID_WORD, PAD_ID_CHAR, PAD_ID_TAG, PAD_ID_TAG, PAD_ID_TAG], num_workers, max_size=max_size, buckets=_buckets,
+                             ragged=ragged, normalize_digits=normalize_digits, symbolic_root=symbolic_root, symbolic_end=symbolic_end)
+
     original_words = []
     data = [[] for _ in _buckets]
     max_char_length = [0 for _ in _buckets]
@@ -253,52 +234,31 @@ def read_bucketed_data(source_path: str, word_alphabet: Alphabet, char_alphabet:
 
         bucket_length = _buckets[bucket_id]
         char_length = min(MAX_CHAR_LENGTH, max_char_length[bucket_id])
-        wid_inputs = np.empty([bucket_size, bucket_length], dtype=np.int64)
-        cid_inputs = np.empty([bucket_size, bucket_length, char_length], dtype=np.int64)
-        pid_inputs = np.empty([bucket_size, bucket_length], dtype=np.int64)
-        hid_inputs = np.empty([bucket_size, bucket_length], dtype=np.int64)
-        tid_inputs = np.empty([bucket_size, bucket_length], dtype=np.int64)
-
-        masks = np.zeros([bucket_size, bucket_length], dtype=np.float32)
-        single = np.zeros([bucket_size, bucket_length], dtype=np.int64)
-        lengths = np.empty(bucket_size, dtype=np.int64)
-
-        for i, inst in enumerate(data[bucket_id]):
-            wids, cid_seqs, pids, hids, tids = inst
-            inst_size = len(wids)
-            lengths[i] = inst_size
-            # word ids
-            wid_inputs[i, :inst_size] = wids
-            wid_inputs[i, inst_size:] = PAD_ID_WORD
-            for c, cids in enumerate(cid_seqs):
-                cid_inputs[i, c, :len(cids)] = cids
-                cid_inputs[i, c, len(cids):] = PAD_ID_CHAR
-            cid_inputs[i, inst_size:, :] = PAD_ID_CHAR
-            # pos ids
-            pid_inputs[i, :inst_size] = pids
-            pid_inputs[i, inst_size:] = PAD_ID_TAG
-            # type ids
-            tid_inputs[i, :inst_size] = tids
-            tid_inputs[i, inst_size:] = PAD_ID_TAG
-            # heads
-            hid_inputs[i, :inst_size] = hids
-            hid_inputs[i, inst_size:] = PAD_ID_TAG
-            # masks
-            masks[i, :inst_size] = 1.0
-            for j, wid in enumerate(wids):
-                if word_alphabet.is_singleton(wid):
-                    single[i, j] = 1
-
-        words = torch.from_numpy(wid_inputs)
-        chars = torch.from_numpy(cid_inputs)
-        pos = torch.from_numpy(pid_inputs)
-        heads = torch.from_numpy(hid_inputs)
-        types = torch.from_numpy(tid_inputs)
-        masks = torch.from_numpy(masks)
-        single = torch.from_numpy(single)
-        lengths = torch.from_numpy(lengths)
-
-        data_tensor = {'WORD': words, 'CHAR': chars, 'POS': pos, 'HEAD': heads, 'TYPE': types,
-                       'MASK': masks, 'SINGLE': single, 'LENGTH': lengths}
+        data_tensor = pack_data(data[bucket_id], ['WORD', 'CHAR', 'POS', 'HEAD', 'TYPE'], [PAD_ID_WORD, PAD_ID_CHAR, PAD_ID_TAG, PAD_ID_TAG, PAD_ID_TAG],
+                                char_length, word_alphabet.is_singleton_many)
+        if not ragged:
+            # the flat id arrays are scattered into the padded [bucket_size, bucket_length(, char_length)] tensors at once.
+            data_tensor = _collate(data_tensor, slice(None), bucket_length, exclude_keys=())
         data_tensors.append(data_tensor)
     return data_tensors, bucket_sizes, original_words
+
+
+def iterate_stream(source_paths, word_alphabet: Alphabet, char_alphabet: Alphabet, pos_alphabet: Alphabet, type_alphabet: Alphabet,
+                   batch_size, bucketed=True, shuffle_buffer=0, interleave=4, unk_replace=0., normalize_digits=True,
+                   symbolic_root=False, symbolic_end=False, keep_words=False, seed=None):
+    """
+    Padded batches read on the fly from the shards source_paths, without loading the data (see neuronlp2.io.streaming).
+    The characters are padded to the longest word of each batch (at most MAX_CHAR_LENGTH).
+    """
+    def read(path):
+        reader = CoNLLXReader(path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet)
+        return reader.iterate(normalize_digits=normalize_digits, symbolic_root=symbolic_root, symbolic_end=symbolic_end)
+
+    def tensorize(insts):
+        data = [[inst.sentence.word_ids, inst.sentence.char_id_seqs, inst.pos_ids, inst.heads, inst.type_ids] for inst in insts]
+        char_length = min(MAX_CHAR_LENGTH, max(len(char_seq) for inst in insts for char_seq in inst.sentence.char_seqs))
+        return pack_data(data, ['WORD', 'CHAR', 'POS', 'HEAD', 'TYPE'], [PAD_ID_WORD, PAD_ID_CHAR, PAD_ID_TAG, PAD_ID_TAG, PAD_ID_TAG],
+                         char_length, word_alphabet.is_singleton_many)
+
+    return stream_batches(source_paths, read, tensorize, batch_size, buckets=_buckets if bucketed else None,
+                          shuffle_buffer=shuffle_buffer, interleave=interleave, unk_replace=unk_replace, keep_words=keep_words, seed=seed)
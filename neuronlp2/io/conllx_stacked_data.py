@@ -1,14 +1,26 @@
 __author__ = 'max'
 
+from bisect import bisect_left
+from functools import partial
+from itertools import chain, islice
+from multiprocessing import Pool
 import numpy as np
 import torch
 from neuronlp2.io.reader import CoNLLXReader
+from neuronlp2.io.data_cache import load_or_build, load_or_build_oracle
+from neuronlp2.io.ragged import pack_data, LengthMask, RaggedSequence, _int_dtype, _offsets
+from neuronlp2.io.streaming import stream_batches
+from neuronlp2.io.parallel import Columns, read_columns, pack_columns, read_parallel
+from neuronlp2.io.utils import _collate
 from neuronlp2.io.conllx_data import _buckets, NUM_SYMBOLIC_TAGS, create_alphabets
 from neuronlp2.io.common import DIGIT_RE, MAX_CHAR_LENGTH, UNK_ID
 from neuronlp2.io.common import PAD_CHAR, PAD, PAD_POS, PAD_TYPE, PAD_ID_CHAR, PAD_ID_TAG, PAD_ID_WORD
 from neuronlp2.io.common import ROOT, END, ROOT_CHAR, ROOT_POS, ROOT_TYPE, END_CHAR, END_POS, END_TYPE
 
 
+PRIOR_ORDERS = ('inside_out', 'left2right', 'deep_first', 'shallow_first')
+
+
 def _obtain_child_index_for_left2right(heads):
     child_ids = [[] for _ in range(len(heads))]
     # skip the symbolic root.
@@ -19,34 +31,31 @@ def _obtain_child_index_for_left2right(heads):
 
 
 def _obtain_child_index_for_inside_out(heads):
-    child_ids = [[] for _ in range(len(heads))]
-    for head in range(len(heads)):
-        # first find left children inside-out
-        for child in reversed(range(1, head)):
-            if heads[child] == head:
-                child_ids[head].append(child)
-        # second find right children inside-out
-        for child in range(head + 1, len(heads)):
-            if heads[child] == head:
-                child_ids[head].append(child)
+    child_ids = _obtain_child_index_for_left2right(heads)
+    for head, children in enumerate(child_ids):
+        # the children are in increasing order: first the left children inside-out, then the right children.
+        if children and children[0] < head:
+            split = bisect_left(children, head)
+            child_ids[head] = children[split - 1::-1] + children[split:]
     return child_ids
 
 
 def _obtain_child_index_for_depth(heads, reverse):
-    def calc_depth(head):
-        children = child_ids[head]
-        max_depth = 0
-        for child in children:
-            depth = calc_depth(child)
-            child_with_depth[head].append((child, depth))
-            max_depth = max(max_depth, depth + 1)
-        child_with_depth[head] = sorted(child_with_depth[head], key=lambda x: x[1], reverse=reverse)
-        return max_depth
-
     child_ids = _obtain_child_index_for_left2right(heads)
+    # the nodes reachable from the root, each one after its head.
+    order = [0]
+    for head in order:
+        order.extend(child_ids[head])
+    # depth of the subtree of each node, computed children first.
+    depth = [0 for _ in range(len(heads))]
+    for head in reversed(order):
+        for child in child_ids[head]:
+            depth[head] = max(depth[head], depth[child] + 1)
+    # the sort is stable: children of the same depth stay from left to right.
     child_with_depth = [[] for _ in range(len(heads))]
-    calc_depth(0)
-    return [[child for child, depth in child_with_depth[head]] for head in range(len(heads))]
+    for head in order:
+        child_with_depth[head] = sorted(child_ids[head], key=depth.__getitem__, reverse=reverse)
+    return child_with_depth
 
 
 def _generate_stack_inputs(heads, types, prior_order):
@@ -68,6 +77,8 @@ def _generate_stack_inputs(heads, types, prior_order):
     skip_connect = []
     prev = [0 for _ in range(len(heads))]
     sibs = [0 for _ in range(len(heads))]
+    # position in child_ids[head] of the next child of each head.
+    next_child = [0 for _ in range(len(heads))]
     stack = [0]
     position = 1
     while len(stack) > 0:
@@ -77,13 +88,14 @@ def _generate_stack_inputs(heads, types, prior_order):
         child_id = child_ids[head]
         skip_connect.append(prev[head])
         prev[head] = position
-        if len(child_id) == 0:
+        if next_child[head] == len(child_id):
             children.append(head)
             sibs[head] = 0
             stacked_types.append(PAD_ID_TAG)
             stack.pop()
         else:
-            child = child_id.pop(0)
+            child = child_id[next_child[head]]
+            next_child[head] += 1
             children.append(child)
             sibs[head] = child
             stack.append(child)
@@ -93,8 +105,195 @@ def _generate_stack_inputs(heads, types, prior_order):
     return stacked_heads, children, siblings, stacked_types, skip_connect
 
 
+def _stack_oracle_chunk(chunk):
+    heads, types, prior_order = chunk
+    return [_generate_stack_inputs(sent_heads, sent_types, prior_order) for sent_heads, sent_types in zip(heads, types)]
+
+
+def stack_oracle(heads, types, prior_order='inside_out', num_workers=1):
+    """
+    The decoder inputs of the stack-pointer parser for many sentences, in time linear in the number of tokens.
+
+    Args:
+        heads: list
+            the head of every token of each sentence (with the symbolic root).
+        types: list
+            the type id of every token of each sentence.
+        prior_order: str
+            the order of the children of a head, one of PRIOR_ORDERS.
+        num_workers: int
+            number of worker processes (1: computed in this process).
+
+    Returns: list
+        (stacked_heads, children, siblings, stacked_types, skip_connect) of each sentence.
+
+    """
+    if prior_order not in PRIOR_ORDERS:
+        raise ValueError('Unknown prior order: %s' % prior_order)
+    if num_workers <= 1 or len(heads) == 0:
+        return _stack_oracle_chunk((heads, types, prior_order))
+
+    # a few chunks per worker to balance the load.
+    chunk_size = (len(heads) - 1) // (4 * num_workers) + 1
+    chunks = [(heads[i:i + chunk_size], types[i:i + chunk_size], prior_order) for i in range(0, len(heads), chunk_size)]
+    with Pool(num_workers) as pool:
+        parts = pool.map(_stack_oracle_chunk, chunks)
+    return [oracle for part in parts for oracle in part]
+
+
+_STACKED_KEYS = ['WORD', 'CHAR', 'POS', 'HEAD', 'TYPE', 'STACK_HEAD', 'CHILD', 'SIBLING', 'STACK_TYPE', 'SKIP_CONNECT']
+_STACKED_PADS = [PAD_ID_WORD, PAD_ID_CHAR] + [PAD_ID_TAG] * (len(_STACKED_KEYS) - 2)
+# the fields of the oracle table, the positions in the output of _generate_stack_inputs. The stacked types depend on
+# the type alphabet, they are gathered from the TYPE field.
+_ORACLE_FIELDS = [0, 1, 2, 4]
+
+
+def _encoder_row(inst):
+    sent = inst.sentence
+    return [sent.word_ids, sent.char_id_seqs, inst.pos_ids, inst.heads, inst.type_ids]
+
+
+def _instance_row(inst, prior_order):
+    return _encoder_row(inst) + list(_generate_stack_inputs(inst.heads, inst.type_ids, prior_order))
+
+
+def _add_decoder_mask(data_tensor, rows=None):
+    data_tensor['MASK_DEC'] = LengthMask(data_tensor['LENGTH'], decoder=True)
+    return data_tensor
+
+
+def _pack_stacked_data(data, char_length, word_alphabet, prior_order):
+    # the rows hold the fields of the encoder, the decoder inputs of all the sentences are generated at once.
+    oracles = stack_oracle([row[3] for row in data], [row[4] for row in data], prior_order)
+    data = [row + list(oracle) for row, oracle in zip(data, oracles)]
+    data_tensor = pack_data(data, _STACKED_KEYS, _STACKED_PADS, char_length, word_alphabet.is_singleton_many, mask_key='MASK_ENC')
+    return _add_decoder_mask(data_tensor)
+
+
+def _read_heads(source_path, alphabets, max_size, normalize_digits):
+    reader = CoNLLXReader(source_path, *alphabets)
+    instances = reader.iterate(normalize_digits=normalize_digits, symbolic_root=True, symbolic_end=False)
+    heads = [inst.heads for inst in islice(instances, max_size or None)]
+    reader.close()
+    return heads
+
+
+def _load_oracle(oracle_dir, source_path, num_steps, read_heads):
+    """
+    The oracle table of the treebank, covering at least num_steps decoding steps. read_heads() returns the heads of the
+    sentences read (in the order of the file) when the table has to be built.
+    """
+    def build():
+        heads = read_heads()
+        count = sum(2 * len(sent_heads) - 1 for sent_heads in heads)
+        table = []
+        for prior_order in PRIOR_ORDERS:
+            # the types are not part of the table, the heads stand in for them.
+            oracles = stack_oracle(heads, heads, prior_order)
+            for field in _ORACLE_FIELDS:
+                table.append(np.fromiter(chain.from_iterable(oracle[field] for oracle in oracles), dtype=np.int64, count=count))
+        return np.stack(table)
+
+    return load_or_build_oracle(oracle_dir, source_path, len(PRIOR_ORDERS) * len(_ORACLE_FIELDS), num_steps, build)
+
+
+def _gather_oracle(data_tensor, table, prior_order):
+    # the decoder fields from the table, the steps of each sentence start at its ORACLE_OFFSET.
+    starts = data_tensor.pop('ORACLE_OFFSET').numpy()
+    lengths = 2 * data_tensor['LENGTH'].numpy() - 1
+    steps = _offsets(lengths)
+    index = np.arange(steps[-1]) + np.repeat(starts - steps[:-1], lengths)
+    order_id = PRIOR_ORDERS.index(prior_order)
+    table = table[order_id * len(_ORACLE_FIELDS):(order_id + 1) * len(_ORACLE_FIELDS)]
+    stacked_heads, children, siblings, skip_connect = table[:, index].astype(np.int64)
+    # the type of the child pushed at each step, none when the head is popped.
+    types = data_tensor['TYPE']
+    stacked_types = types.values.numpy()[np.repeat(types.offsets.numpy()[:-1], lengths) + children].astype(np.int64)
+    stacked_types[children == stacked_heads] = PAD_ID_TAG
+    for key, values in zip(_STACKED_KEYS[5:], (stacked_heads, children, siblings, stacked_types, skip_connect)):
+        data_tensor[key] = RaggedSequence(values.astype(_int_dtype(values)), steps, PAD_ID_TAG)
+    return data_tensor
+
+
+def _read_encoder_data(source_path, alphabets, max_size, normalize_digits, buckets, num_workers, oracle_dir):
+    # the ragged encoder fields, with the start of the decoding steps of each sentence in the oracle table
+    # (ORACLE_OFFSET). The table is built along from the heads read, when missing.
+    options = {'normalize_digits': normalize_digits, 'symbolic_root': True, 'symbolic_end': False}
+    if num_workers > 1:
+        print('Reading data from %s with %d workers' % (source_path, num_workers))
+        columns = read_columns(CoNLLXReader, source_path, alphabets, _encoder_row, 5, num_workers, max_size=max_size, **options)
+    else:
+        print('Reading data from %s' % source_path)
+        reader = CoNLLXReader(source_path, *alphabets)
+        columns = Columns.from_rows([_encoder_row(inst) for inst in islice(reader.iterate(**options), max_size or None)], 5, 1)
+        reader.close()
+    print("Total number of data: %d" % len(columns))
+
+    values, lengths = columns.fields[3]
+    starts = _offsets(lengths)
+    offsets = _offsets(2 * lengths - 1)
+    _load_oracle(oracle_dir, source_path, int(offsets[-1]),
+                 lambda: [values[start:end].tolist() for start, end in zip(starts[:-1], starts[1:])])
+
+    def add_offsets(data_tensor, rows):
+        data_tensor['ORACLE_OFFSET'] = torch.from_numpy(offsets[rows])
+        return data_tensor
+
+    return pack_columns(columns, _STACKED_KEYS[:5], _STACKED_PADS[:5], alphabets[0].is_singleton_many, buckets=buckets,
+                        ragged=True, mask_key='MASK_ENC', finalize=add_offsets)
+
+
+def _read_with_oracle(source_path, alphabets, max_size, normalize_digits, buckets, prior_order, ragged, cache_dir,
+                      num_workers, oracle_dir):
+    """
+    The data of read_data (buckets None) or read_bucketed_data, the decoder fields gathered from the oracle table of
+    oracle_dir. The encoder fields do not depend on the prior order, they are cached once for all the orders.
+    """
+    def build():
+        return _read_encoder_data(source_path, alphabets, max_size, normalize_digits, buckets, num_workers, oracle_dir)
+
+    if cache_dir is None:
+        data, sizes = build()
+    else:
+        options = {'max_size': max_size, 'normalize_digits': normalize_digits}
+        if buckets is None:
+            data, sizes = load_or_build(cache_dir, 'stacked.encoder', source_path, alphabets, options, build)
+        else:
+            data, sizes = load_or_build(cache_dir, 'stacked.encoder.bucketed', source_path, alphabets,
+                                        dict(options, buckets=buckets), build)
+
+    data_tensors = [data] if buckets is None else data
+    num_steps = max([int((tensors['ORACLE_OFFSET'] + 2 * tensors['LENGTH'] - 1).max()) for tensors in data_tensors
+                     if isinstance(tensors, dict) and len(tensors['LENGTH']) > 0], default=0)
+    table = _load_oracle(oracle_dir, source_path, num_steps, partial(_read_heads, source_path, alphabets, max_size, normalize_digits))
+    outputs = []
+    for bucket_id, tensors in enumerate(data_tensors):
+        if isinstance(tensors, dict):
+            tensors = _add_decoder_mask(_gather_oracle(dict(tensors), table, prior_order))
+            if not ragged:
+                if buckets is None:
+                    length = int(tensors['LENGTH'].max()) if len(tensors['LENGTH']) > 0 else 0
+                else:
+                    length = buckets[bucket_id]
+                tensors = _collate(tensors, slice(None), length, exclude_keys=())
+        outputs.append(tensors)
+    return (outputs[0] if buckets is None else outputs), sizes
+
+
 def read_data(source_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet,
-              max_size=None, normalize_digits=True, prior_order='inside_out'):
+              max_size=None, normalize_digits=True, prior_order='inside_out', ragged=False, cache_dir=None, num_workers=1,
+              oracle_dir=None):
+    # the oracle of all the prior orders is cached in oracle_dir (default: cache_dir).
+    oracle_dir = cache_dir if oracle_dir is None else oracle_dir
+    if oracle_dir is not None:
+        return _read_with_oracle(source_path, [word_alphabet, char_alphabet, pos_alphabet, type_alphabet], max_size, normalize_digits,
+                                 None, prior_order, ragged, cache_dir, num_workers, oracle_dir)
+
+    if num_workers > 1:
+        return read_parallel(CoNLLXReader, source_path, [word_alphabet, char_alphabet, pos_alphabet, type_alphabet], partial(_instance_row, prior_order=prior_order),
+                             _STACKED_KEYS, _STACKED_PADS, num_workers, max_size=max_size,
+                             ragged=ragged, mask_key='MASK_ENC', finalize=_add_decoder_mask, normalize_digits=normalize_digits, symbolic_root=True, symbolic_end=False)[:2]
+
     data = []
     max_length = 0
     max_char_length = 0
@@ -108,8 +307,7 @@ def read_data(source_path, word_alphabet, char_alphabet, pos_alphabet, type_alph
             print("reading data: %d" % counter)
 
         sent = inst.sentence
-        stacked_heads, children, siblings, stacked_types, skip_connect = _generate_stack_inputs(inst.heads, inst.type_ids, prior_order)
-        data.append([sent.word_ids, sent.char_id_seqs, inst.pos_ids, inst.heads, inst.type_ids, stacked_heads, children, siblings, stacked_types, skip_connect])
+        data.append([sent.word_ids, sent.char_id_seqs, inst.pos_ids, inst.heads, inst.type_ids])
         max_len = max([len(char_seq) for char_seq in sent.char_seqs])
         if max_char_length < max_len:
             max_char_length = max_len
@@ -121,93 +319,28 @@ def read_data(source_path, word_alphabet, char_alphabet, pos_alphabet, type_alph
 
     data_size = len(data)
     char_length = min(MAX_CHAR_LENGTH, max_char_length)
-    wid_inputs = np.empty([data_size, max_length], dtype=np.int64)
-    cid_inputs = np.empty([data_size, max_length, char_length], dtype=np.int64)
-    pid_inputs = np.empty([data_size, max_length], dtype=np.int64)
-    hid_inputs = np.empty([data_size, max_length], dtype=np.int64)
-    tid_inputs = np.empty([data_size, max_length], dtype=np.int64)
-
-    masks_e = np.zeros([data_size, max_length], dtype=np.float32)
-    single = np.zeros([data_size, max_length], dtype=np.int64)
-    lengths = np.empty(data_size, dtype=np.int64)
-
-    stack_hid_inputs = np.empty([data_size, 2 * max_length - 1], dtype=np.int64)
-    chid_inputs = np.empty([data_size, 2 * max_length - 1], dtype=np.int64)
-    ssid_inputs = np.empty([data_size, 2 * max_length - 1], dtype=np.int64)
-    stack_tid_inputs = np.empty([data_size, 2 * max_length - 1], dtype=np.int64)
-    skip_connect_inputs = np.empty([data_size, 2 * max_length - 1], dtype=np.int64)
-
-    masks_d = np.zeros([data_size, 2 * max_length - 1], dtype=np.float32)
-
-    for i, inst in enumerate(data):
-        wids, cid_seqs, pids, hids, tids, stack_hids, chids, ssids, stack_tids, skip_ids = inst
-        inst_size = len(wids)
-        lengths[i] = inst_size
-        # word ids
-        wid_inputs[i, :inst_size] = wids
-        wid_inputs[i, inst_size:] = PAD_ID_WORD
-        for c, cids in enumerate(cid_seqs):
-            cid_inputs[i, c, :len(cids)] = cids
-            cid_inputs[i, c, len(cids):] = PAD_ID_CHAR
-        cid_inputs[i, inst_size:, :] = PAD_ID_CHAR
-        # pos ids
-        pid_inputs[i, :inst_size] = pids
-        pid_inputs[i, inst_size:] = PAD_ID_TAG
-        # type ids
-        tid_inputs[i, :inst_size] = tids
-        tid_inputs[i, inst_size:] = PAD_ID_TAG
-        # heads
-        hid_inputs[i, :inst_size] = hids
-        hid_inputs[i, inst_size:] = PAD_ID_TAG
-        # masks_e
-        masks_e[i, :inst_size] = 1.0
-        for j, wid in enumerate(wids):
-            if word_alphabet.is_singleton(wid):
-                single[i, j] = 1
-
-        inst_size_decoder = 2 * inst_size - 1
-        # stacked heads
-        stack_hid_inputs[i, :inst_size_decoder] = stack_hids
-        stack_hid_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-        # children
-        chid_inputs[i, :inst_size_decoder] = chids
-        chid_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-        # siblings
-        ssid_inputs[i, :inst_size_decoder] = ssids
-        ssid_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-        # stacked types
-        stack_tid_inputs[i, :inst_size_decoder] = stack_tids
-        stack_tid_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-        # skip connects
-        skip_connect_inputs[i, :inst_size_decoder] = skip_ids
-        skip_connect_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-        # masks_d
-        masks_d[i, :inst_size_decoder] = 1.0
-
-    words = torch.from_numpy(wid_inputs)
-    chars = torch.from_numpy(cid_inputs)
-    pos = torch.from_numpy(pid_inputs)
-    heads = torch.from_numpy(hid_inputs)
-    types = torch.from_numpy(tid_inputs)
-    masks_e = torch.from_numpy(masks_e)
-    single = torch.from_numpy(single)
-    lengths = torch.from_numpy(lengths)
-
-    stacked_heads = torch.from_numpy(stack_hid_inputs)
-    children = torch.from_numpy(chid_inputs)
-    siblings = torch.from_numpy(ssid_inputs)
-    stacked_types = torch.from_numpy(stack_tid_inputs)
-    skip_connect = torch.from_numpy(skip_connect_inputs)
-    masks_d = torch.from_numpy(masks_d)
-
-    data_tensor = {'WORD': words, 'CHAR': chars, 'POS': pos, 'HEAD': heads, 'TYPE': types, 'MASK_ENC': masks_e,
-                   'SINGLE': single, 'LENGTH': lengths, 'STACK_HEAD': stacked_heads, 'CHILD': children,
-                   'SIBLING': siblings, 'STACK_TYPE': stacked_types, 'SKIP_CONNECT': skip_connect, 'MASK_DEC': masks_d}
+    data_tensor = _pack_stacked_data(data, char_length, word_alphabet, prior_order)
+    if not ragged:
+        # the flat id arrays are scattered into the padded [data_size, max_length(, char_length)] tensors at once
+        # ([data_size, 2 * max_length - 1] for the decoder).
+        data_tensor = _collate(data_tensor, slice(None), max_length, exclude_keys=())
     return data_tensor, data_size
 
 
 def read_bucketed_data(source_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet,
-                       max_size=None, normalize_digits=True, prior_order='inside_out'):
+                       max_size=None, normalize_digits=True, prior_order='inside_out', ragged=False, cache_dir=None, num_workers=1,
+                       oracle_dir=None):
+    # the oracle of all the prior orders is cached in oracle_dir (default: cache_dir).
+    oracle_dir = cache_dir if oracle_dir is None else oracle_dir
+    if oracle_dir is not None:
+        return _read_with_oracle(source_path, [word_alphabet, char_alphabet, pos_alphabet, type_alphabet], max_size, normalize_digits,
+                                 _buckets, prior_order, ragged, cache_dir, num_workers, oracle_dir)
+
+    if num_workers > 1:
+        return read_parallel(CoNLLXReader, source_path, [word_alphabet, char_alphabet, pos_alphabet, type_alphabet], partial(_instance_row, prior_order=prior_order),
+                             _STACKED_KEYS, _STACKED_PADS, num_workers, max_size=max_size, buckets=_buckets,
+                             ragged=ragged, mask_key='MASK_ENC', finalize=_add_decoder_mask, normalize_digits=normalize_digits, symbolic_root=True, symbolic_end=False)[:2]
+
     data = [[] for _ in _buckets]
     max_char_length = [0 for _ in _buckets]
     print('Reading data from %s' % source_path)
@@ -223,8 +356,7 @@ def read_bucketed_data(source_path, word_alphabet, char_alphabet, pos_alphabet,
         sent = inst.sentence
         for bucket_id, bucket_size in enumerate(_buckets):
             if inst_size < bucket_size:
-                stacked_heads, children, siblings, stacked_types, skip_connect = _generate_stack_inputs(inst.heads, inst.type_ids, prior_order)
-                data[bucket_id].append([sent.word_ids, sent.char_id_seqs, inst.pos_ids, inst.heads, inst.type_ids, stacked_heads, children, siblings, stacked_types, skip_connect])
+                data[bucket_id].append([sent.word_ids, sent.char_id_seqs, inst.pos_ids, inst.heads, inst.type_ids])
                 max_len = max([len(char_seq) for char_seq in sent.char_seqs])
                 if max_char_length[bucket_id] < max_len:
                     max_char_length[bucket_id] = max_len
@@ -244,88 +376,30 @@ def read_bucketed_data(source_path, word_alphabet, char_alphabet, pos_alphabet,
 
         bucket_length = _buckets[bucket_id]
         char_length = min(MAX_CHAR_LENGTH, max_char_length[bucket_id])
-        wid_inputs = np.empty([bucket_size, bucket_length], dtype=np.int64)
-        cid_inputs = np.empty([bucket_size, bucket_length, char_length], dtype=np.int64)
-        pid_inputs = np.empty([bucket_size, bucket_length], dtype=np.int64)
-        hid_inputs = np.empty([bucket_size, bucket_length], dtype=np.int64)
-        tid_inputs = np.empty([bucket_size, bucket_length], dtype=np.int64)
-
-        masks_e = np.zeros([bucket_size, bucket_length], dtype=np.float32)
-        single = np.zeros([bucket_size, bucket_length], dtype=np.int64)
-        lengths = np.empty(bucket_size, dtype=np.int64)
-
-        stack_hid_inputs = np.empty([bucket_size, 2 * bucket_length - 1], dtype=np.int64)
-        chid_inputs = np.empty([bucket_size, 2 * bucket_length - 1], dtype=np.int64)
-        ssid_inputs = np.empty([bucket_size, 2 * bucket_length - 1], dtype=np.int64)
-        stack_tid_inputs = np.empty([bucket_size, 2 * bucket_length - 1], dtype=np.int64)
-        skip_connect_inputs = np.empty([bucket_size, 2 * bucket_length - 1], dtype=np.int64)
-
-        masks_d = np.zeros([bucket_size, 2 * bucket_length - 1], dtype=np.float32)
-
-        for i, inst in enumerate(data[bucket_id]):
-            wids, cid_seqs, pids, hids, tids, stack_hids, chids, ssids, stack_tids, skip_ids = inst
-            inst_size = len(wids)
-            lengths[i] = inst_size
-            # word ids
-            wid_inputs[i, :inst_size] = wids
-            wid_inputs[i, inst_size:] = PAD_ID_WORD
-            for c, cids in enumerate(cid_seqs):
-                cid_inputs[i, c, :len(cids)] = cids
-                cid_inputs[i, c, len(cids):] = PAD_ID_CHAR
-            cid_inputs[i, inst_size:, :] = PAD_ID_CHAR
-            # pos ids
-            pid_inputs[i, :inst_size] = pids
-            pid_inputs[i, inst_size:] = PAD_ID_TAG
-            # type ids
-            tid_inputs[i, :inst_size] = tids
-            tid_inputs[i, inst_size:] = PAD_ID_TAG
-            # heads
-            hid_inputs[i, :inst_size] = hids
-            hid_inputs[i, inst_size:] = PAD_ID_TAG
-            # masks_e
-            masks_e[i, :inst_size] = 1.0
-            for j, wid in enumerate(wids):
-                if word_alphabet.is_singleton(wid):
-                    single[i, j] = 1
-
-            inst_size_decoder = 2 * inst_size - 1
-            # stacked heads
-            stack_hid_inputs[i, :inst_size_decoder] = stack_hids
-            stack_hid_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-            # children
-            chid_inputs[i, :inst_size_decoder] = chids
-            chid_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-            # siblings
-            ssid_inputs[i, :inst_size_decoder] = ssids
-            ssid_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-            # stacked types
-            stack_tid_inputs[i, :inst_size_decoder] = stack_tids
-            stack_tid_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-            # skip connects
-            skip_connect_inputs[i, :inst_size_decoder] = skip_ids
-            skip_connect_inputs[i, inst_size_decoder:] = PAD_ID_TAG
-            # masks_d
-            masks_d[i, :inst_size_decoder] = 1.0
-
-        words = torch.from_numpy(wid_inputs)
-        chars = torch.from_numpy(cid_inputs)
-        pos = torch.from_numpy(pid_inputs)
-        heads = torch.from_numpy(hid_inputs)
-        types = torch.from_numpy(tid_inputs)
-        masks_e = torch.from_numpy(masks_e)
-        single = torch.from_numpy(single)
-        lengths = torch.from_numpy(lengths)
-
-        stacked_heads = torch.from_numpy(stack_hid_inputs)
-        children = torch.from_numpy(chid_inputs)
-        siblings = torch.from_numpy(ssid_inputs)
-        stacked_types = torch.from_numpy(stack_tid_inputs)
-        skip_connect = torch.from_numpy(skip_connect_inputs)
-        masks_d = torch.from_numpy(masks_d)
-
-        data_tensor = {'WORD': words, 'CHAR': chars, 'POS': pos, 'HEAD': heads, 'TYPE': types, 'MASK_ENC': masks_e,
-                       'SINGLE': single, 'LENGTH': lengths, 'STACK_HEAD': stacked_heads, 'CHILD': children,
-                       'SIBLING': siblings, 'STACK_TYPE': stacked_types, 'SKIP_CONNECT': skip_connect, 'MASK_DEC': masks_d}
+        data_tensor = _pack_stacked_data(data[bucket_id], char_length, word_alphabet, prior_order)
+        if not ragged:
+            # the flat id arrays are scattered into the padded [bucket_size, bucket_length(, char_length)] tensors at once
+            # ([bucket_size, 2 * bucket_length - 1] for the decoder).
+            data_tensor = _collate(data_tensor, slice(None), bucket_length, exclude_keys=())
         data_tensors.append(data_tensor)
-
     return data_tensors, bucket_sizes
+
+
+def iterate_stream(source_paths, word_alphabet, char_alphabet, pos_alphabet, type_alphabet, batch_size, bucketed=True,
+                   shuffle_buffer=0, interleave=4, unk_replace=0., normalize_digits=True, prior_order='inside_out',
+                   keep_words=False, seed=None):
+    """
+    Padded batches read on the fly from the shards source_paths, without loading the data (see neuronlp2.io.streaming).
+    The characters are padded to the longest word of each batch (at most MAX_CHAR_LENGTH).
+    """
+    def read(path):
+        reader = CoNLLXReader(path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet)
+        return reader.iterate(normalize_digits=normalize_digits, symbolic_root=True, symbolic_end=False)
+
+    def tensorize(insts):
+        data = [[inst.sentence.word_ids, inst.sentence.char_id_seqs, inst.pos_ids, inst.heads, inst.type_ids] for inst in insts]
+        char_length = min(MAX_CHAR_LENGTH, max(len(char_seq) for inst in insts for char_seq in inst.sentence.char_seqs))
+        return _pack_stacked_data(data, char_length, word_alphabet, prior_order)
+
+    return stream_batches(source_paths, read, tensorize, batch_size, buckets=_buckets if bucketed else None,
+                          shuffle_buffer=shuffle_buffer, interleave=interleave, unk_replace=unk_replace, keep_words=keep_words, seed=seed)
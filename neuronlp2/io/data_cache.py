@@ -0,0 +1,210 @@
+__author__ = 'max'
+
+"""
+Binary cache of the tensorized datasets returned by read_data / read_bucketed_data.
+
+Each (source file, reader, options) has one .npz file in the cache directory. Besides the arrays, it records the
+cache format version, the hash of the source file and the hash of the alphabets it was built with. A cache whose
+version or hashes do not match is rebuilt and overwritten, so a modified treebank or re-created alphabets never
+load stale ids.
+
+The transition oracle of the stack-pointer parser is cached apart, once per treebank: one memory-mapped .npy table
+holds the oracle of every prior order, so that changing the order only gathers from the table.
+"""
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+import torch
+from neuronlp2.io.ragged import is_ragged, field_state, field_from_state
+
+CACHE_VERSION = 2
+ORACLE_VERSION = 1
+
+# the umask of the process, read once: mkstemp creates files readable by their owner only, the cache files get the
+# permissions of the files created by open().
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def file_hash(path, block_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def alphabet_hash(alphabets):
+    sha = hashlib.sha1()
+    for alphabet in alphabets:
+        content = {'instances': alphabet.instances,
+                   'singletons': None if alphabet.singletons is None else sorted(alphabet.singletons)}
+        sha.update(json.dumps(content, ensure_ascii=False).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def _cache_path(cache_dir, name, source_path, options):
+    key = json.dumps({'source': os.path.abspath(source_path), 'reader': name, 'options': options}, sort_keys=True)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, '%s.%s.%s.npz' % (os.path.basename(source_path), name, digest))
+
+
+def _encode(data, arrays):
+    # data: (tensors, sizes[, original_words]), tensors is a dict of tensors (or ragged fields) or a list of them
+    # (one per bucket, (1, 1) for empty buckets).
+    bucketed = isinstance(data[0], list)
+    buckets = data[0] if bucketed else [data[0]]
+    keys = []
+    fields = []
+    for bucket_id, tensors in enumerate(buckets):
+        if isinstance(tensors, dict):
+            keys.append(list(tensors.keys()))
+            # meta of the ragged fields, stored as several arrays.
+            fields.append({})
+            for key, tensor in tensors.items():
+                if is_ragged(tensor):
+                    fields[-1][key], field_arrays = field_state(tensor)
+                    for name, array in field_arrays.items():
+                        arrays['%d/%s/%s' % (bucket_id, key, name)] = array
+                else:
+                    arrays['%d/%s' % (bucket_id, key)] = tensor.numpy()
+        else:
+            keys.append(None)
+            fields.append(None)
+
+    meta = {'bucketed': bucketed, 'keys': keys, 'fields': fields, 'sizes': data[1], 'has_words': len(data) > 2}
+    if len(data) > 2:
+        original_words = data[2]
+        arrays['words/lengths'] = np.array([len(words) for words in original_words], dtype=np.int64)
+        text = '\n'.join(word for words in original_words for word in words).encode('utf-8')
+        arrays['words/text'] = np.frombuffer(text, dtype=np.uint8)
+    return meta
+
+
+def _decode(meta, arrays):
+    buckets = []
+    for bucket_id, (keys, fields) in enumerate(zip(meta['keys'], meta['fields'])):
+        if keys is None:
+            buckets.append((1, 1))
+            continue
+        tensors = {}
+        for key in keys:
+            if key in fields:
+                prefix = '%d/%s/' % (bucket_id, key)
+                field_arrays = {name[len(prefix):]: array for name, array in arrays.items() if name.startswith(prefix)}
+                tensors[key] = field_from_state(fields[key], field_arrays)
+            else:
+                tensors[key] = torch.from_numpy(arrays['%d/%s' % (bucket_id, key)])
+        buckets.append(tensors)
+    data = [buckets if meta['bucketed'] else buckets[0], meta['sizes']]
+    if meta['has_words']:
+        lengths = arrays['words/lengths']
+        text = arrays['words/text'].tobytes().decode('utf-8')
+        words = text.split('\n') if lengths.sum() > 0 else []
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        data.append([words[offsets[i]:offsets[i + 1]] for i in range(len(lengths))])
+    return tuple(data)
+
+
+def load_or_build(cache_dir, name, source_path, alphabets, options, build):
+    """
+    Load the output of a data reader from the cache, or build it and write the cache.
+
+    Args:
+        cache_dir: str
+            directory of the cache files.
+        name: str
+            name of the reader (e.g. 'conllx.bucketed'), part of the cache key.
+        source_path: str
+            path of the data file.
+        alphabets: list
+            the alphabets used to build the data.
+        options: dict
+            the options of the reader (must be json serializable), part of the cache key.
+        build: callable
+            builds the data when the cache is missing or stale.
+
+    Returns: tuple
+        the output of build().
+
+    """
+    path = _cache_path(cache_dir, name, source_path, options)
+    source_hash = file_hash(source_path)
+    alphabets_hash = alphabet_hash(alphabets)
+    if os.path.exists(path):
+        try:
+            with np.load(path) as npz:
+                meta = json.loads(npz['meta'].tobytes().decode('utf-8'))
+                if meta['version'] == CACHE_VERSION and meta['source_hash'] == source_hash \
+                        and meta['alphabet_hash'] == alphabets_hash:
+                    print('Loading cached data from %s' % path)
+                    return _decode(meta, {key: npz[key] for key in npz.files})
+        except (OSError, ValueError, KeyError) as e:
+            print('Ignoring unreadable cache %s: %s' % (path, repr(e)))
+
+    data = build()
+    arrays = {}
+    meta = _encode(data, arrays)
+    meta.update({'version': CACHE_VERSION, 'source_hash': source_hash, 'alphabet_hash': alphabets_hash})
+    arrays['meta'] = np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8)
+
+    _write(cache_dir, path, lambda file: np.savez(file, **arrays))
+    print('Cached data to %s' % path)
+    return data
+
+
+def _write(cache_dir, path, save):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # write to a temporary file first, so that a crash never leaves a truncated cache.
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            save(file)
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_or_build_oracle(cache_dir, source_path, num_tables, num_steps, build):
+    """
+    Load the oracle table of a treebank from the cache (memory-mapped), or build it and write the cache.
+
+    Args:
+        cache_dir: str
+            directory of the cache files.
+        source_path: str
+            path of the treebank. The cache is keyed by the hash of its content.
+        num_tables: int
+            number of rows of the table (one per prior order and oracle field).
+        num_steps: int
+            number of decoding steps of the sentences read. A table covering fewer steps (built from fewer sentences,
+            e.g. with max_size) is rebuilt.
+        build: callable
+            builds the table: integer array [num_tables, number of steps of the sentences read].
+
+    Returns: numpy.ndarray
+        the table (int16, or int32 for sentences too long for int16), read-only.
+
+    """
+    source_hash = file_hash(source_path)
+    path = os.path.join(cache_dir, '%s.oracle%d.%s.npy' % (os.path.basename(source_path), ORACLE_VERSION, source_hash[:16]))
+    if os.path.exists(path):
+        try:
+            table = np.load(path, mmap_mode='r')
+            if table.ndim == 2 and table.shape[0] == num_tables and table.shape[1] >= num_steps:
+                print('Loading cached oracle from %s' % path)
+                return table
+        except (OSError, ValueError) as e:
+            print('Ignoring unreadable oracle cache %s: %s' % (path, repr(e)))
+
+    table = build()
+    dtype = np.int16 if table.size == 0 or table.max() <= np.iinfo(np.int16).max else np.int32
+    table = table.astype(dtype)
+    _write(cache_dir, path, lambda file: np.save(file, table))
+    print('Cached oracle to %s' % path)
+    return np.load(path, mmap_mode='r')
@@ -0,0 +1,132 @@
+__author__ = 'max'
+
+"""
+Pretrained embeddings stored as one float32 matrix and a vocabulary.
+
+A text embedding file is parsed once and converted to a .npy matrix and a binary alphabet of its words, in a cache
+directory. Later loads memory-map both files, so the text is not parsed again and no array is allocated per word.
+"""
+import os
+import json
+from collections.abc import Mapping
+import numpy as np
+from neuronlp2.io.alphabet import Alphabet
+from neuronlp2.io.data_cache import _write
+
+EMBEDDING_CACHE_VERSION = 1
+
+
+class EmbeddingDict(Mapping):
+    """
+    Read-only word --> embedding mapping backed by a matrix: the embedding of the word of row i of the matrix is
+    matrix[i:i + 1], a [1, dim] array like the values of the dicts returned by load_embedding_dict.
+    """
+    def __init__(self, vocab, matrix):
+        # vocab is a closed alphabet without default value: its index i is row i of the matrix.
+        self.vocab = vocab
+        self.matrix = matrix
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    def __len__(self):
+        return self.vocab.size()
+
+    def __iter__(self):
+        return iter(self.vocab.instances)
+
+    def __contains__(self, word):
+        return self.row(word) >= 0
+
+    def __getitem__(self, word):
+        row = self.row(word)
+        if row < 0:
+            raise KeyError(word)
+        return self.matrix[row:row + 1]
+
+    def row(self, word):
+        """
+        Row of the word in the matrix, -1 if it is missing.
+        """
+        try:
+            return self.vocab.get_index(word)
+        except KeyError:
+            return -1
+
+    def rows(self, words):
+        """
+        Rows of a list of words in the matrix, as an int64 array (-1 for the missing words).
+        """
+        return np.array([self.row(word) for word in words], dtype=np.int64)
+
+
+def build_embedding(words, vectors):
+    """
+    EmbeddingDict of the words and their vectors ([len(words), dim]). A word seen several times keeps its first
+    position and its last vector, as when the words are added to an OrderedDict one after the other.
+    """
+    rows = {}
+    for i, word in enumerate(words):
+        rows[word] = i
+    vocab = Alphabet('embedding')
+    for word in rows:
+        vocab.add(word)
+    vocab.close()
+    if len(rows) != len(words):
+        vectors = vectors[np.fromiter(rows.values(), dtype=np.int64, count=len(rows))]
+    return EmbeddingDict(vocab, vectors)
+
+
+def restrict_embedding(embedd_dict, words):
+    """
+    EmbeddingDict of the words of embedd_dict that are in words, in the order of embedd_dict.
+    """
+    rows = embedd_dict.rows(list(words))
+    rows = np.sort(rows[rows >= 0])
+    return build_embedding([embedd_dict.vocab.get_instance(row) for row in rows.tolist()],
+                           np.asarray(embedd_dict.matrix[rows], dtype=np.float32))
+
+
+def _cache_files(cache_dir, name):
+    return os.path.join(cache_dir, name + '.meta.json'), os.path.join(cache_dir, name + '.npy')
+
+
+def load_cached_embedding(cache_dir, name, source):
+    """
+    The embedding cached under name, None if it is missing or was built from another source (a dict that
+    describes the source file and the reading options).
+    """
+    meta_path, matrix_path = _cache_files(cache_dir, name)
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, 'r') as file:
+            meta = json.load(file)
+        if meta.get('version') != EMBEDDING_CACHE_VERSION or meta.get('source') != source:
+            return None
+        matrix = np.load(matrix_path, mmap_mode='r')
+        vocab = Alphabet('embedding')
+        vocab.load(cache_dir, name=name + '.vocab')
+    except (OSError, ValueError, KeyError) as e:
+        print('Ignoring unreadable embedding cache %s: %s' % (meta_path, repr(e)))
+        return None
+    if vocab.size() != matrix.shape[0]:
+        return None
+    return EmbeddingDict(vocab, matrix)
+
+
+def save_cached_embedding(cache_dir, name, source, embedd_dict):
+    """
+    Write the embedding to the cache. The meta file is written last, so an interrupted write is never loaded.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    meta_path, matrix_path = _cache_files(cache_dir, name)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    _write(cache_dir, matrix_path, lambda file: np.save(file, np.ascontiguousarray(embedd_dict.matrix, dtype=np.float32)))
+    embedd_dict.vocab.save(cache_dir, name=name + '.vocab')
+    with open(meta_path, 'w') as file:
+        json.dump({'version': EMBEDDING_CACHE_VERSION, 'source': source}, file)
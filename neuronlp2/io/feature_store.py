@@ -0,0 +1,264 @@
+__author__ = 'max'
+
+"""
+Binary store for token-level features (e.g. the syntax features extracted by the parsers).
+
+A store is a directory with
+    meta.json         : format version, dtype, feature dimensions, source of the features and the committed sizes.
+    <feature>.bin     : one contiguous [num_tokens, dim] matrix per feature type.
+    tokens.bin        : int32 [num_tokens], the vocabulary id of the word of each row.
+    index.bin         : int64 [num_sentences, 3], (sentence id, first row, number of tokens) of each sentence.
+    vocab.txt         : the vocabulary side table, one word per line.
+
+Sentences are appended incrementally and committed by rewriting meta.json. Everything past the
+committed sizes is discarded when the store is re-opened, so a crashed run can resume. A store built from
+another source (e.g. another input file or model) is not resumed but started afresh.
+"""
+import os
+import json
+import numpy as np
+
+FORMAT_VERSION = 1
+_DTYPES = ('float16', 'float32')
+
+
+def _read_meta(directory):
+    with open(os.path.join(directory, 'meta.json'), 'r') as file:
+        meta = json.load(file)
+    if meta['version'] != FORMAT_VERSION:
+        raise ValueError('Unsupported feature store version: %d' % meta['version'])
+    return meta
+
+
+class FeatureStoreWriter(object):
+    def __init__(self, directory, dtype='float32', resume=True, buffer_size=1 << 20, source=None):
+        # source: json-serializable identity of what the features are built from, recorded in meta.json.
+        if dtype not in _DTYPES:
+            raise ValueError('Unknown feature dtype: %s' % dtype)
+        self.directory = directory
+        self.dtype = dtype
+        self.resume = resume
+        self.buffer_size = buffer_size
+        self.source = source
+
+        self.dims = None
+        self.num_sentences = 0
+        self.num_tokens = 0
+        self.sentence_ids = set()
+        self.word2id = {}
+
+        self.__feature_files = None
+        self.__token_file = None
+        self.__index_file = None
+        self.__vocab_file = None
+
+    def __contains__(self, sent_id):
+        return sent_id in self.sentence_ids
+
+    def open(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        meta = None
+        if self.resume and os.path.exists(os.path.join(self.directory, 'meta.json')):
+            meta = _read_meta(self.directory)
+            if meta.get('source') != self.source:
+                print('Feature store %s was built from another source, starting a new store' % self.directory)
+                meta = None
+        if meta is not None:
+            if meta['dtype'] != self.dtype:
+                raise ValueError('Cannot resume a %s store with dtype %s' % (meta['dtype'], self.dtype))
+            self.dims = meta['features'] or None
+            self.num_sentences = meta['num_sentences']
+            self.num_tokens = meta['num_tokens']
+            self.__recover(meta['vocab_size'])
+            self.__open_files('r+b')
+        else:
+            self.__open_files('wb')
+            with open(os.path.join(self.directory, 'vocab.txt'), 'w'):
+                pass
+            # replaces the meta of a previous store, whose files were just truncated.
+            self.commit()
+
+    def __recover(self, vocab_size):
+        # drop everything written after the last commit.
+        itemsize = np.dtype(self.dtype).itemsize
+        for name, dim in (self.dims or {}).items():
+            self.__truncate(name + '.bin', self.num_tokens * dim * itemsize)
+        self.__truncate('tokens.bin', self.num_tokens * 4)
+        self.__truncate('index.bin', self.num_sentences * 3 * 8)
+
+        index = np.fromfile(os.path.join(self.directory, 'index.bin'), dtype=np.int64).reshape(-1, 3)
+        self.sentence_ids = set(index[:, 0].tolist())
+
+        with open(os.path.join(self.directory, 'vocab.txt'), 'r') as file:
+            vocab = [line.rstrip('\n') for line in file][:vocab_size]
+        with open(os.path.join(self.directory, 'vocab.txt'), 'w') as file:
+            file.write(''.join(word + '\n' for word in vocab))
+        self.word2id = {word: i for i, word in enumerate(vocab)}
+
+    def __truncate(self, name, size):
+        with open(os.path.join(self.directory, name), 'r+b') as file:
+            file.truncate(size)
+
+    def __open_files(self, mode):
+        def open_file(name):
+            file = open(os.path.join(self.directory, name), mode, buffering=self.buffer_size)
+            file.seek(0, os.SEEK_END)
+            return file
+
+        if self.dims is not None:
+            self.__feature_files = {name: open_file(name + '.bin') for name in self.dims}
+        self.__token_file = open_file('tokens.bin')
+        self.__index_file = open_file('index.bin')
+        self.__vocab_file = open(os.path.join(self.directory, 'vocab.txt'), 'a', buffering=self.buffer_size)
+
+    def write(self, sent_ids, words, features):
+        """
+
+        Args:
+            sent_ids: list
+                the sentence id of each sentence in the batch.
+            words: list
+                the words of each sentence (without the symbolic root).
+            features: dict
+                feature name --> numpy array with shape = [num_tokens, dim],
+                the rows of all sentences concatenated in the same order as words.
+
+        Returns: int
+            number of new sentences written (sentences already in the store are skipped).
+
+        """
+        if self.dims is None:
+            self.dims = {name: int(rows.shape[1]) for name, rows in features.items()}
+            self.__feature_files = {name: open(os.path.join(self.directory, name + '.bin'), 'wb', buffering=self.buffer_size)
+                                    for name in self.dims}
+        elif set(self.dims) != set(features):
+            raise ValueError('Features do not match the store: %s' % ', '.join(sorted(features)))
+
+        sizes = np.array([len(sent) for sent in words], dtype=np.int64)
+        keep = np.array([sent_id not in self.sentence_ids for sent_id in sent_ids], dtype=bool)
+        if not keep.any():
+            return 0
+
+        # rows of the sentences that are not in the store yet.
+        row_mask = np.repeat(keep, sizes)
+        index = []
+        token_ids = []
+        start = self.num_tokens
+        for i in np.nonzero(keep)[0]:
+            for word in words[i]:
+                word_id = self.word2id.get(word)
+                if word_id is None:
+                    word_id = len(self.word2id)
+                    self.word2id[word] = word_id
+                    self.__vocab_file.write(word + '\n')
+                token_ids.append(word_id)
+            index.append((sent_ids[i], start, sizes[i]))
+            self.sentence_ids.add(sent_ids[i])
+            start += int(sizes[i])
+
+        for name, rows in features.items():
+            rows = rows[row_mask] if not row_mask.all() else rows
+            np.ascontiguousarray(rows, dtype=self.dtype).tofile(self.__feature_files[name])
+        np.array(token_ids, dtype=np.int32).tofile(self.__token_file)
+        np.array(index, dtype=np.int64).reshape(-1, 3).tofile(self.__index_file)
+
+        self.num_sentences += len(index)
+        self.num_tokens = start
+        self.commit()
+        return len(index)
+
+    def commit(self):
+        files = list(self.__feature_files.values()) if self.__feature_files is not None else []
+        for file in files + [self.__token_file, self.__index_file, self.__vocab_file]:
+            file.flush()
+        meta = {'version': FORMAT_VERSION, 'dtype': self.dtype, 'features': self.dims or {}, 'source': self.source,
+                'num_sentences': self.num_sentences, 'num_tokens': self.num_tokens, 'vocab_size': len(self.word2id)}
+        tmp_path = os.path.join(self.directory, 'meta.json.tmp')
+        with open(tmp_path, 'w') as file:
+            json.dump(meta, file, indent=2)
+        os.replace(tmp_path, os.path.join(self.directory, 'meta.json'))
+
+    def close(self):
+        self.commit()
+        files = list(self.__feature_files.values()) if self.__feature_files is not None else []
+        for file in files + [self.__token_file, self.__index_file, self.__vocab_file]:
+            file.close()
+        self.__feature_files = None
+
+    def abort(self):
+        """
+        Close the files without committing, after a failure. The store keeps the sentences of the last commit
+        (the data written after it is truncated on resume), so a later run only writes the others.
+        """
+        files = list(self.__feature_files.values()) if self.__feature_files is not None else []
+        for file in files + [self.__token_file, self.__index_file, self.__vocab_file]:
+            if file is not None:
+                file.close()
+        self.__feature_files = None
+
+
+class FeatureStore(object):
+    """
+    Read-only view of a feature store. The feature matrices are memory-mapped, so slicing a
+    sentence or a token returns a view of the file without copying.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        meta = _read_meta(directory)
+        self.dtype = np.dtype(meta['dtype'])
+        self.dims = meta['features']
+        self.num_sentences = meta['num_sentences']
+        self.num_tokens = meta['num_tokens']
+
+        self.features = {}
+        for name, dim in self.dims.items():
+            if self.num_tokens == 0:
+                self.features[name] = np.empty([0, dim], dtype=self.dtype)
+            else:
+                self.features[name] = np.memmap(os.path.join(directory, name + '.bin'), dtype=self.dtype, mode='r',
+                                                shape=(self.num_tokens, dim))
+        self.token_ids = np.fromfile(os.path.join(directory, 'tokens.bin'), dtype=np.int32, count=self.num_tokens)
+        index = np.fromfile(os.path.join(directory, 'index.bin'), dtype=np.int64, count=self.num_sentences * 3).reshape(-1, 3)
+        with open(os.path.join(directory, 'vocab.txt'), 'r') as file:
+            self.vocab = [line.rstrip('\n') for line in file][:meta['vocab_size']]
+
+        # dense lookup tables from sentence id to (first row, number of tokens), -1 for missing sentences.
+        max_id = int(index[:, 0].max()) + 1 if len(index) > 0 else 0
+        self.starts = np.full(max_id, -1, dtype=np.int64)
+        self.lengths = np.full(max_id, -1, dtype=np.int64)
+        self.starts[index[:, 0]] = index[:, 1]
+        self.lengths[index[:, 0]] = index[:, 2]
+
+    def __len__(self):
+        return self.num_sentences
+
+    def __contains__(self, sent_id):
+        return 0 <= sent_id < len(self.starts) and self.starts[sent_id] >= 0
+
+    def sentence_ids(self):
+        return np.nonzero(self.starts >= 0)[0]
+
+    def rows(self, sent_id, position=None):
+        """
+        Row range of a sentence (or the row of the token at the given position of the sentence).
+        """
+        if sent_id not in self:
+            raise KeyError('sentence not found: %d' % sent_id)
+        start = self.starts[sent_id]
+        length = self.lengths[sent_id]
+        if position is None:
+            return slice(start, start + length)
+        if not 0 <= position < length:
+            raise IndexError('token position %d out of range for sentence %d' % (position, sent_id))
+        return start + position
+
+    def get(self, name, sent_id, position=None):
+        """
+        Returns: numpy array
+            the features of a sentence [length, dim] or of a single token [dim].
+        """
+        return self.features[name][self.rows(sent_id, position)]
+
+    def words(self, sent_id):
+        return [self.vocab[word_id] for word_id in self.token_ids[self.rows(sent_id)]]
@@ -0,0 +1,298 @@
+__author__ = 'max'
+
+"""
+Parallel reading of large CoNLL files.
+
+The file is split into byte ranges at sentence boundaries (blank lines). Each range is read by a worker process
+with its own copy of the (closed, read-only) alphabets and returned as flat id arrays, one per field, and the
+shards are concatenated in file order. The arrays are packed into the ragged fields of the serial reader
+without building any per-token python object in the main process, so the output is identical to the serial
+reader while the tokenization and id-mapping scale with the number of workers.
+"""
+import io
+import os
+import locale
+from multiprocessing import Pool
+import numpy as np
+import torch
+from neuronlp2.io.ragged import RaggedSequence, RaggedChars, LengthMask, _int_dtype, _offsets
+from neuronlp2.io.utils import _collate
+from neuronlp2.io.common import MAX_CHAR_LENGTH
+
+# state of the worker processes, set once by _init_worker.
+_worker = {}
+
+
+def split_file(path, num_shards):
+    """
+    Split the file into at most num_shards (start, end) byte ranges, each starting at the beginning of a sentence.
+    """
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as file:
+        for i in range(1, num_shards):
+            position = size * i // num_shards
+            if position <= offsets[-1]:
+                continue
+            file.seek(position)
+            # skip the (partial) line we landed in, then the rest of the sentence.
+            file.readline()
+            line = file.readline()
+            while line and line.strip():
+                line = file.readline()
+            position = file.tell()
+            if position >= size:
+                break
+            offsets.append(position)
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def _take(values, lengths, rows):
+    # the values of the selected rows of a flat (values, lengths) column.
+    starts = _offsets(lengths)[rows]
+    lengths = lengths[rows]
+    index = np.repeat(starts - _offsets(lengths)[:-1], lengths) + np.arange(lengths.sum())
+    return values[index], lengths
+
+
+class Columns(object):
+    """
+    The fields of a list of sentences as flat arrays: fields[i] is (values, lengths), the lengths are per sentence,
+    except for the characters (values, number of chars of each token). words holds the text of the sentences.
+    """
+    def __init__(self, fields, char_field, words=None):
+        self.fields = fields
+        self.char_field = char_field
+        self.words = words
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def lengths(self):
+        return self.fields[0][1]
+
+    @classmethod
+    def concatenate(cls, parts, num_fields, char_field):
+        if len(parts) == 0:
+            empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+            return cls([empty] * num_fields, char_field, words=(np.zeros(0, dtype=np.int64), ''))
+        fields = [(np.concatenate([part.fields[i][0] for part in parts]), np.concatenate([part.fields[i][1] for part in parts]))
+                  for i in range(num_fields)]
+        words = (np.concatenate([part.words[0] for part in parts]), '\n'.join(part.words[1] for part in parts if len(part.words[0])))
+        return cls(fields, char_field, words=words)
+
+    @classmethod
+    def from_rows(cls, rows, num_fields, char_field, words=None):
+        """
+        The columns of the rows (the id sequences of each sentence), words: the words of each sentence or None.
+        """
+        if len(rows) == 0:
+            return cls.concatenate([], num_fields, char_field)
+        fields = []
+        for i, column in enumerate(zip(*rows)):
+            if i == char_field:
+                column = [cids for seq in column for cids in seq]
+            lengths = np.fromiter((len(seq) for seq in column), dtype=np.int64, count=len(column))
+            values = np.fromiter((value for seq in column for value in seq), dtype=np.int64, count=int(lengths.sum()))
+            fields.append((values, lengths))
+        if words is not None:
+            word_counts = np.fromiter((len(ws) for ws in words), dtype=np.int64, count=len(words))
+            words = (word_counts, '\n'.join(word for ws in words for word in ws))
+        return cls(fields, char_field, words=words)
+
+    def take(self, rows):
+        """
+        The columns of the selected sentences (without the words).
+        """
+        fields = []
+        for i, (values, lengths) in enumerate(self.fields):
+            if i == self.char_field:
+                # select the tokens of the rows, then their characters.
+                tokens = _take(np.arange(self.lengths.sum()), self.lengths, rows)[0]
+                fields.append(_take(values, lengths, tokens))
+            else:
+                fields.append(_take(values, lengths, rows))
+        return Columns(fields, self.char_field)
+
+    def head(self, size):
+        """
+        The columns of the first size sentences.
+        """
+        return self.take(np.arange(size)) if size < len(self) else self
+
+    def original_words(self):
+        lengths, text = self.words
+        words = text.split('\n') if lengths.sum() > 0 else []
+        offsets = _offsets(lengths).tolist()
+        return [words[offsets[i]:offsets[i + 1]] for i in range(len(lengths))]
+
+    def pack(self, keys, pads, is_singleton, mask_key='MASK'):
+        """
+        The ragged fields of the sentences, identical to pack_data on the same rows.
+        """
+        lengths = self.lengths
+        data_tensor = {}
+        for i, (key, pad) in enumerate(zip(keys, pads)):
+            values, counts = self.fields[i]
+            if i == self.char_field:
+                char_length = int(min(counts.max(), MAX_CHAR_LENGTH)) if len(counts) > 0 else 0
+                data_tensor[key] = RaggedChars(values.astype(_int_dtype(values)), _offsets(lengths), _offsets(counts), pad, char_length)
+            else:
+                data_tensor[key] = RaggedSequence(values.astype(_int_dtype(values)), _offsets(counts), pad)
+        single = is_singleton(self.fields[0][0]).astype(np.int64)
+        data_tensor['SINGLE'] = RaggedSequence(single.astype(_int_dtype(single)), _offsets(lengths), 0)
+        data_tensor['LENGTH'] = torch.from_numpy(lengths.astype(np.int64))
+        data_tensor[mask_key] = LengthMask(data_tensor['LENGTH'])
+        return data_tensor
+
+
+def _init_worker(reader_class, alphabets, row_fn, options):
+    _worker['reader_class'] = reader_class
+    _worker['alphabets'] = alphabets
+    _worker['row_fn'] = row_fn
+    _worker['options'] = options
+
+
+def _read_shard(shard):
+    path, start, end, char_field = shard
+    with open(path, 'rb') as file:
+        file.seek(start)
+        chunk = file.read(end - start)
+    # decoded as open(path, 'r') does.
+    source = io.TextIOWrapper(io.BytesIO(chunk), encoding=locale.getpreferredencoding(False))
+    reader = _worker['reader_class'](source, *_worker['alphabets'])
+    rows = []
+    words = []
+    for inst in reader.iterate(**_worker['options']):
+        rows.append(_worker['row_fn'](inst))
+        words.append(inst.sentence.words)
+    if len(rows) == 0:
+        return None
+    return Columns.from_rows(rows, len(rows[0]), char_field, words=words)
+
+
+def read_columns(reader_class, source_path, alphabets, row_fn, num_fields, num_workers, max_size=None, char_field=1, **options):
+    """
+    Read a file with num_workers processes.
+
+    Args:
+        reader_class: class
+            CoNLLXReader or CoNLL03Reader.
+        source_path: str
+            path of the data file.
+        alphabets: list
+            the alphabets passed to the reader, they must be closed.
+        row_fn: callable
+            instance --> list of the num_fields id sequences of the sentence (must be picklable).
+        num_fields: int
+            number of fields returned by row_fn.
+        num_workers: int
+            number of worker processes.
+        max_size: int or None
+            maximum number of sentences.
+        char_field: int
+            position of the list of char id lists in the rows.
+        **options:
+            the arguments of reader_class.iterate.
+
+    Returns: Columns
+        the sentences of the file, in file order.
+
+    """
+    for alphabet in alphabets:
+        if alphabet.keep_growing:
+            raise ValueError('parallel reading requires closed alphabets (call alphabet.close() first).')
+
+    # a few shards per worker to balance the load.
+    shards = [(source_path, start, end, char_field) for start, end in split_file(source_path, 4 * num_workers)]
+    parts = []
+    counter = 0
+    with Pool(num_workers, initializer=_init_worker, initargs=(reader_class, alphabets, row_fn, options)) as pool:
+        for part in pool.imap(_read_shard, shards):
+            if part is None:
+                continue
+            if max_size and counter + len(part) >= max_size:
+                parts.append(Columns(part.head(max_size - counter).fields, char_field,
+                                     words=(part.words[0][:max_size - counter], part.words[1])))
+                break
+            parts.append(part)
+            counter += len(part)
+    return Columns.concatenate(parts, num_fields, char_field)
+
+
+def pack_columns(columns, keys, pads, is_singleton, buckets=None, ragged=False, mask_key='MASK', finalize=None):
+    """
+    The data of the sentences read by read_columns, as returned by read_data / read_bucketed_data.
+
+    Args:
+        columns: Columns
+            the sentences.
+        keys, pads:
+            names and padding ids of the fields of the columns, 'CHAR' second.
+        is_singleton: callable
+            array of word ids --> boolean array telling which are singletons (for the 'SINGLE' field).
+        buckets: list or None
+            the buckets of read_bucketed_data, None for read_data.
+        ragged: bool
+            return ragged fields instead of padded tensors.
+        mask_key: str
+            name of the mask field.
+        finalize: callable or None
+            (ragged fields, indices of their sentences in columns) --> the ragged fields with the extra fields of a
+            reader (e.g. the decoder mask).
+
+    Returns: tuple
+        (data, size) as read_data, or (data per bucket, bucket sizes) as read_bucketed_data.
+
+    """
+    def build(rows, width):
+        part = columns if rows is None else columns.take(rows)
+        data_tensor = part.pack(keys, pads, is_singleton, mask_key=mask_key)
+        if finalize is not None:
+            data_tensor = finalize(data_tensor, np.arange(len(columns)) if rows is None else rows)
+        if ragged:
+            return data_tensor
+        return _collate(data_tensor, slice(None), width, exclude_keys=())
+
+    lengths = columns.lengths
+    if buckets is None:
+        max_length = int(lengths.max()) if len(columns) > 0 else 0
+        return build(None, max_length), len(columns)
+
+    # the first bucket longer than the sentence, sentences longer than the last bucket are dropped.
+    bucket_ids = np.searchsorted(buckets, lengths, side='right')
+    data_tensors = []
+    bucket_sizes = []
+    for bucket_id, bucket_length in enumerate(buckets):
+        rows = np.nonzero(bucket_ids == bucket_id)[0]
+        bucket_sizes.append(len(rows))
+        if len(rows) == 0:
+            data_tensors.append((1, 1))
+            continue
+        data_tensors.append(build(rows, bucket_length))
+    return data_tensors, bucket_sizes
+
+
+def read_parallel(reader_class, source_path, alphabets, row_fn, keys, pads, num_workers, max_size=None, buckets=None,
+                  ragged=False, mask_key='MASK', finalize=None, **options):
+    """
+    Parallel counterpart of the read_data / read_bucketed_data functions of the data modules.
+
+    Args:
+        keys, pads:
+            names and padding ids of the fields returned by row_fn (see read_columns), 'CHAR' second.
+        buckets, ragged, mask_key, finalize:
+            see pack_columns.
+
+    Returns: tuple
+        (data, size, original_words) as read_data, or (data per bucket, bucket sizes, original_words) as read_bucketed_data.
+
+    """
+    print('Reading data from %s with %d workers' % (source_path, num_workers))
+    columns = read_columns(reader_class, source_path, alphabets, row_fn, len(keys), num_workers, max_size=max_size, **options)
+    print("Total number of data: %d" % len(columns))
+    data = pack_columns(columns, keys, pads, alphabets[0].is_singleton_many, buckets=buckets, ragged=ragged,
+                        mask_key=mask_key, finalize=finalize)
+    return data + (columns.original_words(), )
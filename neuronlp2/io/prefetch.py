@@ -0,0 +1,128 @@
+__author__ = 'max'
+
+"""
+Assembly of the training batches ahead of the training loop.
+
+A background thread runs the batch iterator (selection of the rows, padding, unk replacement) while the training
+loop runs the forward and backward passes of the previous batches; the torch operations of both sides release the
+GIL. On a GPU, every batch is copied into one of a ring of preallocated pinned host buffers and sent to the device
+asynchronously on a side stream, so the .to(device) of the training loop finds the tensors already there.
+"""
+import queue
+import threading
+import torch
+
+_END = object()
+
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+
+class _HostBuffers(object):
+    """
+    Reusable pinned buffers of one batch, one flat buffer per field, grown to the largest batch seen.
+    """
+    def __init__(self):
+        self.storage = {}
+        self.event = None
+
+    def __load(self, key, tensor):
+        storage = self.storage.get(key)
+        if storage is None or storage.dtype != tensor.dtype or storage.numel() < tensor.numel():
+            storage = torch.empty(tensor.numel(), dtype=tensor.dtype, pin_memory=True)
+            self.storage[key] = storage
+        buffer = storage[:tensor.numel()].view(tensor.size())
+        buffer.copy_(tensor)
+        return buffer
+
+    def transfer(self, batch, device, stream):
+        # the previous copy out of these buffers has to be over before they are overwritten.
+        if self.event is not None:
+            self.event.synchronize()
+        with torch.cuda.stream(stream):
+            output = {}
+            for key, value in batch.items():
+                if torch.is_tensor(value):
+                    value = self.__load(key, value).to(device, non_blocking=True)
+                output[key] = value
+            self.event = torch.cuda.Event()
+            self.event.record(stream)
+        return output, self.event
+
+
+def _put(ready, item, stop):
+    # gives up when the consumer is gone.
+    while not stop.is_set():
+        try:
+            ready.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def prefetch(batches, device, num_prefetch=2):
+    """
+    Iterate the batches while the next ones are assembled by a background thread.
+
+    Args:
+        batches: iterable
+            the batches (dicts of tensors), e.g. from iterate_data. It is iterated by the background thread only.
+        device: torch.device
+            the device of the model. On a GPU the tensors of the batches are returned on the device.
+        num_prefetch: int
+            number of batches assembled ahead (0: the batches are returned as they are).
+
+    Returns: generator
+        the batches, in order.
+
+    On the CPU the unk replacement of the background thread and the dropout of the training loop draw from the same
+    random generator in an order that varies between runs, so the training is only reproducible without prefetching.
+
+    """
+    if num_prefetch <= 0:
+        yield from batches
+        return
+
+    cuda = device.type == 'cuda'
+    stream = torch.cuda.Stream(device) if cuda else None
+    # a slot is only rewritten once its copy to the device is over, so num_prefetch + 1 slots never wait on the
+    # training loop.
+    slots = [_HostBuffers() for _ in range(num_prefetch + 1)] if cuda else None
+    ready = queue.Queue(maxsize=num_prefetch)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for step, batch in enumerate(batches):
+                if cuda:
+                    batch = slots[step % len(slots)].transfer(batch, device, stream)
+                if not _put(ready, batch, stop):
+                    return
+            _put(ready, _END, stop)
+        except BaseException as e:
+            _put(ready, _Failure(e), stop)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = ready.get()
+            if item is _END:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            if cuda:
+                item, event = item
+                current = torch.cuda.current_stream(device)
+                current.wait_event(event)
+                # the tensors were allocated on the side stream but are used on the current one.
+                for value in item.values():
+                    if torch.is_tensor(value):
+                        value.record_stream(current)
+            yield item
+    finally:
+        stop.set()
+        producer.join()
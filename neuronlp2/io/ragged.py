@@ -0,0 +1,239 @@
+__author__ = 'max'
+
+"""
+Ragged (packed) storage of the token-level fields of a dataset.
+
+The rows of a field are concatenated into one flat array, with an offset vector giving the start of each
+sentence, and stored in the smallest integer type that holds the values. A field is indexed like the dense
+[num_sentences, max_length] tensors, field[rows, :length], and pads only the selected rows, so padding is
+paid per batch instead of for the whole corpus.
+"""
+from itertools import chain
+import numpy as np
+import torch
+
+
+def _int_dtype(values):
+    # the smallest integer type holding all the values.
+    if values.size == 0:
+        return np.int16
+    low, high = values.min(), values.max()
+    for dtype in (np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return np.int64
+
+
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def _rows(key, num_rows):
+    rows, cols = key
+    if isinstance(rows, slice):
+        rows = torch.arange(num_rows)[rows]
+    return rows, cols
+
+
+def _all_rows(key):
+    # field[:, :length] selects every row in order: the values are already in the order of the padded output.
+    return isinstance(key[0], slice) and key[0] == slice(None)
+
+
+class RaggedSequence(object):
+    """
+    Variable-length rows of ids (e.g. the word ids of each sentence).
+    """
+    def __init__(self, values, offsets, pad, dtype=torch.int64):
+        self.values = torch.as_tensor(values)
+        self.offsets = torch.as_tensor(offsets)
+        self.pad = pad
+        self.dtype = dtype
+
+    @classmethod
+    def pack(cls, sequences, pad, dtype=torch.int64):
+        lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+        values = np.fromiter(chain.from_iterable(sequences), dtype=np.int64, count=int(lengths.sum()))
+        return cls(values.astype(_int_dtype(values)), _offsets(lengths), pad, dtype=dtype)
+
+    def __len__(self):
+        return self.offsets.size(0) - 1
+
+    @property
+    def nbytes(self):
+        return self.values.numel() * self.values.element_size() + self.offsets.numel() * self.offsets.element_size()
+
+    def __getitem__(self, key):
+        rows, cols = _rows(key, len(self))
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        length = cols.stop if cols.stop is not None else lengths.max().item()
+        positions = torch.arange(length)
+        valid = positions.unsqueeze(0) < lengths.unsqueeze(1)
+        output = torch.full((rows.size(0), length), self.pad, dtype=self.dtype)
+        if _all_rows(key) and bool((lengths <= length).all()):
+            output[valid] = self.values.to(self.dtype)
+        else:
+            output[valid] = self.values[(starts.unsqueeze(1) + positions)[valid]].to(self.dtype)
+        return output
+
+    def state(self):
+        return {'pad': self.pad, 'dtype': str(self.dtype)}, {'values': self.values.numpy(), 'offsets': self.offsets.numpy()}
+
+
+class RaggedChars(object):
+    """
+    Character ids of each token of each sentence, padded to [rows, length, char_length] when indexed.
+    """
+    def __init__(self, values, token_offsets, char_offsets, pad, char_length):
+        self.values = torch.as_tensor(values)
+        self.token_offsets = torch.as_tensor(token_offsets)
+        self.char_offsets = torch.as_tensor(char_offsets)
+        self.pad = pad
+        self.char_length = char_length
+
+    @classmethod
+    def pack(cls, char_id_seqs, pad, char_length):
+        """
+        char_id_seqs: list of sentences, each is a list of the char id lists of its tokens.
+        """
+        num_tokens = np.fromiter(map(len, char_id_seqs), dtype=np.int64, count=len(char_id_seqs))
+        char_lengths = np.fromiter(map(len, chain.from_iterable(char_id_seqs)), dtype=np.int64, count=int(num_tokens.sum()))
+        if char_lengths.size > 0 and char_lengths.max() > char_length:
+            char_lengths = np.minimum(char_lengths, char_length)
+            values = np.fromiter((cid for sent in char_id_seqs for cids in sent for cid in cids[:char_length]),
+                                 dtype=np.int64, count=int(char_lengths.sum()))
+        else:
+            values = np.fromiter(chain.from_iterable(chain.from_iterable(char_id_seqs)), dtype=np.int64, count=int(char_lengths.sum()))
+        return cls(values.astype(_int_dtype(values)), _offsets(num_tokens), _offsets(char_lengths), pad, char_length)
+
+    def __len__(self):
+        return self.token_offsets.size(0) - 1
+
+    @property
+    def nbytes(self):
+        return sum(tensor.numel() * tensor.element_size() for tensor in (self.values, self.token_offsets, self.char_offsets))
+
+    def __getitem__(self, key):
+        rows, cols = _rows(key, len(self))
+        starts = self.token_offsets[rows]
+        num_tokens = self.token_offsets[rows + 1] - starts
+        length = cols.stop if cols.stop is not None else num_tokens.max().item()
+        positions = torch.arange(length)
+        valid = positions.unsqueeze(0) < num_tokens.unsqueeze(1)
+        char_positions = torch.arange(self.char_length)
+        all_tokens = _all_rows(key) and bool((num_tokens <= length).all())
+        if all_tokens:
+            # every token of the data, in order: the values are already in the order of the padded output (the
+            # characters of a token are never longer than char_length).
+            char_lengths = self.char_offsets[1:] - self.char_offsets[:-1]
+        else:
+            # global index of every real token of the batch.
+            tokens = (starts.unsqueeze(1) + positions)[valid]
+            char_starts = self.char_offsets[tokens]
+            char_lengths = self.char_offsets[tokens + 1] - char_starts
+        char_valid = char_positions.unsqueeze(0) < char_lengths.unsqueeze(1)
+        chars = torch.full((char_lengths.size(0), self.char_length), self.pad, dtype=torch.int64)
+        if all_tokens:
+            chars[char_valid] = self.values.long()
+        else:
+            chars[char_valid] = self.values[(char_starts.unsqueeze(1) + char_positions)[char_valid]].long()
+
+        output = torch.full((rows.size(0), length, self.char_length), self.pad, dtype=torch.int64)
+        output[valid] = chars
+        return output
+
+    def state(self):
+        return {'pad': self.pad, 'char_length': self.char_length}, \
+               {'values': self.values.numpy(), 'token_offsets': self.token_offsets.numpy(), 'char_offsets': self.char_offsets.numpy()}
+
+
+class LengthMask(object):
+    """
+    Float mask of the first `length` (or 2 * length - 1 for the decoder of the stack-pointer parser) positions.
+    """
+    def __init__(self, lengths, decoder=False):
+        self.lengths = torch.as_tensor(lengths)
+        self.decoder = decoder
+
+    def __len__(self):
+        return self.lengths.size(0)
+
+    @property
+    def nbytes(self):
+        return 0
+
+    def __getitem__(self, key):
+        rows, cols = _rows(key, len(self))
+        lengths = self.lengths[rows]
+        if self.decoder:
+            lengths = 2 * lengths - 1
+        length = cols.stop if cols.stop is not None else lengths.max().item()
+        return (torch.arange(length).unsqueeze(0) < lengths.unsqueeze(1)).float()
+
+    def state(self):
+        return {'decoder': self.decoder}, {'lengths': self.lengths.numpy()}
+
+
+_FIELDS = {cls.__name__: cls for cls in (RaggedSequence, RaggedChars, LengthMask)}
+
+
+def is_ragged(field):
+    return isinstance(field, tuple(_FIELDS.values()))
+
+
+def field_state(field):
+    meta, arrays = field.state()
+    return dict(meta, type=field.__class__.__name__), arrays
+
+
+def field_from_state(meta, arrays):
+    meta = dict(meta)
+    cls = _FIELDS[meta.pop('type')]
+    if cls is RaggedSequence:
+        return RaggedSequence(arrays['values'], arrays['offsets'], meta['pad'], dtype=getattr(torch, meta['dtype'].split('.')[-1]))
+    elif cls is RaggedChars:
+        return RaggedChars(arrays['values'], arrays['token_offsets'], arrays['char_offsets'], meta['pad'], meta['char_length'])
+    else:
+        return LengthMask(arrays['lengths'], decoder=meta['decoder'])
+
+
+def pack_data(data, keys, pads, char_length, is_singleton, mask_key='MASK'):
+    """
+    Pack the instances read by a reader into ragged fields.
+
+    Args:
+        data: list
+            one list per sentence with the fields in the order of keys, 'CHAR' is the list of char id lists.
+        keys: list
+            names of the fields; the first one is 'WORD'.
+        pads: list
+            padding id of each field.
+        char_length: int
+            width of the padded characters.
+        is_singleton: callable
+            array of word ids --> boolean array telling which are singletons (for the 'SINGLE' field).
+        mask_key: str
+            name of the mask field.
+
+    Returns: dict
+        the ragged fields, 'SINGLE', 'LENGTH' and the mask.
+
+    """
+    columns = list(zip(*data)) if len(data) > 0 else [[] for _ in keys]
+    lengths = torch.tensor([len(inst[0]) for inst in data], dtype=torch.int64)
+    data_tensor = {}
+    for key, pad, column in zip(keys, pads, columns):
+        if key == 'CHAR':
+            data_tensor[key] = RaggedChars.pack(column, pad, char_length)
+        else:
+            data_tensor[key] = RaggedSequence.pack(column, pad)
+    words = data_tensor['WORD']
+    single = is_singleton(words.values.numpy()).astype(np.int64)
+    data_tensor['SINGLE'] = RaggedSequence(single.astype(_int_dtype(single)), words.offsets, 0)
+    data_tensor['LENGTH'] = lengths
+    data_tensor[mask_key] = LengthMask(lengths)
+    return data_tensor
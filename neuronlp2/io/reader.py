@@ -8,7 +8,8 @@ from neuronlp2.io.common import DIGIT_RE, MAX_CHAR_LENGTH
 
 class CoNLLXReader(object):
     def __init__(self, file_path, word_alphabet, char_alphabet, pos_alphabet, type_alphabet):
-        self.__source_file = open(file_path, 'r')
+        # file_path can also be an opened text file.
+        self.__source_file = open(file_path, 'r') if isinstance(file_path, str) else file_path
         self.__word_alphabet = word_alphabet
         self.__char_alphabet = char_alphabet
         self.__pos_alphabet = pos_alphabet
@@ -17,6 +18,18 @@ class CoNLLXReader(object):
     def close(self):
         self.__source_file.close()
 
+    def iterate(self, normalize_digits=False, symbolic_root=False, symbolic_end=False):
+        """
+        Generator over the remaining instances of the file, closes the file when exhausted.
+        """
+        try:
+            inst = self.getNext(normalize_digits=normalize_digits, symbolic_root=symbolic_root, symbolic_end=symbolic_end)
+            while inst is not None:
+                yield inst
+                inst = self.getNext(normalize_digits=normalize_digits, symbolic_root=symbolic_root, symbolic_end=symbolic_end)
+        finally:
+            self.close()
+
     def getNext(self, normalize_digits=False, symbolic_root=False, symbolic_end=False):
         words = []
         word_ids = []
@@ -141,7 +154,8 @@ class CoNLLXReader(object):
 
 class CoNLL03Reader(object):
     def __init__(self, file_path, word_alphabet, char_alphabet, pos_alphabet, chunk_alphabet, ner_alphabet):
-        self.__source_file = open(file_path, 'r')
+        # file_path can also be an opened text file.
+        self.__source_file = open(file_path, 'r') if isinstance(file_path, str) else file_path
         self.__word_alphabet = word_alphabet
         self.__char_alphabet = char_alphabet
         self.__pos_alphabet = pos_alphabet
@@ -151,6 +165,18 @@ class CoNLL03Reader(object):
     def close(self):
         self.__source_file.close()
 
+    def iterate(self, normalize_digits=True):
+        """
+        Generator over the remaining instances of the file, closes the file when exhausted.
+        """
+        try:
+            inst = self.getNext(normalize_digits)
+            while inst is not None:
+                yield inst
+                inst = self.getNext(normalize_digits)
+        finally:
+            self.close()
+
     def getNext(self, normalize_digits=True):
         words = []
         word_ids = []
@@ -0,0 +1,157 @@
+__author__ = 'max'
+
+"""
+Streaming pipeline: padded (bucketed) batches read directly from one or more shards on disk.
+
+Only a bounded number of sentences is held in memory: the shuffle buffer, plus at most one partial batch per
+bucket. The shards are read in order, or, when shuffling, in a random order with several shards interleaved.
+"""
+import os
+import glob
+import numpy as np
+import torch
+from neuronlp2.io.utils import _collate
+
+
+def shard_paths(path):
+    """
+    The shards given by path: a directory (all its files), or a comma-separated list of files or glob patterns.
+    """
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, f) for f in os.listdir(path)
+                      if not f.startswith('.') and os.path.isfile(os.path.join(path, f)))
+    paths = []
+    for pattern in path.split(','):
+        matches = sorted(glob.glob(pattern))
+        paths.extend(matches if matches else [pattern])
+    return paths
+
+
+def count_sentences(paths):
+    """
+    Number of sentences (blocks separated by blank lines) of the shards, in one pass and constant memory.
+    """
+    count = 0
+    for path in paths:
+        in_sentence = False
+        with open(path, 'r') as file:
+            for line in file:
+                if len(line.strip()) == 0:
+                    in_sentence = False
+                elif not in_sentence:
+                    in_sentence = True
+                    count += 1
+    return count
+
+
+def _iterate_shards(paths, read, shuffle, interleave, rng):
+    paths = list(paths)
+    if not shuffle:
+        for path in paths:
+            for inst in read(path):
+                yield inst
+        return
+
+    rng.shuffle(paths)
+    next_path = 0
+    readers = []
+    while readers or next_path < len(paths):
+        while len(readers) < interleave and next_path < len(paths):
+            readers.append(read(paths[next_path]))
+            next_path += 1
+        i = rng.randint(len(readers))
+        try:
+            yield next(readers[i])
+        except StopIteration:
+            readers.pop(i)
+
+
+def _shuffle(items, buffer_size, rng):
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = rng.randint(buffer_size)
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    for item in buffer:
+        yield item
+
+
+def _group(items, batch_size, buckets, length, shuffle, rng):
+    if buckets is None:
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+        return
+
+    pending = [[] for _ in buckets]
+    for item in items:
+        inst_size = length(item)
+        # same assignment as read_bucketed_data: sentences longer than the last bucket are dropped.
+        for bucket_id, bucket_size in enumerate(buckets):
+            if inst_size < bucket_size:
+                pending[bucket_id].append(item)
+                if len(pending[bucket_id]) == batch_size:
+                    yield pending[bucket_id]
+                    pending[bucket_id] = []
+                break
+    bucket_ids = np.arange(len(buckets))
+    if shuffle:
+        rng.shuffle(bucket_ids)
+    for bucket_id in bucket_ids:
+        if pending[bucket_id]:
+            yield pending[bucket_id]
+
+
+def stream_batches(source_paths, read, tensorize, batch_size, buckets=None, shuffle_buffer=0, interleave=4,
+                   unk_replace=0., keep_words=False, seed=None):
+    """
+    Args:
+        source_paths: list
+            the shards.
+        read: callable
+            path --> iterator over the instances of the shard.
+        tensorize: callable
+            list of instances --> dict of ragged fields (see neuronlp2.io.ragged.pack_data).
+        batch_size: int
+            number of sentences in each batch.
+        buckets: list or None
+            bucket boundaries; batches hold sentences of the same bucket. None keeps the input order.
+        shuffle_buffer: int
+            size of the shuffle buffer (0 for no shuffling: the shards and the sentences are read in order).
+        interleave: int
+            number of shards read at the same time when shuffling.
+        unk_replace: float
+            the rate to replace a singleton word with UNK.
+        keep_words: bool
+            add the words of each sentence to the batches, under 'ORIGINAL_WORDS'.
+        seed: int or None
+            seed of the shuffling (None uses the global numpy random state).
+
+    Returns: generator
+        padded batches with the same fields as iterate_batch, plus 'INDEX', the position of each sentence in the stream.
+
+    """
+    shuffle = shuffle_buffer > 0
+    rng = np.random if seed is None else np.random.RandomState(seed)
+    items = enumerate(_iterate_shards(source_paths, read, shuffle, interleave, rng))
+    if shuffle:
+        items = _shuffle(items, shuffle_buffer, rng)
+
+    for batch in _group(items, batch_size, buckets, lambda item: item[1].length(), shuffle, rng):
+        index, insts = zip(*batch)
+        data = tensorize(insts)
+        batch_length = data['LENGTH'].max().item()
+        batch = _collate(data, slice(None), batch_length, unk_replace=unk_replace)
+        batch['INDEX'] = torch.tensor(index, dtype=torch.int64)
+        if keep_words:
+            batch['ORIGINAL_WORDS'] = [inst.sentence.words for inst in insts]
+        yield batch
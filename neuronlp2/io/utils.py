@@ -1,36 +1,117 @@
 __author__ = 'max'
 
+import weakref
 import numpy as np
 import torch
+from neuronlp2.io.common import UNK_ID
+from neuronlp2.io.ragged import is_ragged
+
+
+_STACK_KEYS = set(['STACK_HEAD', 'CHILD', 'SIBLING', 'STACK_TYPE', 'SKIP_CONNECT', 'MASK_DEC'])
+
+
+def _singleton_index(single):
+    """
+    Positions of the singleton words of every sentence, as numpy arrays (offsets, columns): the singletons of
+    sentence i are at columns[offsets[i]:offsets[i + 1]].
+    """
+    if is_ragged(single):
+        values = single.values.numpy()
+        row_offsets = single.offsets.numpy()
+        positions = np.flatnonzero(values)
+        rows = np.searchsorted(row_offsets, positions, side='right') - 1
+        columns = positions - row_offsets[rows]
+        num_rows = len(single)
+    else:
+        rows, columns = np.nonzero(single.cpu().numpy())
+        num_rows = single.size(0)
+    offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_rows), out=offsets[1:])
+    return offsets, columns
+
+
+class _Collator(object):
+    """
+    Batches of one dataset. The fields to select and the positions of the singleton words are worked out once, so
+    that a batch only selects its rows and draws the unk replacement of its own singletons.
+    """
+    def __init__(self, data, exclude_keys=('SINGLE', ), unk_replace=0.):
+        self.lengths = data['LENGTH']
+        self.fields = [(key, field, key in _STACK_KEYS) for key, field in data.items()
+                       if key != 'LENGTH' and key not in exclude_keys]
+        self.unk_replace = unk_replace
+        self.singletons = _singleton_index(data['SINGLE']) if unk_replace else None
+        # slices of dense tensors are views of the data, the words are copied before the replacement.
+        self.dense_words = torch.is_tensor(data['WORD'])
+
+    def __call__(self, index, batch_length):
+        """
+        Select the rows index of every field, cut (or padded, for the ragged fields) to batch_length
+        (2 * batch_length - 1 for the decoder fields of the stack-pointer parser).
+        """
+        batch = {'LENGTH': self.lengths[index]}
+        for key, field, stacked in self.fields:
+            batch[key] = field[index, :2 * batch_length - 1 if stacked else batch_length]
+
+        if self.unk_replace:
+            words = batch['WORD']
+            if self.dense_words and isinstance(index, slice):
+                words = words.clone()
+            self.__replace_unk(words, index)
+            batch['WORD'] = words
+        return batch
+
+    def __replace_unk(self, words, index):
+        offsets, columns = self.singletons
+        if isinstance(index, slice):
+            rows = np.arange(*index.indices(offsets.size - 1))
+        else:
+            rows = index.cpu().numpy()
+        starts = offsets[rows]
+        counts = offsets[rows + 1] - starts
+        # the row in the batch of every singleton of the batch, and its position in columns.
+        batch_rows = np.repeat(np.arange(rows.size), counts)
+        positions = np.arange(batch_rows.size) - (np.cumsum(counts) - counts)[batch_rows] + starts[batch_rows]
+        noise = torch.rand(batch_rows.size).numpy() < self.unk_replace
+        rows = torch.from_numpy(batch_rows[noise]).to(words.device)
+        columns = torch.from_numpy(columns[positions[noise]]).to(words.device)
+        words[rows, columns] = UNK_ID
+
+
+# the collators of the datasets iterated in batches, built once and reused by every epoch. They are keyed by the id of
+# the SINGLE field of the data, which they do not hold, and dropped with it.
+_collators = {}
+
+
+def _dataset_collator(data, unk_replace=0.):
+    single = data['SINGLE']
+    key = (id(single), unk_replace)
+    collator = _collators.get(key)
+    if collator is None:
+        collator = _Collator(data, unk_replace=unk_replace)
+        _collators[key] = collator
+        weakref.finalize(single, _collators.pop, key, None)
+    return collator
+
+
+def _collate(data, index, batch_length, exclude_keys=('SINGLE', ), unk_replace=0.):
+    """
+    A single batch of the data, see _Collator.
+    """
+    return _Collator(data, exclude_keys=exclude_keys, unk_replace=unk_replace)(index, batch_length)
 
 
 def get_batch(data, batch_size, unk_replace=0.):
-    data, data_size,_ = data
+    data, data_size = data[:2]
     batch_size = min(data_size, batch_size)
     index = torch.randperm(data_size).long()[:batch_size]
 
-    lengths = data['LENGTH'][index]
-    max_length = lengths.max().item()
-    words = data['WORD']
-    single = data['SINGLE']
-    words = words[index, :max_length]
-    single = single[index, :max_length]
-    if unk_replace:
-        ones = single.new_ones(batch_size, max_length)
-        noise = single.new_empty(batch_size, max_length).bernoulli_(unk_replace).long()
-        words = words * (ones - single * noise)
-
-    stack_keys = ['STACK_HEAD', 'CHILD', 'SIBLING', 'STACK_TYPE', 'SKIP_CONNECT', 'MASK_DEC']
-    exclude_keys = set(['SINGLE', 'WORD', 'LENGTH'] + stack_keys)
-    stack_keys = set(stack_keys)
-    batch = {'WORD': words, 'LENGTH': lengths}
-    batch.update({key: field[index, :max_length] for key, field in data.items() if key not in exclude_keys})
-    batch.update({key: field[index, :2 * max_length - 1] for key, field in data.items() if key in stack_keys})
-    return batch
+    max_length = data['LENGTH'][index].max().item()
+    return _collate(data, index, max_length, unk_replace=unk_replace)
 
 
 def get_bucketed_batch(data, batch_size, unk_replace=0.):
-    data_buckets, bucket_sizes = data
+    data_buckets, bucket_sizes = data[:2]
     total_size = float(sum(bucket_sizes))
     # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
     # to select a bucket. Length of [scale[i], scale[i+1]] is proportional to
@@ -47,104 +128,207 @@ def get_bucketed_batch(data, batch_size, unk_replace=0.):
     batch_size = min(bucket_size, batch_size)
     index = torch.randperm(bucket_size).long()[:batch_size]
 
-    lengths = data['LENGTH'][index]
-    max_length = lengths.max().item()
-    words = data['WORD']
-    single = data['SINGLE']
-    words = words[index, :max_length]
-    single = single[index, :max_length]
-    if unk_replace:
-        ones = single.new_ones(batch_size, max_length)
-        noise = single.new_empty(batch_size, max_length).bernoulli_(unk_replace).long()
-        words = words * (ones - single * noise)
-
-    stack_keys = ['STACK_HEAD', 'CHILD', 'SIBLING', 'STACK_TYPE', 'SKIP_CONNECT', 'MASK_DEC']
-    exclude_keys = set(['SINGLE', 'WORD', 'LENGTH'] + stack_keys)
-    stack_keys = set(stack_keys)
-    batch = {'WORD': words, 'LENGTH': lengths}
-    batch.update({key: field[index, :max_length] for key, field in data.items() if key not in exclude_keys})
-    batch.update({key: field[index, :2 * max_length - 1] for key, field in data.items() if key in stack_keys})
-    return batch
+    max_length = data['LENGTH'][index].max().item()
+    return _collate(data, index, max_length, unk_replace=unk_replace)
 
 
 def iterate_batch(data, batch_size, unk_replace=0., shuffle=False):
-    data, data_size,_ = data
-
-    words = data['WORD']
-    single = data['SINGLE']
-    max_length = words.size(1)
-    if unk_replace:
-        ones = single.new_ones(data_size, max_length)
-        noise = single.new_empty(data_size, max_length).bernoulli_(unk_replace).long()
-        words = words * (ones - single * noise)
+    data, data_size = data[:2]
 
+    collate = _dataset_collator(data, unk_replace=unk_replace)
     indices = None
     if shuffle:
         indices = torch.randperm(data_size).long()
-        indices = indices.to(words.device)
+        indices = indices.to(data['LENGTH'].device)
 
-    stack_keys = ['STACK_HEAD', 'CHILD', 'SIBLING', 'STACK_TYPE', 'SKIP_CONNECT', 'MASK_DEC']
-    exclude_keys = set(['SINGLE', 'WORD', 'LENGTH'] + stack_keys)
-    stack_keys = set(stack_keys)
     for start_idx in range(0, data_size, batch_size):
         if shuffle:
             excerpt = indices[start_idx:start_idx + batch_size]
         else:
             excerpt = slice(start_idx, start_idx + batch_size)
 
-        lengths = data['LENGTH'][excerpt]
-        batch_length = lengths.max().item()
-        batch = {'WORD': words[excerpt, :batch_length], 'LENGTH': lengths}
-        batch.update({key: field[excerpt, :batch_length] for key, field in data.items() if key not in exclude_keys})
-        batch.update({key: field[excerpt, :2 * batch_length - 1] for key, field in data.items() if key in stack_keys})
-        yield batch
+        batch_length = data['LENGTH'][excerpt].max().item()
+        yield collate(excerpt, batch_length)
 
 
 def iterate_bucketed_batch(data, batch_size, unk_replace=0., shuffle=False):
-    data_tensor, bucket_sizes,_ = data
+    data_tensor, bucket_sizes = data[:2]
 
     bucket_indices = np.arange(len(bucket_sizes))
     if shuffle:
         np.random.shuffle((bucket_indices))
 
-    stack_keys = ['STACK_HEAD', 'CHILD', 'SIBLING', 'STACK_TYPE', 'SKIP_CONNECT', 'MASK_DEC']
-    exclude_keys = set(['SINGLE', 'WORD', 'LENGTH'] + stack_keys)
-    stack_keys = set(stack_keys)
     for bucket_id in bucket_indices:
         data = data_tensor[bucket_id]
         bucket_size = bucket_sizes[bucket_id]
         if bucket_size == 0:
             continue
 
-        words = data['WORD']
-        single = data['SINGLE']
-        bucket_length = words.size(1)
-        # unk_replace=False
-        if unk_replace:
-            ones = single.new_ones(bucket_size, bucket_length)
-            noise = single.new_empty(bucket_size, bucket_length).bernoulli_(unk_replace).long()
-            words = words * (ones - single * noise)
-
+        collate = _dataset_collator(data, unk_replace=unk_replace)
         indices = None
         if shuffle:
             indices = torch.randperm(bucket_size).long()
-            indices = indices.to(words.device)
+            indices = indices.to(data['LENGTH'].device)
         for start_idx in range(0, bucket_size, batch_size):
             if shuffle:
                 excerpt = indices[start_idx:start_idx + batch_size]
             else:
                 excerpt = slice(start_idx, start_idx + batch_size)
 
-            lengths = data['LENGTH'][excerpt]
-            batch_length = lengths.max().item()
-            batch = {'WORD': words[excerpt, :batch_length], 'LENGTH': lengths}
-            batch.update({key: field[excerpt, :batch_length] for key, field in data.items() if key not in exclude_keys})
-            batch.update({key: field[excerpt, :2 * batch_length - 1] for key, field in data.items() if key in stack_keys})
-            yield batch
+            batch_length = data['LENGTH'][excerpt].max().item()
+            yield collate(excerpt, batch_length)
+
+
+def iterate_sorted_batch(data, batch_size, max_tokens=None, sort_by_length=True):
+    """
+    Iterate the (non-bucketed) data in mini-batches for inference.
+    Sentences are grouped by length (if sort_by_length) so that little padding is computed, and every
+    batch holds at most batch_size sentences and, if max_tokens is given, at most max_tokens padded tokens.
+    The position of each sentence in the data is returned under the key 'INDEX'.
+    """
+    data, data_size = data[:2]
+
+    lengths = data['LENGTH']
+    if sort_by_length:
+        indices = torch.from_numpy(np.argsort(lengths.numpy(), kind='stable'))
+    else:
+        indices = torch.arange(data_size)
+
+    collate = _Collator(data, exclude_keys=())
+    start_idx = 0
+    while start_idx < data_size:
+        # grow the batch until it hits the sentence or the padded token budget.
+        end_idx = start_idx + 1
+        batch_length = lengths[indices[start_idx]].item()
+        while end_idx < data_size and end_idx - start_idx < batch_size:
+            length = max(batch_length, lengths[indices[end_idx]].item())
+            if max_tokens is not None and (end_idx - start_idx + 1) * length > max_tokens:
+                break
+            batch_length = length
+            end_idx += 1
+
+        excerpt = indices[start_idx:end_idx]
+        batch = collate(excerpt, batch_length)
+        batch['INDEX'] = excerpt
+        yield batch
+        start_idx = end_idx
+
+
+def length_buckets(lengths, num_buckets=8):
+    """
+    Bucket boundaries derived from the histogram of the sentence lengths, so that every bucket holds about the
+    same number of tokens. As with the _buckets tables of the readers, a sentence of length l goes to the first
+    bucket with l < boundary.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if len(lengths) == 0:
+        return []
+    histogram = np.bincount(lengths)
+    tokens = np.cumsum(histogram * np.arange(len(histogram)))
+    targets = tokens[-1] * np.arange(1, num_buckets) / num_buckets
+    boundaries = np.searchsorted(tokens, targets, side='left') + 1
+    return sorted(set(boundaries.tolist()) | {len(histogram)})
+
+
+def _batch_cost(num_sentences, batch_length, cost):
+    if cost == 'square':
+        return num_sentences * batch_length * batch_length
+    return num_sentences * batch_length
+
+
+def _token_batches(lengths, max_tokens, batch_size, cost, num_buckets, shuffle):
+    """
+    Split the sentences (of the given lengths) into batches of the same length bucket whose padded cost is at most
+    max_tokens (a batch always holds at least one sentence). Returns a list of index arrays.
+    """
+    boundaries = length_buckets(lengths, num_buckets)
+    bucket_ids = np.searchsorted(boundaries, lengths, side='right')
+
+    batches = []
+    for bucket_id in range(len(boundaries)):
+        indices = np.nonzero(bucket_ids == bucket_id)[0]
+        if shuffle:
+            np.random.shuffle(indices)
+        else:
+            indices = indices[np.argsort(lengths[indices], kind='stable')]
+
+        start = 0
+        batch_length = 0
+        for end, length in enumerate(lengths[indices].tolist()):
+            length = max(batch_length, length)
+            num_sentences = end - start + 1
+            if end > start and (num_sentences > batch_size or _batch_cost(num_sentences, length, cost) > max_tokens):
+                batches.append(indices[start:end])
+                start = end
+                length = lengths[indices[end]]
+            batch_length = length
+        if start < len(indices):
+            batches.append(indices[start:])
+    return batches
+
+
+def iterate_token_batch(data, max_tokens, batch_size=None, bucketed=False, cost='tokens', num_buckets=8, unk_replace=0., shuffle=False):
+    """
+    Iterate the data in mini-batches of (about) the same padded size instead of the same number of sentences.
+
+    Args:
+        data: tuple
+            the data, as returned by read_data (or read_bucketed_data if bucketed).
+        max_tokens: int
+            budget of each batch: the number of padded tokens (cost='tokens'), or the sum of the squared padded
+            lengths (cost='square'), the size of the arc scores of the biaffine parsers.
+        batch_size: int or None
+            maximum number of sentences in each batch (None: no limit).
+        bucketed: bool
+            the data is bucketed by length.
+        cost: str
+            'tokens' or 'square'.
+        num_buckets: int
+            number of length buckets derived from the length histogram of the data (of each bucket of the data, if
+            bucketed); the sentences of a batch are drawn from the same bucket.
+        unk_replace: float
+            the rate to replace a singleton word with UNK.
+        shuffle: bool
+            shuffle the sentences of each bucket and the order of the batches.
+
+    Returns: generator
+        batches with the same fields as iterate_batch.
+
+    """
+    if cost not in ('tokens', 'square'):
+        raise ValueError('Unknown batch cost: %s' % cost)
+    if batch_size is None:
+        batch_size = float('inf')
+
+    if bucketed:
+        datasets = [bucket for bucket, bucket_size in zip(*data[:2]) if bucket_size > 0]
+    else:
+        datasets = [data[0]] if data[1] > 0 else []
+
+    batches = []
+    collators = [_dataset_collator(data, unk_replace=unk_replace) for data in datasets]
+    for data_id, data in enumerate(datasets):
+        lengths = data['LENGTH'].cpu().numpy()
+        for excerpt in _token_batches(lengths, max_tokens, batch_size, cost, num_buckets, shuffle):
+            batches.append((data_id, excerpt, int(lengths[excerpt].max())))
+
+    if shuffle:
+        batches = [batches[i] for i in np.random.permutation(len(batches))]
+
+    for data_id, excerpt, batch_length in batches:
+        excerpt = torch.from_numpy(excerpt).to(datasets[data_id]['LENGTH'].device)
+        yield collators[data_id](excerpt, batch_length)
 
 
-def iterate_data(data, batch_size, bucketed=False, unk_replace=0., shuffle=False):
+def iterate_data(data, batch_size, bucketed=False, unk_replace=0., shuffle=False, max_tokens=None, cost='tokens'):
+    """
+    Iterate the data in batches of batch_size sentences or, if max_tokens is given, in batches of at most max_tokens
+    padded tokens (and batch_size sentences), see iterate_token_batch.
+    """
+    if max_tokens is not None:
+        return iterate_token_batch(data, max_tokens, batch_size=batch_size, bucketed=bucketed, cost=cost,
+                                   unk_replace=unk_replace, shuffle=shuffle)
     if bucketed:
-        return iterate_bucketed_batch(data, batch_size, unk_replace==unk_replace, shuffle=shuffle)
+        return iterate_bucketed_batch(data, batch_size, unk_replace=unk_replace, shuffle=shuffle)
     else:
-        return iterate_batch(data, batch_size, unk_replace==unk_replace, shuffle=shuffle)
+        return iterate_batch(data, batch_size, unk_replace=unk_replace, shuffle=shuffle)
@@ -0,0 +1,123 @@
+__author__ = 'max'
+
+"""
+Vocabulary counting for create_alphabets.
+
+All the files are split at sentence boundaries and counted in a single pass, by a pool of processes when
+num_workers > 1. The counts of the shards are merged in file order, so the characters and tags come out in order of
+first occurrence and the alphabets get the same ids as with a sequential read.
+"""
+import io
+import os
+import locale
+from multiprocessing import Pool
+from neuronlp2.io.alphabet import Alphabet
+from neuronlp2.io.parallel import split_file
+from neuronlp2.io.common import DIGIT_RE
+
+
+def _count_shard(shard):
+    path, start, end, separator, tag_columns, normalize_digits = shard
+    with open(path, 'rb') as file:
+        file.seek(start)
+        chunk = file.read(end - start)
+    # decoded as open(path, 'r') does.
+    source = io.TextIOWrapper(io.BytesIO(chunk), encoding=locale.getpreferredencoding(False))
+
+    tokens_count = {}
+    tags = [{} for _ in tag_columns]
+    for line in source:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+
+        tokens = line.split(separator)
+        tokens_count[tokens[1]] = tokens_count.get(tokens[1], 0) + 1
+        # dicts as ordered sets: the first occurrence keeps its position.
+        for column_tags, column in zip(tags, tag_columns):
+            column_tags[tokens[column]] = None
+
+    # the characters and the normalized words of each distinct token, in order of first occurrence.
+    words = {}
+    chars = {}
+    for token, count in tokens_count.items():
+        chars.update(dict.fromkeys(token))
+        word = DIGIT_RE.sub("0", token) if normalize_digits else token
+        words[word] = words.get(word, 0) + count
+    return words, chars, tags
+
+
+def count_vocabulary(paths, tag_columns, separator='\t', normalize_digits=True, num_workers=1):
+    """
+    Count the words of CoNLL files and collect their characters and tags.
+
+    Args:
+        paths: list
+            the files.
+        tag_columns: tuple
+            the columns of the tags to collect (e.g. POS and type).
+        separator: str
+            the column separator.
+        normalize_digits: bool
+            replace the digits of the words with 0.
+        num_workers: int
+            number of worker processes (1: counted in this process).
+
+    Returns: list
+        for each path, (word --> count, chars, [tags of each column]), the characters and the tags are dicts with
+        keys in order of first occurrence.
+
+    """
+    shards = []
+    for path_id, path in enumerate(paths):
+        for start, end in split_file(path, 4 * num_workers if num_workers > 1 else 1):
+            shards.append((path_id, (path, start, end, separator, tag_columns, normalize_digits)))
+
+    if num_workers > 1:
+        with Pool(num_workers) as pool:
+            parts = pool.map(_count_shard, [shard for _, shard in shards])
+    else:
+        parts = [_count_shard(shard) for _, shard in shards]
+
+    counts = [({}, {}, [{} for _ in tag_columns]) for _ in paths]
+    for (path_id, _), part in zip(shards, parts):
+        merge_counts(counts[path_id], part)
+    return counts
+
+
+def merge_counts(counts, other):
+    """
+    Add the counts of other (a later part of the data) to counts, in place.
+    """
+    words, chars, tags = counts
+    for word, count in other[0].items():
+        words[word] = words.get(word, 0) + count
+    chars.update(other[1])
+    for column_tags, other_tags in zip(tags, other[2]):
+        column_tags.update(other_tags)
+    return counts
+
+
+def embedding_vocabulary(words, embedd_dict):
+    """
+    The words found in the pretrained embedding, as is or lower-cased. Each distinct word is checked once, against
+    the keys of the embedding only.
+    """
+    keys = embedd_dict.keys()
+    return set(word for word in words if word in keys or word.lower() in keys)
+
+
+def vocabulary_words(paths, separator='\t', alphabet_directory=None, normalize_digits=True, num_workers=1):
+    """
+    The words a pretrained embedding is needed for: the words of the data files and, if the alphabets were already
+    created in alphabet_directory, the words of the word alphabet.
+    """
+    words = set()
+    for counts in count_vocabulary(paths, (), separator=separator, normalize_digits=normalize_digits,
+                                   num_workers=num_workers):
+        words.update(counts[0])
+    if alphabet_directory is not None and os.path.isdir(alphabet_directory):
+        word_alphabet = Alphabet('word', defualt_value=True, singleton=True)
+        word_alphabet.load(alphabet_directory)
+        words.update(word_alphabet.instances)
+    return words
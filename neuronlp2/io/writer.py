@@ -1,5 +1,11 @@
 __author__ = 'max'
 
+import os
+from collections import OrderedDict
+import numpy as np
+from neuronlp2.io.common import PAD, ROOT, END
+from neuronlp2.io.feature_store import FeatureStoreWriter
+
 
 class CoNLL03Writer(object):
     def __init__(self, word_alphabet, char_alphabet, pos_alphabet, chunk_alphabet, ner_alphabet):
@@ -18,14 +24,15 @@ class CoNLL03Writer(object):
 
     def write(self, word, pos, chunk, predictions, targets, lengths):
         batch_size, _ = word.shape
+        # the whole batch is decoded with one call per alphabet.
+        word = self.__word_alphabet.decode_many(word)
+        pos = self.__pos_alphabet.decode_many(pos)
+        chunk = self.__chunk_alphabet.decode_many(chunk)
+        targets = self.__ner_alphabet.decode_many(targets)
+        predictions = self.__ner_alphabet.decode_many(predictions)
         for i in range(batch_size):
             for j in range(lengths[i]):
-                w = self.__word_alphabet.get_instance(word[i, j])
-                p = self.__pos_alphabet.get_instance(pos[i, j])
-                ch = self.__chunk_alphabet.get_instance(chunk[i, j])
-                tgt = self.__ner_alphabet.get_instance(targets[i, j])
-                pred = self.__ner_alphabet.get_instance(predictions[i, j])
-                self.__source_file.write('%d %s %s %s %s %s\n' % (j + 1, w, p, ch, tgt, pred))
+                self.__source_file.write('%d %s %s %s %s %s\n' % (j + 1, word[i, j], pos[i, j], chunk[i, j], targets[i, j], predictions[i, j]))
             self.__source_file.write('\n')
 
 
@@ -46,12 +53,13 @@ class POSWriter(object):
         batch_size, _ = word.shape
         start = 1 if symbolic_root else 0
         end = 1 if symbolic_end else 0
+        # the whole batch is decoded with one call per alphabet.
+        word = self.__word_alphabet.decode_many(word)
+        predictions = self.__pos_alphabet.decode_many(predictions)
+        targets = self.__pos_alphabet.decode_many(targets)
         for i in range(batch_size):
             for j in range(start, lengths[i] - end):
-                w = self.__word_alphabet.get_instance(word[i, j])
-                pred = self.__pos_alphabet.get_instance(predictions[i, j])
-                tgt = self.__pos_alphabet.get_instance(targets[i, j])
-                self.__source_file.write('%d\t%s\t_\t%s\t%s\n' % (j, w, tgt, pred))
+                self.__source_file.write('%d\t%s\t_\t%s\t%s\n' % (j, word[i, j], targets[i, j], predictions[i, j]))
             self.__source_file.write('\n')
 
 
@@ -73,11 +81,137 @@ class CoNLLXWriter(object):
         batch_size, _ = word.shape
         start = 1 if symbolic_root else 0
         end = 1 if symbolic_end else 0
+        # the whole batch is decoded with one call per alphabet.
+        word = self.__word_alphabet.decode_many(word)
+        pos = self.__pos_alphabet.decode_many(pos)
+        type = self.__type_alphabet.decode_many(type)
+        head = np.asarray(head).tolist()
         for i in range(batch_size):
             for j in range(start, lengths[i] - end):
-                w = self.__word_alphabet.get_instance(word[i, j])
-                p = self.__pos_alphabet.get_instance(pos[i, j])
-                t = self.__type_alphabet.get_instance(type[i, j])
-                h = head[i, j]
-                self.__source_file.write('%d\t%s\t_\t_\t%s\t_\t%d\t%s\n' % (j, w, p, h, t))
+                self.__source_file.write('%d\t%s\t_\t_\t%s\t_\t%d\t%s\n' % (j, word[i, j], pos[i, j], head[i][j], type[i, j]))
             self.__source_file.write('\n')
+
+
+class SyntaxFeatureWriter(object):
+    """
+    Writer for the syntax features (hidden states) of a graph-based parser.
+    In 'text' format every feature is written to its own file in the output directory through a long-lived
+    buffered handle: every token is a line "word v_1 ... v_d" and sentences are separated by a blank line.
+    In 'binary' format the features are appended to a memory-mappable FeatureStore (see neuronlp2.io.feature_store),
+    which is indexed by sentence id and skips the sentences already written by a previous (crashed) run of the same
+    source.
+    """
+    FEATURES = ('arc_dep', 'arc_head', 'lstm_out', 'rel_dep', 'rel_head')
+    SKIP_WORDS = (PAD, ROOT, END)
+
+    def __init__(self, fmt='text', dtype='float32', buffer_size=1 << 20):
+        if fmt not in ['text', 'binary']:
+            raise ValueError('Unknown feature format: %s' % fmt)
+        self.__fmt = fmt
+        self.__dtype = dtype
+        self.__buffer_size = buffer_size
+        self.__feature_files = None
+        self.__store = None
+        self.__output_dir = None
+        self.__next_id = 0
+
+    def start(self, output_dir, source=None):
+        # source: identity of the input and the model (binary format), a store of another source is rebuilt.
+        self.__next_id = 0
+        self.__output_dir = output_dir
+        if self.__fmt == 'text':
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            self.__feature_files = OrderedDict()
+            for name in self.FEATURES:
+                self.__feature_files[name] = open(os.path.join(output_dir, name), 'w', buffering=self.__buffer_size)
+        else:
+            self.__store = FeatureStoreWriter(output_dir, dtype=self.__dtype, buffer_size=self.__buffer_size, source=source)
+            self.__store.open()
+
+    def close(self):
+        if self.__fmt == 'text':
+            for file in self.__feature_files.values():
+                file.close()
+            self.__feature_files = None
+        else:
+            self.__store.close()
+            self.__store = None
+
+    def abort(self):
+        """
+        Close the output after a failure. The partial text files are removed; the binary store keeps the sentences
+        written so far, which a later run skips.
+        """
+        if self.__fmt == 'text':
+            if self.__feature_files is not None:
+                for file in self.__feature_files.values():
+                    file.close()
+                self.__feature_files = None
+            for name in self.FEATURES:
+                path = os.path.join(self.__output_dir, name)
+                if os.path.exists(path):
+                    os.remove(path)
+            if os.path.isdir(self.__output_dir) and not os.listdir(self.__output_dir):
+                os.rmdir(self.__output_dir)
+        elif self.__store is not None:
+            self.__store.abort()
+            self.__store = None
+
+    def written(self, sent_id):
+        """
+        Check if the features of a sentence are already in the output (only tracked for the binary format).
+        """
+        return self.__store is not None and sent_id in self.__store
+
+    def write(self, words, features, sent_ids=None):
+        """
+
+        Args:
+            words: list
+                the original words of each sentence in the batch (including the symbolic root at position 0).
+            features: dict
+                feature name --> numpy array with shape = [batch, length, dim]
+            sent_ids: list or None
+                the sentence id of each sentence in the batch (binary format only).
+                If None, sentences are numbered in the order they are written.
+
+        """
+        # select the (sentence, position) pairs of all real tokens in the batch (skip the symbolic root).
+        max_length = next(iter(features.values())).shape[1]
+        batch_index = []
+        token_index = []
+        tokens = []
+        for i, sent in enumerate(words):
+            for j in range(1, min(len(sent), max_length)):
+                if sent[j] in self.SKIP_WORDS:
+                    continue
+                batch_index.append(i)
+                token_index.append(j)
+                tokens.append(sent[j])
+
+        # number of tokens of each sentence (used to place the sentence separators).
+        sent_sizes = np.bincount(np.array(batch_index, dtype=np.int64), minlength=len(words))
+        # [num_tokens, dim]
+        rows = OrderedDict((name, features[name][batch_index, token_index]) for name in self.FEATURES)
+        if self.__fmt == 'text':
+            for name in self.FEATURES:
+                self.__feature_files[name].write(self.__format_text(tokens, rows[name].tolist(), sent_sizes))
+        else:
+            if sent_ids is None:
+                sent_ids = list(range(self.__next_id, self.__next_id + len(words)))
+                self.__next_id += len(words)
+            ends = np.cumsum(sent_sizes)
+            sentences = [tokens[end - size:end] for size, end in zip(sent_sizes, ends)]
+            self.__store.write(sent_ids, sentences, rows)
+
+    @staticmethod
+    def __format_text(tokens, values, sent_sizes):
+        lines = []
+        start = 0
+        for size in sent_sizes:
+            for k in range(start, start + size):
+                lines.append(tokens[k] + ' ' + ' '.join(map(str, values[k])) + '\n')
+            lines.append('\n')
+            start += size
+        return ''.join(lines)
@@ -12,6 +12,67 @@ from neuronlp2.tasks import parser
 from neuronlp2.nn.variational_rnn import * 
 from neuronlp2.nn.attention import *
 
+
+def _label_energy(bilinear, type_h, type_c, loss_arc, leading_symbolic, exp=False, chunk_size=None):
+    """
+    Energy of the best label of every arc, computed for a chunk of heads at a time
+    instead of materializing the [batch, length, length, type_space] inputs of the bilinear layer.
+
+    Args:
+        bilinear: BiLinear
+            the label scorer.
+        type_h: Tensor
+            the head representations with shape = [batch, length, type_space]
+        type_c: Tensor
+            the child representations with shape = [batch, length, type_space]
+        loss_arc: Tensor
+            the log-probabilities of the arcs with shape = [batch, length_h, length_c]
+        leading_symbolic: int
+            number of symbolic labels leading in type alphabets
+        exp: bool
+            take the exponential of the energies (before the max over the labels).
+        chunk_size: int or None
+            number of heads scored at once (by default about 4M label scores per chunk).
+
+    Returns: (Tensor, Tensor)
+        the energy [batch, length_h, length_c] and the id [batch, length_h, length_c] of the best label of every arc.
+
+    """
+    batch, max_len, _ = type_h.size()
+    if chunk_size is None:
+        chunk_size = max(1, (1 << 22) // (batch * max_len * bilinear.out_features))
+    energies = []
+    label_ids = []
+    for start in range(0, max_len, chunk_size):
+        # [batch, chunk, length, num_labels]
+        loss_type = F.log_softmax(bilinear.pairwise(type_h[:, start:start + chunk_size], type_c), dim=3)
+        energy = loss_arc[:, start:start + chunk_size].unsqueeze(3) + loss_type
+        if exp:
+            energy = torch.exp(energy)
+        energy, label_id = energy[:, :, :, leading_symbolic:].max(dim=3)
+        energies.append(energy)
+        label_ids.append(label_id + leading_symbolic)
+    return torch.cat(energies, dim=1), torch.cat(label_ids, dim=1)
+
+
+def _decode_labeled(energy, label_ids, length, decoder='mst'):
+    """
+    Decode the trees from the energies of the best labels (see _label_energy).
+
+    Returns: (numpy array, numpy array)
+        predicted heads and types (in the same format as parser.decode_MST).
+    """
+    if decoder == 'eisner':
+        heads, _ = parser.decode_eisner(energy, length, labeled=False)
+    else:
+        heads, _ = parser.decode_MST(energy.cpu().numpy(), length, labeled=False)
+    label_ids = label_ids.cpu().numpy()
+    types = np.ones(heads.shape, dtype=np.int32)
+    for i in range(heads.shape[0]):
+        types[i, 1:length[i]] = label_ids[i, heads[i, 1:length[i]], np.arange(1, length[i])]
+    types[:, 0] = 0
+    return heads, types
+
 class PriorOrder(Enum):
     DEPTH = 0
     INSIDE_OUT = 1
@@ -216,7 +277,7 @@ class DeepBiAffine(nn.Module):
 
         return heads.cpu().numpy(), types.cpu().numpy()
 
-    def decode(self, input_word, input_char, input_pos, mask=None, leading_symbolic=0):
+    def decode(self, input_word, input_char, input_pos, mask=None, leading_symbolic=0, decoder='mst'):
         """
         Args:
             input_word: Tensor
@@ -233,6 +294,8 @@ class DeepBiAffine(nn.Module):
                 the initial states of RNN
             leading_symbolic: int
                 number of symbolic labels leading in type alphabets (set it to 0 if you are not sure)
+            decoder: str
+                'mst' for (non-projective) maximum spanning trees, 'eisner' for projective trees.
         Returns: (Tensor, Tensor)
                 predicted heads and types.
         """
@@ -241,26 +304,18 @@ class DeepBiAffine(nn.Module):
 
         # out_type shape [batch, length, type_space]
         type_h, type_c = out_type
-        batch, max_len, type_space = type_h.size()
-
-        type_h = type_h.unsqueeze(2).expand(batch, max_len, max_len, type_space).contiguous()
-        type_c = type_c.unsqueeze(1).expand(batch, max_len, max_len, type_space).contiguous()
-        # compute output for type [batch, length_h, length_c, num_labels]
-        out_type = self.bilinear(type_h, type_c)
 
         if mask is not None:
             minus_mask = mask.eq(0).unsqueeze(2)
             out_arc.masked_fill_(minus_mask, float('-inf'))
         # loss_arc shape [batch, length_h, length_c]
         loss_arc = F.log_softmax(out_arc, dim=1)
-        # loss_type shape [batch, length_h, length_c, num_labels]
-        loss_type = F.log_softmax(out_type, dim=3).permute(0, 3, 1, 2)
-        # [batch, num_labels, length_h, length_c]
-        energy = loss_arc.unsqueeze(1) + loss_type
+        # energy and id of the best label of each arc [batch, length_h, length_c]
+        energy, label_ids = _label_energy(self.bilinear, type_h, type_c, loss_arc, leading_symbolic)
 
         # compute lengths
         length = mask.sum(dim=1).long().cpu().numpy()
-        return parser.decode_MST(energy.cpu().numpy(), length, leading_symbolic=leading_symbolic, labeled=True)
+        return _decode_labeled(energy, label_ids, length, decoder=decoder)
 
 
 class NeuroMST(DeepBiAffine):
@@ -300,7 +355,7 @@ class NeuroMST(DeepBiAffine):
         return loss_arc, loss_type[:, 1:].sum(dim=1)
 
     @overrides
-    def decode(self, input_word, input_char, input_pos, mask=None, leading_symbolic=0):
+    def decode(self, input_word, input_char, input_pos, mask=None, leading_symbolic=0, decoder='mst'):
         """
         Args:
             input_word: Tensor
@@ -317,6 +372,8 @@ class NeuroMST(DeepBiAffine):
                 the initial states of RNN
             leading_symbolic: int
                 number of symbolic labels leading in type alphabets (set it to 0 if you are not sure)
+            decoder: str
+                'mst' for (non-projective) maximum spanning trees, 'eisner' for projective trees.
         Returns: (Tensor, Tensor)
                 predicted heads and types.
         """
@@ -324,7 +381,10 @@ class NeuroMST(DeepBiAffine):
         energy, out_type = self(input_word, input_char, input_pos, mask=mask)
         # compute lengths
         length = mask.sum(dim=1).long()
-        heads, _ = parser.decode_MST(energy.cpu().numpy(), length.cpu().numpy(), leading_symbolic=leading_symbolic, labeled=False)
+        if decoder == 'eisner':
+            heads, _ = parser.decode_eisner(energy, length, leading_symbolic=leading_symbolic, labeled=False)
+        else:
+            heads, _ = parser.decode_MST(energy.cpu().numpy(), length.cpu().numpy(), leading_symbolic=leading_symbolic, labeled=False)
         types = self._decode_types(out_type, torch.from_numpy(heads).type_as(length), leading_symbolic)
         return heads, types.cpu().numpy()
 
@@ -796,67 +856,6 @@ class BiRecurrentConvBiAffine(nn.Module):
         self.type_c = nn.Linear(out_dim, type_space)
         self.bilinear = BiLinear(type_space, type_space, self.num_labels)
     
-    def _write_new_line(self, path, output_dir):
-        # f_arc_dep = path+'arc_dep_udtout2'
-        # f_arc_head = path+'arc_head_udtout2'
-        # f_lstm_out = path+'lstm_out_udtout2'
-        # f_rel_dep = path+'rel_dep_udtout2'
-        # f_rel_head = path+'rel_head_udtout2'
-        
-        f_arc_dep = output_dir + 'arc_dep'
-        f_arc_head = output_dir + 'arc_head'
-        f_lstm_out = output_dir + 'lstm_out'
-        f_rel_dep = output_dir + 'rel_dep'
-        f_rel_head = output_dir + 'rel_head'
-        
-        f = open(f_arc_dep, 'a')
-        f.write('\n')
-        f.close()
-
-        f = open(f_arc_head, 'a')
-        f.write('\n')
-        f.close()
-
-        f = open(f_lstm_out, 'a')
-        f.write('\n')
-        f.close()
-
-        f = open(f_rel_dep, 'a')
-        f.write('\n')
-        f.close()
-        
-        f = open(f_rel_head, 'a')
-        f.write('\n')
-        f.close()
-
-    def _write_the_output(self, path, word, arc_dep, arc_head, lstm_out, rel_dep, rel_head, output_dir):
-        f_arc_dep = output_dir + 'arc_dep'
-        f_arc_head = output_dir + 'arc_head'
-        f_lstm_out = output_dir + 'lstm_out'
-        f_rel_dep = output_dir + 'rel_dep'
-        f_rel_head = output_dir + 'rel_head'
-        # print(">>>>>>>>>>>>>", word)
-
-        f = open(f_arc_dep, 'a')
-        f.write(word+' '+' '.join([str(float(a)) for a in arc_dep])+'\n')
-        f.close()
-
-        f = open(f_arc_head, 'a')
-        f.write(word+' '+' '.join([str(float(a)) for a in arc_head])+'\n')
-        f.close()
-
-        f = open(f_lstm_out, 'a')
-        f.write(word+' '+' '.join([str(float(a)) for a in lstm_out])+'\n')
-        f.close()
-
-        f = open(f_rel_dep, 'a')
-        f.write(word + ' ' + ' '.join([str(float(a)) for a in rel_dep])+'\n')
-        f.close()
-        
-        f = open(f_rel_head, 'a')
-        f.write(word + ' ' + ' '.join([str(float(a)) for a in rel_head])+'\n')
-        f.close()
-
     def get_syntax_feature(self, input_word, input_char, input_pos, mask=None, length=None, hx=None):
         # [batch, length, word_dim]
         word = self.word_embedd(input_word)
@@ -912,7 +911,7 @@ class BiRecurrentConvBiAffine(nn.Module):
 
         return torch.cat([arc_c, type_c, arc_h, type_h], dim=2)
 
-    def _get_rnn_output(self, input_word, input_char, input_pos, original_words=None, mask=None, length=None, hx=None, output_dir='./'):
+    def _get_rnn_output(self, input_word, input_char, input_pos, mask=None, length=None, hx=None, feature_writer=None, original_words=None, sent_ids=None):
         # [batch, length, word_dim]
         word = self.word_embedd(input_word)
         # apply dropout on input
@@ -954,58 +953,15 @@ class BiRecurrentConvBiAffine(nn.Module):
         # output size [batch, length, arc_space]
         arc_h = F.elu(self.arc_h(output))
         arc_c = F.elu(self.arc_c(output))
-        # print("-----------------")
-        # print(arc_h)
-        # print(arc_c)
 
         # output size [batch, length, type_space]
         type_h = F.elu(self.type_h(output))
         type_c = F.elu(self.type_c(output))
         
-        # import ipdb; ipdb.set_trace()
-        # dep, head, out, dep, head
-        # print("data", input_word.data[0])
-        total_index = -1
-        for i in range(len(input_word.data)):
-            # skip _ROOT which is at the beginning of every sent
-            for j in range(1, len(input_word.data[i])):
-                if j >= len(original_words[i]):
-                    break
-                total_index += 1
-            # if input_word.data[0][i] == 2 or input_word.data[0][i] == 1 or input_word.data[0][i] == 0:
-                # if input_word.data[i][j] == 2 or input_word.data[i][j] == 1:
-                #     print('#############################', self.id2word[int(input_word.data[i][j])])
-                #     continue
-                if original_words is not None:
-                    german_word = original_words[i][j]
-                elif self.original_words is not None:
-                    german_word = self.original_words[total_index]
-
-                else:
-                    print("Word not found")
-                #     german_word = self.id2word[int(input_word.data[i][j])]
-                print(german_word)
-                if german_word == '_PAD' or german_word == '_ROOT' or german_word == '_END':
-                    continue
-                try:
-                    if total_index % 100 == 0:
-                        alt_word = self.original_words[total_index]
-                        if (alt_word != german_word):
-                            print(f'{german_word} <> {alt_word}')
-                except Exception:
-                    pass
-
-                
-                self._write_the_output(self.path, 
-                                    german_word,
-                                    arc_c.data[i][j], 
-                                    arc_h.data[i][j],
-                                    lstm_out.data[i][j],
-                                    type_c.data[i][j], 
-                                    type_h.data[i][j],
-                                    output_dir=output_dir)
-            self._write_new_line(self.path,
-                output_dir=output_dir)
+        # export the syntax features of the batch: dep, head, out, dep, head
+        if feature_writer is not None:
+            features = {'arc_dep': arc_c, 'arc_head': arc_h, 'lstm_out': lstm_out, 'rel_dep': type_c, 'rel_head': type_h}
+            feature_writer.write(original_words, {name: feature.detach().cpu().numpy() for name, feature in features.items()}, sent_ids=sent_ids)
 
         # apply dropout
         # [batch, length, dim] --> [batch, 2 * length, dim]
@@ -1093,7 +1049,11 @@ class BiRecurrentConvBiAffine(nn.Module):
         _, types = out_type.max(dim=2)
         return types + leading_symbolic
 
-    def decode(self, input_word, input_char, input_pos, mask=None, length=None, hx=None, leading_symbolic=0):
+    def decode(self, input_word, input_char, input_pos, mask=None, length=None, hx=None, leading_symbolic=0, decoder=None):
+        # decode well-formed trees with the tree decoders, greedy decoding by default.
+        if decoder is not None:
+            return self.decode_mst(input_word, input_char, input_pos, mask=mask, length=length, hx=hx,
+                                   leading_symbolic=leading_symbolic, decoder=decoder)
         # out_arc shape [batch, length, length]
         out_arc, out_type, mask, length = self.forward(input_word, input_char, input_pos, mask=mask, length=length, hx=hx)
         out_arc = out_arc.data
@@ -1114,7 +1074,7 @@ class BiRecurrentConvBiAffine(nn.Module):
 
         return heads.cpu().numpy(), types.data.cpu().numpy()
 
-    def decode_mst(self, input_word, input_char, input_pos, mask=None, length=None, hx=None, leading_symbolic=0):
+    def decode_mst(self, input_word, input_char, input_pos, mask=None, length=None, hx=None, leading_symbolic=0, decoder='mst'):
         '''
         Args:
             input_word: Tensor
@@ -1131,6 +1091,8 @@ class BiRecurrentConvBiAffine(nn.Module):
                 the initial states of RNN
             leading_symbolic: int
                 number of symbolic labels leading in type alphabets (set it to 0 if you are not sure)
+            decoder: str
+                'mst' for (non-projective) maximum spanning trees, 'eisner' for projective trees.
         Returns: (Tensor, Tensor)
                 predicted heads and types.
         '''
@@ -1148,11 +1110,6 @@ class BiRecurrentConvBiAffine(nn.Module):
             else:
                 length = mask.data.sum(dim=1).long().cpu().numpy()
 
-        type_h = type_h.unsqueeze(2).expand(batch, max_len, max_len, type_space).contiguous()
-        type_c = type_c.unsqueeze(1).expand(batch, max_len, max_len, type_space).contiguous()
-        # compute output for type [batch, length, length, num_labels]
-        out_type = self.bilinear(type_h, type_c)
-
         # mask invalid position to -inf for log_softmax
         if mask is not None:
             minus_inf = -1e8
@@ -1161,9 +1118,6 @@ class BiRecurrentConvBiAffine(nn.Module):
 
         # loss_arc shape [batch, length, length]
         loss_arc = F.log_softmax(out_arc, dim=1)
-        # loss_type shape [batch, length, length, num_labels]
-        loss_type = F.log_softmax(out_type, dim=3).permute(0, 3, 1, 2)
-        # [batch, num_labels, length, length]
-        energy = torch.exp(loss_arc.unsqueeze(1) + loss_type)
-
-        return parser.decode_MST(energy.data.cpu().numpy(), length, leading_symbolic=leading_symbolic, labeled=True)
+        # energy and id of the best label of each arc [batch, length, length]
+        energy, label_ids = _label_energy(self.bilinear, type_h, type_c, loss_arc.data, leading_symbolic, exp=True)
+        return _decode_labeled(energy, label_ids, length, decoder=decoder)
@@ -178,12 +178,13 @@ class BiVarRecurrentConv(BiRecurrentConv):
 
 class BiRecurrentConvCRF(BiRecurrentConv):
     def __init__(self, word_dim, num_words, char_dim, num_chars, rnn_mode, hidden_size, out_features, num_layers,
-                 num_labels, embedd_word=None, embedd_char=None, p_in=0.33, p_out=0.5, p_rnn=(0.5, 0.5), bigram=False, activation='elu'):
+                 num_labels, embedd_word=None, embedd_char=None, p_in=0.33, p_out=0.5, p_rnn=(0.5, 0.5), bigram=False, activation='elu',
+                 crf_algorithm='sequential'):
         super(BiRecurrentConvCRF, self).__init__(word_dim, num_words, char_dim, num_chars, rnn_mode, hidden_size, out_features, num_layers,
                                                  num_labels, embedd_word=embedd_word, embedd_char=embedd_char,
                                                  p_in=p_in, p_out=p_out, p_rnn=p_rnn, activation=activation)
 
-        self.crf = ChainCRF(out_features, num_labels, bigram=bigram)
+        self.crf = ChainCRF(out_features, num_labels, bigram=bigram, algorithm=crf_algorithm)
         self.readout = None
         self.criterion = None
 
@@ -213,12 +214,13 @@ class BiRecurrentConvCRF(BiRecurrentConv):
 
 class BiVarRecurrentConvCRF(BiVarRecurrentConv):
     def __init__(self, word_dim, num_words, char_dim, num_chars, rnn_mode, hidden_size, out_features, num_layers,
-                 num_labels, embedd_word=None, embedd_char=None, p_in=0.33, p_out=0.33, p_rnn=(0.33, 0.33), bigram=False, activation='elu'):
+                 num_labels, embedd_word=None, embedd_char=None, p_in=0.33, p_out=0.33, p_rnn=(0.33, 0.33), bigram=False, activation='elu',
+                 crf_algorithm='sequential'):
         super(BiVarRecurrentConvCRF, self).__init__(word_dim, num_words, char_dim, num_chars, rnn_mode, hidden_size, out_features, num_layers,
                                                     num_labels, embedd_word=embedd_word, embedd_char=embedd_char,
                                                     p_in=p_in, p_out=p_out, p_rnn=p_rnn, activation=activation)
 
-        self.crf = ChainCRF(out_features, num_labels, bigram=bigram)
+        self.crf = ChainCRF(out_features, num_labels, bigram=bigram, algorithm=crf_algorithm)
         self.readout = None
         self.criterion = None
 
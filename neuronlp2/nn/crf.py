@@ -4,11 +4,69 @@ import numpy as np
 import torch
 import torch.nn as nn
 from torch.nn.parameter import Parameter
+from torch.autograd.function import Function, once_differentiable
 from neuronlp2.nn.modules import BiAffine
 
 
+# log-space zero of the identity matrices used for masked steps: finite, so that no gradient becomes nan.
+_LOG_ZERO = -1e4
+
+
+class _LogDet(Function):
+    """
+    log |det L| of a batch of matrices by LU factorization, with the pivots of U (not differentiable).
+    """
+    @staticmethod
+    def forward(ctx, L):
+        LU, pivots, _ = torch.linalg.lu_factor_ex(L)
+        diag = LU.diagonal(dim1=1, dim2=2).clone()
+        ctx.save_for_backward(LU, pivots)
+        ctx.mark_non_differentiable(diag, pivots)
+        return diag.abs().log().sum(dim=1), diag, pivots
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output, grad_diag, grad_pivots):
+        LU, pivots = ctx.saved_tensors
+        # d log |det L| / dL = L^-T
+        eye = torch.eye(LU.size(1), device=LU.device, dtype=LU.dtype).expand_as(LU)
+        return grad_output.view(-1, 1, 1) * torch.linalg.lu_solve(LU, pivots, eye, adjoint=True)
+
+
+def _log_matmul(left, right):
+    # [..., n, n] x [..., n, n] in the log semiring, as a matmul of the exponentials shifted by their max.
+    left_max = left.max(dim=-1, keepdim=True)[0].detach()
+    right_max = right.max(dim=-2, keepdim=True)[0].detach()
+    output = torch.matmul((left - left_max).exp(), (right - right_max).exp())
+    return output.clamp(min=torch.finfo(output.dtype).tiny).log() + left_max + right_max
+
+
+def _max_matmul(left, right):
+    # [..., n, n] x [..., n, n] in the max-plus semiring, with the argmax of every entry.
+    return (left.unsqueeze(-2) + right.transpose(-1, -2).unsqueeze(-3)).max(dim=-1)
+
+
+def _pad_identity(matrices):
+    # pad [batch, length, n, n] to an even length with an identity matrix.
+    batch, length, n, _ = matrices.size()
+    if length % 2 == 0:
+        return matrices
+    identity = matrices.new_full((n, n), _LOG_ZERO).fill_diagonal_(0.)
+    return torch.cat([matrices, identity.expand(batch, 1, n, n)], dim=1)
+
+
+def _tree_reduce(matrices):
+    '''
+    Log-semiring product of the matrices [batch, length, n, n] along dim 1, with O(log length) sequential steps.
+    '''
+    while matrices.size(1) > 1:
+        matrices = _pad_identity(matrices)
+        matrices = _log_matmul(matrices[:, 0::2], matrices[:, 1::2])
+    return matrices[:, 0]
+
+
 class ChainCRF(nn.Module):
-    def __init__(self, input_size, num_labels, bigram=True):
+    def __init__(self, input_size, num_labels, bigram=True, algorithm='sequential'):
         '''
 
         Args:
@@ -18,12 +76,20 @@ class ChainCRF(nn.Module):
                 the number of labels of the crf layer
             bigram: bool
                 if apply bi-gram parameter.
+            algorithm: str
+                'sequential' steps through time, 'scan' multiplies the transition matrices of all the steps
+                as a balanced tree (log-semiring for the loss, max-plus for decoding), with O(log length) depth.
+                'scan' only pays off for long sequences (over about 100 tokens); its decoding is slower than the
+                sequential one and its gradients differ slightly (accumulated in a different order).
         '''
         super(ChainCRF, self).__init__()
+        if algorithm not in ['sequential', 'scan']:
+            raise ValueError('Unknown CRF algorithm: %s' % algorithm)
         self.input_size = input_size
         self.num_labels = num_labels + 1
         self.pad_label_id = num_labels
         self.bigram = bigram
+        self.algorithm = algorithm
 
 
         # state weight tensor
@@ -95,6 +161,8 @@ class ChainCRF(nn.Module):
         '''
         batch, length, _ = input.size()
         energy = self(input, mask=mask)
+        if self.algorithm == 'scan':
+            return self._loss_scan(energy, target, mask=mask)
         # shape = [length, batch, num_label, num_label]
         energy_transpose = energy.transpose(0, 1)
         # shape = [length, batch]
@@ -130,6 +198,26 @@ class ChainCRF(nn.Module):
 
         return torch.logsumexp(partition, dim=1) - tgt_energy
 
+    def _loss_scan(self, energy, target, mask=None):
+        batch, length, num_label, _ = energy.size()
+        # target energy: the previous label of the first step is the pad label.
+        prev_label = torch.cat([target.new_full((batch, 1), num_label - 1), target[:, :-1]], dim=1)
+        index = (prev_label * num_label + target).unsqueeze(2)
+        tgt_energy = energy.view(batch, length, num_label * num_label).gather(dim=2, index=index).squeeze(2).sum(dim=1)
+
+        # shape = [batch, num_label]
+        partition = energy[:, 0, -1, :]
+        if length > 1:
+            transitions = energy[:, 1:]
+            if mask is not None:
+                # masked steps keep the partition unchanged: replace them by the identity.
+                identity = energy.new_full((num_label, num_label), _LOG_ZERO).fill_diagonal_(0.)
+                transitions = torch.where(mask[:, 1:, None, None] > 0, transitions, identity)
+            # [batch, num_label, num_label]
+            transitions = _tree_reduce(transitions)
+            partition = torch.logsumexp(partition.unsqueeze(2) + transitions, dim=1)
+        return torch.logsumexp(partition, dim=1) - tgt_energy
+
     def decode(self, input, mask=None, leading_symbolic=0):
         """
 
@@ -147,6 +235,8 @@ class ChainCRF(nn.Module):
         """
 
         energy = self(input, mask=mask)
+        if self.algorithm == 'scan':
+            return self._decode_scan(energy, leading_symbolic=leading_symbolic)
 
         # Input should be provided as (n_batch, n_time_steps, num_labels, num_labels)
         # For convenience, we need to dimshuffle to (n_time_steps, n_batch, num_labels, num_labels)
@@ -177,6 +267,43 @@ class ChainCRF(nn.Module):
 
         return back_pointer.transpose(0, 1) + leading_symbolic
 
+    def _decode_scan(self, energy, leading_symbolic=0):
+        # Viterbi as a max-plus product of the transition matrices, reduced as a balanced tree. Backtracking
+        # walks down the tree: the argmax of each product is the label between its two halves.
+        batch, length, _, _ = energy.size()
+        # remove the pad label and the first #symbolic labels.
+        # shape = [batch, num_label]
+        pi = energy[:, 0, -1, leading_symbolic:-1]
+        if length == 1:
+            return pi.argmax(dim=1, keepdim=True) + leading_symbolic
+
+        # shape = [batch, length - 1, num_label, num_label]
+        transitions = energy[:, 1:, leading_symbolic:-1, leading_symbolic:-1]
+        num_label = transitions.size(2)
+        splits = []
+        while transitions.size(1) > 1:
+            num_steps = transitions.size(1)
+            transitions = _pad_identity(transitions)
+            transitions, split = _max_matmul(transitions[:, 0::2], transitions[:, 1::2])
+            splits.append((num_steps, split))
+
+        # best labels of the first and the last step.
+        best = (pi.unsqueeze(2) + transitions[:, 0]).view(batch, -1).argmax(dim=1)
+        # labels at the boundaries of the segments of the current level, shape = [batch, num_segments + 1]
+        labels = torch.stack([best // num_label, best % num_label], dim=1)
+        batch_index = torch.arange(batch, device=energy.device).unsqueeze(1)
+        for num_steps, split in reversed(splits):
+            num_segments = split.size(1)
+            segment_index = torch.arange(num_segments, device=energy.device).unsqueeze(0)
+            middle = split[batch_index, segment_index, labels[:, :-1], labels[:, 1:]]
+            # interleave the boundaries with the labels between the two halves of each segment.
+            new_labels = labels.new_empty(batch, 2 * num_segments + 1)
+            new_labels[:, 0::2] = labels
+            new_labels[:, 1::2] = middle
+            # drop the boundary of the padding identity.
+            labels = new_labels[:, :num_steps + 1]
+        return labels + leading_symbolic
+
 
 class TreeCRF(nn.Module):
     '''
@@ -193,6 +320,8 @@ class TreeCRF(nn.Module):
         super(TreeCRF, self).__init__()
         self.model_dim = model_dim
         self.energy = BiAffine(model_dim, model_dim)
+        # cached [length, length] identity mask, reused across batches.
+        self._eye = None
 
     def forward(self, heads, children, mask=None):
         '''
@@ -216,6 +345,141 @@ class TreeCRF(nn.Module):
         output = self.energy(heads, children, mask_query=mask, mask_key=mask)
         return output
 
+    def _diag_mask(self, length, device):
+        if self._eye is None or self._eye.size(0) < length or self._eye.device != device:
+            self._eye = torch.eye(length, dtype=torch.bool, device=device)
+        return self._eye[:length, :length]
+
+    def _laplacian(self, energy, mask=None):
+        '''
+        Build the Laplacian of the (shifted) arc weights, without the row and column of the root.
+
+        Args:
+            energy: Tensor
+                the energy tensor with shape = [batch, length, length]
+            mask: Tensor or None
+                the mask tensor with shape = [batch, length]
+
+        Returns: (Tensor, Tensor, Tensor)
+            the laplacian [batch, length - 1, length - 1], the arc weights [batch, length, length - 1]
+            and the log-space shift of each child [batch, length - 1].
+
+        '''
+        batch, length, _ = energy.size()
+        # no self loops and no arcs from or to padded positions.
+        invalid = self._diag_mask(length, energy.device).unsqueeze(0)
+        if mask is not None:
+            padded = mask.eq(0)
+            invalid = invalid | padded.unsqueeze(2) | padded.unsqueeze(1)
+        # the root is never a child: only keep the arcs into positions 1 .. length - 1.
+        # [batch, length, length - 1]
+        energy = energy.masked_fill(invalid, float('-inf'))[:, :, 1:]
+
+        # shift the arcs into each child by their max, so that the weights are in (0, 1].
+        # the shift cancels out in the gradient of log Z, so it is kept out of the graph.
+        shift = energy.detach().max(dim=1)[0]
+        shift = torch.where(torch.isfinite(shift), shift, torch.zeros_like(shift))
+        A = torch.exp(energy - shift.unsqueeze(1))
+
+        # L = D - A, where D is the total weight of the arcs into each child.
+        L = -A[:, 1:]
+        diag = L.diagonal(dim1=1, dim2=2)
+        diag.add_(A.sum(dim=1))
+        if mask is not None:
+            # padded positions are isolated: identity rows and columns.
+            diag.add_(1. - mask[:, 1:])
+        return L, A, shift
+
+    @staticmethod
+    def _logdet(L):
+        '''
+        log det L by LU factorization, and the instances where it is lost to cancellation.
+
+        The determinant of very peaked distributions is lost to cancellation in any precision. Its relative error
+        grows as eps / pivot, so the instances with a pivot below 1e6 * eps (0.1 in single precision) or a non
+        positive determinant are unstable.
+        '''
+        logdet, diag, pivots = _LogDet.apply(L)
+        # the sign of the determinant: the negative pivots and the row swaps.
+        swaps = pivots.ne(torch.arange(1, L.size(1) + 1, device=L.device, dtype=pivots.dtype)).sum(dim=1)
+        negative = (diag.lt(0).sum(dim=1) + swaps) % 2 == 1
+        unstable = negative | ~torch.isfinite(logdet) | (diag.abs().min(dim=1)[0] < 1e6 * torch.finfo(L.dtype).eps)
+        return logdet, unstable
+
+    def log_partition(self, energy, mask=None):
+        '''
+
+        Args:
+            energy: Tensor
+                the energy tensor with shape = [batch, length, length]
+            mask: Tensor or None
+                the mask tensor with shape = [batch, length]
+
+        Returns: Tensor
+            the log partition function log Z(x) with shape = [batch]
+
+        '''
+        L, _, shift = self._laplacian(energy, mask=mask)
+        # the shift of child c scales column c of L by exp(-shift[c])
+        logdet, unstable = self._logdet(L)
+        if unstable.any():
+            # keep the result of the stable instances only and redo the others in log space.
+            L = torch.where(unstable.view(-1, 1, 1), torch.eye(L.size(1), device=L.device, dtype=L.dtype).expand_as(L), L)
+            logdet = self._logdet(L)[0]
+            logz = self._log_partition_elimination(energy[unstable].double(), mask=None if mask is None else mask[unstable])
+            return (logdet + shift.sum(dim=1)).index_put((unstable.nonzero().squeeze(1), ), logz.to(logdet.dtype))
+        return logdet + shift.sum(dim=1)
+
+    def _log_partition_elimination(self, energy, mask=None):
+        '''
+        log Z(x) by eliminating the words one by one from the Laplacian, in log space.
+
+        Eliminating word k adds the paths i --> k --> j to the arcs i --> j and the paths root --> k --> j to the
+        root arcs, and multiplies Z by the total weight of the arcs into k (the pivot). Unlike the LU factorization
+        of the determinant, the pivots and the updated weights are sums of non-negative terms (no cancellation), so
+        log Z is exact for arbitrarily peaked energies. It takes length - 1 sequential steps, for the few instances
+        where the determinant is lost.
+
+        Args:
+            energy: Tensor
+                the energy tensor with shape = [batch, length, length]
+            mask: Tensor or None
+                the mask tensor with shape = [batch, length]
+
+        Returns: Tensor
+            the log partition function log Z(x) with shape = [batch]
+
+        '''
+        batch, length, _ = energy.size()
+        # a finite stand-in for the log weight of missing arcs, so that the gradients of logaddexp stay defined.
+        neg = -1e30
+        invalid = self._diag_mask(length, energy.device).unsqueeze(0)
+        if mask is not None:
+            padded = mask.eq(0)
+            invalid = invalid | padded.unsqueeze(2) | padded.unsqueeze(1)
+        energy = energy.masked_fill(invalid, neg)
+        # [batch, length - 1]: arcs from the root, [batch, length - 1, length - 1]: arcs between the words.
+        root = energy[:, 0, 1:]
+        arcs = energy[:, 1:, 1:]
+        if mask is not None:
+            # padded positions are isolated, with a pivot of 1.
+            root = root.masked_fill(padded[:, 1:], 0.)
+
+        eye = self._diag_mask(length - 1, energy.device)
+        logz = energy.new_zeros(batch)
+        for k in range(length - 1):
+            pivot = torch.logsumexp(torch.cat([root[:, k:k + 1], arcs[:, :, k]], dim=1), dim=1)
+            logz = logz + pivot
+            into = arcs[:, :, k] - pivot.unsqueeze(1)
+            out = arcs[:, k, :]
+            arcs = torch.logaddexp(arcs, into.unsqueeze(2) + out.unsqueeze(1))
+            root = torch.logaddexp(root, (root[:, k] - pivot).unsqueeze(1) + out)
+            # k is gone, and the cycles i --> k --> i are not arcs.
+            removed = eye | eye[k].unsqueeze(0) | eye[k].unsqueeze(1)
+            arcs = arcs.masked_fill(removed, neg)
+            root = root.masked_fill(eye[k], neg)
+        return logz
+
     def loss(self, heads, children, target_heads, mask=None):
         '''
 
@@ -232,49 +496,44 @@ class TreeCRF(nn.Module):
         Returns: Tensor
                 A 1D tensor for minus log likelihood loss
         '''
-        batch, length, _ = heads.size()
         # [batch, length, length]
-        energy = self(heads, children, mask=mask).double()
-        A = torch.exp(energy)
-        # mask out invalid positions
-        if mask is not None:
-            mask = mask.double()
-            A = A * mask.unsqueeze(2) * mask.unsqueeze(1)
-
-        # set diagonal elements to 0
-        diag_mask = 1.0 - torch.eye(length).unsqueeze(0).type_as(energy)
-        A = A * diag_mask
-        energy = energy * diag_mask
-
-        # get D [batch, length]
-        D = A.sum(dim=1)
-        rtol = 1e-4
-        atol = 1e-6
-        D += atol
+        energy = self(heads, children, mask=mask)
+        # compute partition Z(x) [batch]
+        z = self.log_partition(energy, mask=mask)
+
+        # compute target energy [batch, length - 1]
+        tgt_energy = energy.gather(dim=1, index=target_heads.unsqueeze(1)).squeeze(1)[:, 1:]
         if mask is not None:
-            D = D * mask
+            tgt_energy = tgt_energy * mask[:, 1:]
+        # sum over dim=1 shape = [batch]
+        tgt_energy = tgt_energy.sum(dim=1)
+        return z - tgt_energy
 
-        # [batch, length, length]
-        D = torch.diag_embed(D)
+    def marginals(self, heads, children, mask=None):
+        '''
+        Edge marginals (posterior probabilities of the arcs) by the matrix-tree theorem.
 
-        # compute laplacian matrix
-        # [batch, length, length]
-        L = D - A
+        Args:
+            heads: Tensor
+                the head input tensor with shape = [batch, length, model_dim]
+            children: Tensor
+                the child input tensor with shape = [batch, length, model_dim]
+            mask: Tensor or None
+                the mask tensor with shape = [batch, length]
 
-        if mask is not None:
-            L = L + torch.diag_embed(1. - mask)
+        Returns: Tensor
+            the marginal probability of each arc head --> child with shape = [batch, length_h, length_c]
+            (every column of a real child sums to 1).
 
-        # compute partition Z(x) [batch]
-        L = L[:, 1:, 1:]
-        z = torch.logdet(L)
-
-        # first create index matrix [length, batch]
-        index = torch.arange(0, length).view(length, 1).expand(length, batch)
-        index = index.type_as(energy).long()
-        batch_index = torch.arange(0, batch).type_as(index)
-        # compute target energy [length-1, batch]
-        tgt_energy = energy[batch_index, target_heads.t(), index][1:]
-        # sum over dim=0 shape = [batch]
-        tgt_energy = tgt_energy.sum(dim=0)
-
-        return (z - tgt_energy).float()
+        '''
+        energy = self(heads, children, mask=mask)
+        L, A, _ = self._laplacian(energy, mask=mask)
+        batch, length, _ = energy.size()
+        # d log Z / d A[h, c] = inv[c, c] - inv[c, h] (the second term only for h > 0)
+        inv = torch.inverse(L)
+        # [batch, length, length - 1]
+        grad = inv.diagonal(dim1=1, dim2=2).unsqueeze(1).repeat(1, length, 1)
+        grad[:, 1:] -= inv.transpose(1, 2)
+        marginals = A * grad
+        # the root has no head.
+        return torch.cat([marginals.new_zeros(batch, length, 1), marginals], dim=2)
@@ -72,6 +72,31 @@ class BiLinear(nn.Module):
         # convert back to [batch1, batch2, ..., out_features]
         return output.view(batch_size + (self.out_features, ))
 
+    def pairwise(self, input_left, input_right):
+        """
+        Output of every (left, right) pair, without expanding the inputs to [batch, length_left, length_right, features].
+
+        Args:
+            input_left: Tensor
+                the left input tensor with shape = [batch, length_left, left_features]
+            input_right: Tensor
+                the right input tensor with shape = [batch, length_right, right_features]
+
+        Returns: Tensor
+            the output tensor with shape = [batch, length_left, length_right, out_features]
+
+        """
+        batch, length_left, _ = input_left.size()
+        _, length_right, _ = input_right.size()
+        # [batch, length_left, out_features * right_features]
+        left = torch.matmul(input_left, self.U.transpose(0, 1).reshape(self.left_features, -1))
+        left = left.view(batch, length_left * self.out_features, self.right_features)
+        # [batch, length_left, out_features, length_right]
+        output = torch.bmm(left, input_right.transpose(1, 2)).view(batch, length_left, self.out_features, length_right)
+        output = output.transpose(2, 3)
+        output = output + F.linear(input_left, self.weight_left, self.bias).unsqueeze(2) + F.linear(input_right, self.weight_right, None).unsqueeze(1)
+        return output
+
     def __repr__(self):
         return self.__class__.__name__ + ' (' \
                + 'left_features=' + str(self.left_features) \
@@ -0,0 +1,135 @@
+__author__ = 'max'
+
+"""
+Batched Eisner decoder for projective dependency trees.
+
+The charts are [batch, length, length] tensors where chart[b, i, j] (i < j) is the best score of the span i..j.
+Every span width is filled for all the sentences and all the start positions at once through strided views
+of the charts, so the only Python loops run over the span width (forward) and the depth of the derivation
+(backtracking).
+"""
+import numpy as np
+import torch
+
+# span types
+_COMPLETE_RIGHT = 0    # complete span i..j headed by i
+_COMPLETE_LEFT = 1     # complete span i..j headed by j
+_INCOMPLETE_RIGHT = 2  # incomplete span with the arc i --> j
+_INCOMPLETE_LEFT = 3   # incomplete span with the arc j --> i
+
+
+def _stripe(chart, n, w, start):
+    """
+    View of the chart with shape [batch, n, w], element (b, i, k) is chart[b, start[0] + i, start[1] + i + k]
+    """
+    batch, length, _ = chart.size()
+    return chart.as_strided((batch, n, w), (length * length, length + 1, 1), storage_offset=start[0] * length + start[1])
+
+
+def decode_eisner(energies, lengths, leading_symbolic=0, labeled=True):
+    """
+    decode best projective parsing tree with the Eisner algorithm (same interface and outputs as decode_MST).
+    :param energies: Tensor or numpy array
+        energies of each edge. the shape is [batch_size, num_labels, n_steps, n_steps] (labeled)
+        or [batch_size, n_steps, n_steps] (unlabeled), where the summy root is at index 0.
+    :param lengths: Tensor or numpy array
+        the length of each instance in the shape [batch_size].
+    :param leading_symbolic: int
+        number of symbolic dependency types leading in type alphabets)
+    :return: (numpy array, numpy array)
+        predicted heads and types.
+    """
+    energies = torch.as_tensor(energies)
+    if labeled:
+        assert energies.dim() == 4, 'dimension of energies is not equal to 4'
+        # get best label for each edge.
+        scores, label_id_matrix = energies[:, leading_symbolic:].max(dim=1)
+        label_id_matrix = label_id_matrix + leading_symbolic
+    else:
+        assert energies.dim() == 3, 'dimension of energies is not equal to 3'
+        scores = energies
+        label_id_matrix = None
+
+    device = scores.device
+    batch, length, _ = scores.size()
+    lengths = torch.as_tensor(lengths, device=device).long()
+    scores = scores.float().clone()
+    # the root cannot be a dependent.
+    scores[:, :, 0] = float('-inf')
+
+    # the charts read along a column are also kept transposed, so that all the views are contiguous in k.
+    minus_inf = float('-inf')
+    complete_r = scores.new_full((batch, length, length), minus_inf)
+    complete_l = scores.new_full((batch, length, length), minus_inf)
+    complete_r_t = scores.new_full((batch, length, length), minus_inf)
+    complete_l_t = scores.new_full((batch, length, length), minus_inf)
+    incomplete_r = scores.new_full((batch, length, length), minus_inf)
+    incomplete_l_t = scores.new_full((batch, length, length), minus_inf)
+    for chart in [complete_r, complete_l, complete_r_t, complete_l_t]:
+        chart.diagonal(dim1=1, dim2=2).fill_(0)
+    # split points of the spans [4, batch, length, length]
+    backptr = torch.zeros(4, batch, length, length, dtype=torch.long, device=device)
+
+    for w in range(1, length):
+        n = length - w
+        starts = torch.arange(n, device=device).unsqueeze(0)
+        # I(i, j) = max_{i <= r < j} C(i -> r) + C(r + 1 <- j) + s(arc)
+        span = _stripe(complete_r, n, w, (0, 0)) + _stripe(complete_l_t, n, w, (w, 1))
+        span, split = span.max(dim=2)
+        split = split + starts
+        incomplete_r.diagonal(w, dim1=1, dim2=2).copy_(span + scores.diagonal(w, dim1=1, dim2=2))
+        incomplete_l_t.diagonal(-w, dim1=1, dim2=2).copy_(span + scores.diagonal(-w, dim1=1, dim2=2))
+        backptr[_INCOMPLETE_RIGHT].diagonal(w, dim1=1, dim2=2).copy_(split)
+        backptr[_INCOMPLETE_LEFT].diagonal(w, dim1=1, dim2=2).copy_(split)
+
+        # C(i -> j) = max_{i < r <= j} I(i -> r) + C(r -> j)
+        span = _stripe(incomplete_r, n, w, (0, 1)) + _stripe(complete_r_t, n, w, (w, 1))
+        span, split = span.max(dim=2)
+        complete_r.diagonal(w, dim1=1, dim2=2).copy_(span)
+        complete_r_t.diagonal(-w, dim1=1, dim2=2).copy_(span)
+        backptr[_COMPLETE_RIGHT].diagonal(w, dim1=1, dim2=2).copy_(split + starts + 1)
+
+        # C(i <- j) = max_{i <= r < j} C(i <- r) + I(r <- j)
+        span = _stripe(complete_l, n, w, (0, 0)) + _stripe(incomplete_l_t, n, w, (w, 0))
+        span, split = span.max(dim=2)
+        complete_l.diagonal(w, dim1=1, dim2=2).copy_(span)
+        complete_l_t.diagonal(-w, dim1=1, dim2=2).copy_(span)
+        backptr[_COMPLETE_LEFT].diagonal(w, dim1=1, dim2=2).copy_(split + starts)
+
+    # backtrack all the sentences at once, starting from the complete span 0 -> length - 1.
+    heads = torch.zeros(batch, length, dtype=torch.long, device=device)
+    # type of the left and right sub-span of each span type, and the offset of the right sub-span.
+    left_types = torch.tensor([_INCOMPLETE_RIGHT, _COMPLETE_LEFT, _COMPLETE_RIGHT, _COMPLETE_RIGHT], device=device)
+    right_types = torch.tensor([_COMPLETE_RIGHT, _INCOMPLETE_LEFT, _COMPLETE_LEFT, _COMPLETE_LEFT], device=device)
+    right_offsets = torch.tensor([0, 0, 1, 1], device=device)
+
+    b = torch.arange(batch, device=device)
+    i = torch.zeros(batch, dtype=torch.long, device=device)
+    j = lengths - 1
+    t = torch.full((batch,), _COMPLETE_RIGHT, dtype=torch.long, device=device)
+    while True:
+        keep = i < j
+        if not keep.any():
+            break
+        b, i, j, t = b[keep], i[keep], j[keep], t[keep]
+        r = backptr[t, b, i, j]
+
+        arc_r = t == _INCOMPLETE_RIGHT
+        heads[b[arc_r], j[arc_r]] = i[arc_r]
+        arc_l = t == _INCOMPLETE_LEFT
+        heads[b[arc_l], i[arc_l]] = j[arc_l]
+
+        b = torch.cat([b, b])
+        i, j = torch.cat([i, r + right_offsets[t]]), torch.cat([r, j])
+        t = torch.cat([left_types[t], right_types[t]])
+
+    mask = torch.arange(length, device=device).unsqueeze(0) < lengths.unsqueeze(1)
+    heads = heads * mask.long()
+    pars = heads.cpu().numpy().astype(np.int32)
+    if not labeled:
+        return pars, None
+
+    types = label_id_matrix.gather(dim=1, index=heads.unsqueeze(1)).squeeze(1)
+    types = torch.where(mask, types, types.new_ones(()))
+    types[:, 0] = 0
+    return pars, types.cpu().numpy().astype(np.int32)
@@ -0,0 +1,173 @@
+__author__ = 'max'
+
+"""
+Array-based Chu-Liu-Edmonds maximum spanning tree decoder.
+
+Each round picks the best head of every node with one argmax over the score matrix. If the resulting graph
+has a cycle, the cycle is contracted into a single node with a few vectorized gathers, the contracted graph
+is decoded and the cycle is expanded again. The cycle search is compiled with numba when it is installed.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _find_cycle(heads):
+    """
+    Find a cycle in the graph given by the head of every node (the root 0 has head -1).
+    Returns: numpy array
+        the nodes of the cycle in order, or an empty array if the graph is a tree.
+    """
+    length = heads.shape[0]
+    # 0: not visited, 1: on the current path, 2: done
+    state = np.zeros(length, dtype=np.int8)
+    state[0] = 2
+    for i in range(1, length):
+        node = i
+        while state[node] == 0:
+            state[node] = 1
+            node = heads[node]
+        if state[node] == 1:
+            # the walk came back to a node of the current path: collect the cycle.
+            cycle_len = 1
+            child = heads[node]
+            while child != node:
+                cycle_len += 1
+                child = heads[child]
+            cycle = np.empty(cycle_len, dtype=np.int64)
+            for k in range(cycle_len):
+                cycle[k] = node
+                node = heads[node]
+            return cycle
+        # mark the current path as done.
+        node = i
+        while state[node] == 1:
+            state[node] = 2
+            node = heads[node]
+    return np.zeros(0, dtype=np.int64)
+
+
+if njit is not None:
+    _find_cycle = njit(cache=True)(_find_cycle)
+
+
+def chu_liu_edmonds(scores):
+    """
+    Args:
+        scores: numpy array
+            the score matrix with shape = [length, length], scores[h, c] is the score of the arc h --> c.
+            node 0 is the root.
+
+    Returns: numpy array
+        the head of every node with shape = [length] (the head of the root is -1).
+
+    """
+    scores = np.array(scores, dtype=np.float64)
+    # no self loops and no arcs into the root.
+    np.fill_diagonal(scores, -np.inf)
+    scores[:, 0] = -np.inf
+    return _chu_liu_edmonds(scores)
+
+
+def _chu_liu_edmonds(scores):
+    length = scores.shape[0]
+    heads = scores.argmax(axis=0)
+    heads[0] = -1
+    cycle = _find_cycle(heads)
+    if len(cycle) == 0:
+        return heads
+
+    in_cycle = np.zeros(length, dtype=bool)
+    in_cycle[cycle] = True
+    noncycle = np.nonzero(~in_cycle)[0]
+    # score of the arcs inside the cycle
+    cycle_scores = scores[heads[cycle], cycle]
+    cycle_score = cycle_scores.sum()
+
+    # arcs entering the cycle: breaking the cycle at c and attaching c to an outside head h.
+    # [num_noncycle, cycle_len]
+    enter_scores = scores[noncycle[:, None], cycle] - cycle_scores + cycle_score
+    enter_index = enter_scores.argmax(axis=1)
+    # arcs leaving the cycle: the best head inside the cycle of every outside node.
+    # [cycle_len, num_noncycle]
+    leave_scores = scores[cycle[:, None], noncycle]
+    leave_index = leave_scores.argmax(axis=0)
+
+    # the cycle is contracted into the last node of the new graph.
+    num_noncycle = len(noncycle)
+    contracted = np.empty([num_noncycle + 1, num_noncycle + 1], dtype=scores.dtype)
+    contracted[:num_noncycle, :num_noncycle] = scores[noncycle[:, None], noncycle]
+    contracted[:num_noncycle, num_noncycle] = enter_scores[np.arange(num_noncycle), enter_index]
+    contracted[num_noncycle, :num_noncycle] = leave_scores[leave_index, np.arange(num_noncycle)]
+    contracted[num_noncycle, num_noncycle] = -np.inf
+
+    contracted_heads = _chu_liu_edmonds(contracted)
+
+    # expand the contracted node.
+    new_heads = np.empty(length, dtype=heads.dtype)
+    new_heads[cycle] = heads[cycle]
+    outside = contracted_heads[:num_noncycle]
+    from_cycle = outside == num_noncycle
+    new_heads[noncycle[~from_cycle]] = noncycle[outside[~from_cycle]]
+    new_heads[noncycle[from_cycle]] = cycle[leave_index[from_cycle]]
+    new_heads[0] = -1
+    # the head of the cycle breaks the cycle at its best entry point.
+    cycle_head = contracted_heads[num_noncycle]
+    new_heads[cycle[enter_index[cycle_head]]] = noncycle[cycle_head]
+    return new_heads
+
+
+_executors = {}
+
+
+def _get_executor(num_workers):
+    if num_workers not in _executors:
+        _executors[num_workers] = ProcessPoolExecutor(max_workers=num_workers)
+    return _executors[num_workers]
+
+
+def decode_MST(energies, lengths, leading_symbolic=0, labeled=True, num_workers=0):
+    """
+    decode best parsing tree with MST algorithm (same interface and outputs as parser.decode_MST).
+    :param energies: energies: numpy 4D tensor
+        energies of each edge. the shape is [batch_size, num_labels, n_steps, n_steps],
+        where the summy root is at index 0.
+    :param lengths: numpy 1D tensor
+        the length of each instance in the shape [batch_size].
+    :param leading_symbolic: int
+        number of symbolic dependency types leading in type alphabets)
+    :param num_workers: int
+        decode the sentences of the batch on a pool of num_workers processes (0 for no pool).
+    :return:
+    """
+    if labeled:
+        assert energies.ndim == 4, 'dimension of energies is not equal to 4'
+        # get best label for each edge (for all the instances at once).
+        energies = energies[:, leading_symbolic:]
+        label_id_matrix = energies.argmax(axis=1) + leading_symbolic
+        energies = energies.max(axis=1)
+    else:
+        assert energies.ndim == 3, 'dimension of energies is not equal to 3'
+        label_id_matrix = None
+
+    batch_size, max_length, _ = energies.shape
+    score_matrices = [energies[i, :lengths[i], :lengths[i]] for i in range(batch_size)]
+    if num_workers > 0 and batch_size > 1:
+        trees = list(_get_executor(num_workers).map(chu_liu_edmonds, score_matrices))
+    else:
+        trees = [chu_liu_edmonds(score_matrix) for score_matrix in score_matrices]
+
+    pars = np.zeros([batch_size, max_length], dtype=np.int32)
+    types = np.ones([batch_size, max_length], dtype=np.int32) if labeled else None
+    for i, tree in enumerate(trees):
+        length = lengths[i]
+        pars[i, 1:length] = tree[1:]
+        if labeled:
+            types[i, 1:length] = label_id_matrix[i, tree[1:], np.arange(1, length)]
+    if labeled:
+        types[:, 0] = 0
+    return pars, types
@@ -2,6 +2,8 @@ __author__ = 'max'
 
 import re
 import numpy as np
+from neuronlp2.tasks.mst import decode_MST
+from neuronlp2.tasks.eisner import decode_eisner
 
 def is_uni_punctuation(word):
     match = re.match("^[^\w\s]+$]", word, flags=re.UNICODE)
@@ -34,14 +36,17 @@ def eval(words, postags, heads_pred, types_pred, heads, types, word_alphabet, po
     total_root = 0.
     start = 1 if symbolic_root else 0
     end = 1 if symbolic_end else 0
+    # the whole batch is decoded with one call per alphabet.
+    word_instances = word_alphabet.decode_many(words)
+    pos_instances = pos_alphabet.decode_many(postags)
     for i in range(batch_size):
         ucm = 1.
         lcm = 1.
         ucm_nopunc = 1.
         lcm_nopunc = 1.
         for j in range(start, lengths[i] - end):
-            word = word_alphabet.get_instance(words[i, j])
-            pos = pos_alphabet.get_instance(postags[i, j])
+            word = word_instances[i, j]
+            pos = pos_instances[i, j]
 
             total += 1
             if heads[i, j] == heads_pred[i, j]:
@@ -80,9 +85,9 @@ def eval(words, postags, heads_pred, types_pred, heads, types, word_alphabet, po
            (corr_root, total_root), batch_size
 
 
-def decode_MST(energies, lengths, leading_symbolic=0, labeled=True):
+def decode_MST_recursive(energies, lengths, leading_symbolic=0, labeled=True):
     """
-    decode best parsing tree with MST algorithm.
+    decode best parsing tree with the recursive Chu-Liu-Edmonds algorithm (reference implementation of decode_MST).
     :param energies: energies: numpy 4D tensor
         energies of each edge. the shape is [batch_size, num_labels, n_steps, n_steps],
         where the summy root is at index 0.
@@ -1,18 +1,108 @@
 __author__ = 'max'
 
-from collections import OrderedDict
+import os
 import pickle
+import hashlib
 import numpy as np
 from gensim.models.word2vec import Word2Vec
 import gzip
 
 from neuronlp2.io.common import DIGIT_RE
+from neuronlp2.io.alphabet import Alphabet
+from neuronlp2.io.embedding import EmbeddingDict, build_embedding, restrict_embedding, load_cached_embedding, \
+    save_cached_embedding
 
-def load_embedding_dict(embedding, embedding_path, normalize_digits=True):
+_VALUE_CHUNK = 10000
+
+
+def _parse_values(values, embedd_dim):
+    # the vectors of a list of lines of values, parsed in one call.
+    if len(values) == 0:
+        return np.zeros([0, max(embedd_dim, 0)], dtype=np.float32)
+    array = np.loadtxt(values, dtype=np.float32, comments=None, ndmin=2)
+    if array.shape != (len(values), embedd_dim):
+        raise ValueError('invalid embedding values, expected %d values per word' % embedd_dim)
+    return array
+
+
+def _read_text_embedding(embedding_path, sskip, normalize_digits, targets=None):
+    # the words and the vectors of a gzipped text embedding (glove / senna format, or sskip with a header line and
+    # words of several tokens). With targets, only the values of the words in targets are parsed, into a matrix
+    # allocated for len(targets) rows. A word seen several times keeps its first position and its last vector.
+    embedd_dim = -1
+    rows = {}
+    words = []
+    values = []
+    chunks = []
+    matrix = None
+
+    def flush():
+        nonlocal matrix
+        if len(values) == 0:
+            return
+        vectors = _parse_values(values, embedd_dim)
+        indices = np.array([rows.setdefault(word, len(rows)) for word in words], dtype=np.int64)
+        if targets is None:
+            chunks.append((indices, vectors))
+        else:
+            if matrix is None:
+                matrix = np.empty([len(targets), embedd_dim], dtype=np.float32)
+            matrix[indices] = vectors
+        del words[:]
+        del values[:]
+
+    with gzip.open(embedding_path, 'rt') as file:
+        if sskip:
+            # skip the first line
+            file.readline()
+        for line in file:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+
+            if sskip:
+                tokens = line.split()
+                if len(tokens) < embedd_dim:
+                    continue
+                if embedd_dim < 0:
+                    embedd_dim = len(tokens) - 1
+                start = len(tokens) - embedd_dim
+                word = ' '.join(tokens[0:start])
+            else:
+                # the number of values is checked when they are parsed.
+                if embedd_dim < 0:
+                    embedd_dim = len(line.split()) - 1
+                tokens = line.split(None, 1)
+                start = 1
+                word = tokens[0]
+            word = DIGIT_RE.sub("0", word) if normalize_digits else word
+            if targets is not None and word not in targets:
+                continue
+            words.append(word)
+            values.append(' '.join(tokens[start:]))
+            if len(values) == _VALUE_CHUNK:
+                flush()
+    flush()
+
+    if targets is None:
+        matrix = np.empty([len(rows), max(embedd_dim, 0)], dtype=np.float32)
+        for indices, vectors in chunks:
+            matrix[indices] = vectors
+    elif matrix is None:
+        matrix = np.empty([0, max(embedd_dim, 0)], dtype=np.float32)
+    return list(rows), matrix[:len(rows)], embedd_dim
+
+
+def load_embedding_dict(embedding, embedding_path, normalize_digits=True, cache_dir=None, words=None):
     """
     load word embeddings from file
     :param embedding:
     :param embedding_path:
+    :param cache_dir: directory of the binary copy of the embedding, memory-mapped by the later loads (default: the
+                      directory of the embedding file).
+    :param words: if given (a collection of words or an Alphabet), only the embeddings of these words and of their
+                  lower case are loaded: the file is streamed once and the values of the other words are not parsed.
+                  The filtered embedding is cached for this set of words.
     :return: embedding dict, embedding dimention, caseless
     """
     print("loading embedding: %s from %s" % (embedding, embedding_path))
@@ -21,87 +111,76 @@ def load_embedding_dict(embedding, embedding_path, normalize_digits=True):
         word2vec = Word2Vec.load_word2vec_format(embedding_path, binary=True)
         embedd_dim = word2vec.vector_size
         return word2vec, embedd_dim
-    elif embedding == 'glove':
-        # loading GloVe
-        embedd_dim = -1
-        embedd_dict = OrderedDict()
-        with gzip.open(embedding_path, 'rt') as file:
-            for line in file:
-                line = line.strip()
-                if len(line) == 0:
-                    continue
+    elif embedding not in ['glove', 'senna', 'sskip', 'polyglot']:
+        raise ValueError("embedding should choose from [word2vec, senna, glove, sskip, polyglot]")
 
-                tokens = line.split()
-                if embedd_dim < 0:
-                    embedd_dim = len(tokens) - 1
-                else:
-                    assert (embedd_dim + 1 == len(tokens))
-                embedd = np.empty([1, embedd_dim], dtype=np.float32)
-                embedd[:] = tokens[1:]
-                word = DIGIT_RE.sub("0", tokens[0]) if normalize_digits else tokens[0]
-                embedd_dict[word] = embedd
-        return embedd_dict, embedd_dim
-    elif embedding == 'senna':
-        # loading Senna
-        embedd_dim = -1
-        embedd_dict = OrderedDict()
-        with gzip.open(embedding_path, 'rt') as file:
-            for line in file:
-                line = line.strip()
-                if len(line) == 0:
-                    continue
+    cache_dir = cache_dir if cache_dir else os.path.dirname(os.path.abspath(embedding_path))
+    cache_name = '%s.%s%s' % (os.path.basename(embedding_path), embedding, '' if normalize_digits else '.raw')
+    stat = os.stat(embedding_path)
+    source = {'path': os.path.abspath(embedding_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
 
-                tokens = line.split()
-                if embedd_dim < 0:
-                    embedd_dim = len(tokens) - 1
-                else:
-                    # print('eeeee',embedd_dim)
-                    # print('eee222',len(tokens))
-
-                    assert (embedd_dim + 1 == len(tokens))
-                embedd = np.empty([1, embedd_dim], dtype=np.float32)
-                embedd[:] = tokens[1:]
-                word = DIGIT_RE.sub("0", tokens[0]) if normalize_digits else tokens[0]
-                embedd_dict[word] = embedd
-        return embedd_dict, embedd_dim
-    elif embedding == 'sskip':
-        embedd_dim = -1
-        embedd_dict = OrderedDict()
-        with gzip.open(embedding_path, 'rt') as file:
-            # skip the first line
-            file.readline()
-            for line in file:
-                line = line.strip()
-                try:
-                    if len(line) == 0:
-                        continue
-
-                    tokens = line.split()
-                    if len(tokens) < embedd_dim:
-                        continue
-
-                    if embedd_dim < 0:
-                        embedd_dim = len(tokens) - 1
-
-                    embedd = np.empty([1, embedd_dim], dtype=np.float32)
-                    start = len(tokens) - embedd_dim
-                    word = ' '.join(tokens[0:start])
-                    embedd[:] = tokens[start:]
-                    word = DIGIT_RE.sub("0", word) if normalize_digits else word
-                    embedd_dict[word] = embedd
-                except UnicodeDecodeError:
-                    continue
-        return embedd_dict, embedd_dim
-    elif embedding == 'polyglot':
+    targets = None
+    if words is not None:
+        targets = set(words.instances if isinstance(words, Alphabet) else words)
+        targets.update([word.lower() for word in targets])
+        full_embedd_dict = load_cached_embedding(cache_dir, cache_name, source)
+        if full_embedd_dict is not None:
+            print("loaded cached embedding from %s" % cache_dir)
+            return restrict_embedding(full_embedd_dict, targets), full_embedd_dict.dim
+        cache_name += '.' + hashlib.sha1('\n'.join(sorted(targets)).encode('utf-8')).hexdigest()[:16]
+
+    embedd_dict = load_cached_embedding(cache_dir, cache_name, source)
+    if embedd_dict is not None:
+        print("loaded cached embedding from %s" % cache_dir)
+        return embedd_dict, embedd_dict.dim
+
+    if embedding == 'polyglot':
         words, embeddings = pickle.load(open(embedding_path, 'rb'), encoding='latin1')
         _, embedd_dim = embeddings.shape
-        embedd_dict = OrderedDict()
-        for i, word in enumerate(words):
-            embedd = np.empty([1, embedd_dim], dtype=np.float32)
-            embedd[:] = embeddings[i, :]
-            word = DIGIT_RE.sub("0", word) if normalize_digits else word
-            embedd_dict[word] = embedd
+        words = [DIGIT_RE.sub("0", word) if normalize_digits else word for word in words]
+        embedd_dict = build_embedding(words, np.asarray(embeddings, dtype=np.float32))
+        if targets is not None:
+            embedd_dict = restrict_embedding(embedd_dict, targets)
+    else:
+        # loading GloVe, Senna or sskip
+        words, embeddings, embedd_dim = _read_text_embedding(embedding_path, embedding == 'sskip', normalize_digits,
+                                                             targets=targets)
+        embedd_dict = build_embedding(words, embeddings)
+
+    if embedd_dim < 0:
         return embedd_dict, embedd_dim
+    try:
+        save_cached_embedding(cache_dir, cache_name, source, embedd_dict)
+    except OSError as e:
+        print("embedding is not cached: %s" % repr(e))
+    return embedd_dict, embedd_dim
 
-    else:
-        raise ValueError("embedding should choose from [word2vec, senna, glove, sskip, polyglot]")
+
+def lookup_embeddings(embedd_dict, words):
+    """
+    Embeddings of a list of words, or of their lower case, for the embedding table of a network.
+    :param embedd_dict: the embedding dict returned by load_embedding_dict.
+    :param words: the words.
+    :return: the embeddings of the words found [number of words found, dim], and the boolean mask of the words found.
+    """
+    if isinstance(embedd_dict, EmbeddingDict):
+        rows = embedd_dict.rows(words)
+        missing = np.nonzero(rows < 0)[0]
+        if len(missing) > 0:
+            rows[missing] = embedd_dict.rows([words[i].lower() for i in missing])
+        found = rows >= 0
+        return np.asarray(embedd_dict.matrix[rows[found]], dtype=np.float32), found
+
+    embeddings = []
+    found = np.zeros(len(words), dtype=bool)
+    for i, word in enumerate(words):
+        if word in embedd_dict:
+            embeddings.append(embedd_dict[word])
+        elif word.lower() in embedd_dict:
+            embeddings.append(embedd_dict[word.lower()])
+        else:
+            continue
+        found[i] = True
+    embeddings = [np.asarray(embedding, dtype=np.float32).reshape(1, -1) for embedding in embeddings]
+    # [0, 1] broadcasts to the rows of any table when no word is found.
+    return np.concatenate(embeddings) if embeddings else np.zeros([0, 1], dtype=np.float32), found